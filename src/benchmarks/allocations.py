@@ -0,0 +1,142 @@
+"""
+Measures the memory churn of decoding and preprocessing 12 megapixel pages with the reused buffers of the steps
+against `PREPROCESS_BUFFERS_MB=0`, where OpenCV allocates every result like before.
+
+Each variant runs in a fresh process for its peak RSS. Allocations are the full-size arrays OpenCV allocated for a result
+plus the arrays newly allocated for the buffers, page faults show how much memory was freshly mapped.
+
+Run from `src`: `python -m benchmarks.allocations`
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_SIZE = (4000, 3000)
+# smaller arrays like histograms aren't counted
+MIN_COUNTED_BYTES = 64 * 1024
+
+
+class Counter:
+    def __init__(self):
+        self.allocations = 0
+        self.allocated_bytes = 0
+
+    def count(self, result, args):
+        arrays = [value for value in (result if isinstance(result, tuple) else (result,)) if isinstance(value, np.ndarray)]
+        given = {arg.__array_interface__['data'][0] for arg in args if isinstance(arg, np.ndarray)}
+        for array in arrays:
+            if array.nbytes >= MIN_COUNTED_BYTES and array.__array_interface__['data'][0] not in given:
+                self.allocations += 1
+                self.allocated_bytes += array.nbytes
+
+    def wrap(self, fn):
+        def counted(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            self.count(result, [*args, *kwargs.values()])
+            return result
+        return counted
+
+
+class CountingModule:
+    """
+    Stands in for `cv2` or `numpy` in `optimize_image`, counts the arrays returned by the `counted` functions which aren't one of the arguments.
+    """
+
+    def __init__(self, module, counter: Counter, counted=None):
+        self.module = module
+        self.counter = counter
+        self.counted = counted
+
+    def __getattr__(self, name):
+        value = getattr(self.module, name)
+        if name == 'createCLAHE':
+            return lambda *args, **kwargs: CountingClahe(value(*args, **kwargs), self.counter)
+        if self.counted is not None and name not in self.counted or not callable(value) or isinstance(value, type):
+            return value
+        return self.counter.wrap(value)
+
+
+class CountingClahe:
+    def __init__(self, clahe, counter: Counter):
+        self.apply = counter.wrap(clahe.apply)
+
+
+def child(pages: int):
+    import resource
+    import time
+
+    from benchmarks.documents import encode, text_page
+    from helpers import optimize_image
+
+    counter = Counter()
+    optimize_image.cv2 = CountingModule(optimize_image.cv2, counter)
+    # the buffers, `np.frombuffer` of the encoded page doesn't allocate
+    optimize_image.np = CountingModule(optimize_image.np, counter, counted={'empty'})
+    variants = {
+        'auto': encode(text_page(*PAGE_SIZE, font_scale=1.0)[0]),
+        'auto,dark': encode(text_page(*PAGE_SIZE, font_scale=1.0, background=35, color=220)[0]),
+        'clahe+threshold': encode(text_page(*PAGE_SIZE, font_scale=1.0, background=200, color=100)[0]),
+        'equalhist': encode(text_page(*PAGE_SIZE, font_scale=1.0, color=175)[0]),
+    }
+    with open('/proc/self/statm') as file:
+        baseline = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    results = {}
+    for name, data in variants.items():
+        profile = name.split(',')[0]
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        counter.allocations = counter.allocated_bytes = 0
+        start = time.perf_counter()
+        for _ in range(pages):
+            image, scale = optimize_image.optimize_image_bytes(data, 'page.png', profile)
+            pil_image = optimize_image.to_pil_image(image, 'page.png', None, scale)
+            del image, pil_image
+        duration = (time.perf_counter() - start) / pages
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        results[name] = {
+            'ms': duration * 1000,
+            'allocations': counter.allocations / pages,
+            'allocated_mb': counter.allocated_bytes / pages / 1024 / 1024,
+            'faulted_mb': (after.ru_minflt - usage.ru_minflt) * os.sysconf('SC_PAGE_SIZE') / pages / 1024 / 1024,
+        }
+    # kilobytes on Linux
+    results['peak_rss_mb'] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline) / 1024 / 1024
+    print(json.dumps(results))
+
+
+def run(buffers_mb: int, pages: int) -> dict:
+    env = {**os.environ, 'PREPROCESS_BUFFERS_MB': str(buffers_mb)}
+    proc = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.allocations', '--child', '--pages', str(pages)],
+        cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=5, help='pages per variant, the first ones fill the buffers')
+    parser.add_argument('--buffers-mb', type=int, default=64)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.pages)
+        return
+
+    print(f'{PAGE_SIZE[0]}x{PAGE_SIZE[1]} pages, {args.pages} per variant, per page')
+    for label, buffers_mb in (('allocating', 0), (f'buffers {args.buffers_mb}MB', args.buffers_mb)):
+        results = run(buffers_mb, args.pages)
+        print(f'{label}: peak RSS above the encoded pages {results.pop("peak_rss_mb"):.0f}MiB')
+        for name, result in results.items():
+            print(
+                f'  {name:16} | {result["ms"]:7.1f}ms | {result["allocations"]:4.1f} allocations {result["allocated_mb"]:6.1f}MiB'
+                f' | page faults {result["faulted_mb"]:6.1f}MiB'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Deterministic synthetic documents for the benchmarks, the same arguments always create the same pixels.
+"""
+import random
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# `(text, left, top, width, height)`
+WordBox = Tuple[str, int, int, int, int]
+
+
+def text_page(
+    width: int, height: int,
+    font_scale=1.0, seed=42,
+    background=255, color=0,
+) -> Tuple[np.ndarray, List[WordBox]]:
+    """
+    BGR page with lines of random words, returns it with the boxes of the words.
+    """
+    rng = random.Random(seed)
+    page = np.full((height, width, 3), background, np.uint8)
+    thickness = max(1, round(font_scale * 2))
+    line_height = cv2.getTextSize('Xg', FONT, font_scale, thickness)[0][1] * 2
+    words = []
+    top = line_height
+    while top + line_height < height:
+        left = line_height
+        while True:
+            text = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFG') for _ in range(rng.randint(3, 9)))
+            (text_width, text_height), baseline = cv2.getTextSize(text, FONT, font_scale, thickness)
+            if left + text_width + line_height > width:
+                break
+            cv2.putText(page, text, (left, top + text_height), FONT, font_scale, (color, color, color), thickness)
+            words.append((text, left, top, text_width, text_height + baseline))
+            left += text_width + rng.randint(line_height // 3, line_height)
+        top += rng.randint(line_height, line_height * 3 // 2)
+    return page, words
+
+
+def photo_page(width: int, height: int, seed=42) -> np.ndarray:
+    """
+    BGR photo-like page: smooth color gradients with noise and a caption.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.arange(width, dtype=np.float32) / width
+    y = np.arange(height, dtype=np.float32) / height
+    channels = [
+        127 + 100 * np.outer(np.cos(y * rng.uniform(2, 6)), np.sin(x * rng.uniform(2, 6) + phase))
+        for phase in rng.uniform(0, np.pi, 3)
+    ]
+    page = np.stack(channels, axis=2) + rng.standard_normal((height, width, 3), dtype=np.float32) * 12
+    page = np.clip(page, 0, 255).astype(np.uint8)
+    caption, _ = text_page(width, max(200, height // 10), font_scale=2, seed=seed)
+    page[-caption.shape[0]:] = caption
+    return page
+
+
+def screenshot_page(width: int, height: int, seed=42) -> Tuple[np.ndarray, List[WordBox]]:
+    """
+    BGR screenshot-like page: a dark toolbar, a photo and a few paragraphs in wide empty margins, returns it with the boxes of the paragraph words.
+    """
+    page = np.full((height, width, 3), 245, np.uint8)
+    page[:height // 25] = 50
+    cv2.putText(page, 'File  Edit  View  Window  Help', (width // 60, height // 35), FONT, 1.2, (230, 230, 230), 2)
+    photo = photo_page(width // 3, height // 3, seed=seed)
+    page[height // 8:height // 8 + photo.shape[0], width // 2:width // 2 + photo.shape[1]] = photo
+    words = []
+    for i, (left, top) in enumerate(((width // 12, height // 8), (width // 12, height // 2), (width // 2, height * 3 // 4))):
+        paragraph, paragraph_words = text_page(width // 3, height // 6, seed=seed + i, background=245)
+        page[top:top + paragraph.shape[0], left:left + paragraph.shape[1]] = paragraph
+        words.extend((text, left + x, top + y, w, h) for text, x, y, w, h in paragraph_words)
+    return page, words
+
+
+DOCUMENTS = {
+    # black text on white, the most common upload
+    'text': lambda: text_page(2480, 3508)[0],
+    'dark_mode': lambda: text_page(2480, 3508, background=35, color=220)[0],
+    'light_text': lambda: text_page(2480, 3508, color=175)[0],
+    'gray_paper': lambda: text_page(2480, 3508, background=200, color=100)[0],
+    # bilevel like from fax or document scanners
+    'binary_scan': lambda: cv2.threshold(text_page(2480, 3508)[0], 127, 255, cv2.THRESH_BINARY)[1],
+    'small_font': lambda: text_page(2480, 3508, font_scale=0.4)[0],
+    'large_photo': lambda: photo_page(6000, 4000),
+}
+
+
+def encode(image: np.ndarray, extension='.png') -> bytes:
+    return cv2.imencode(extension, image)[1].tobytes()
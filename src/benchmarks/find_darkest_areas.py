@@ -0,0 +1,98 @@
+"""
+Compares `find_darkest_areas` against the previous loop-based implementation and times it for multiple image sizes.
+
+Run from `src`: `python -m benchmarks.find_darkest_areas`
+"""
+import argparse
+import time
+
+import numpy as np
+
+from helpers.optimize_image import find_darkest_areas
+
+
+def find_darkest_areas_loop(image, rect=5):
+    # previous implementation, kept as reference for the results
+    if len(image.shape) == 3 and image.shape[-1] == 3:
+        height, width, _ = image.shape
+    elif len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[-1] == 1):
+        height, width = image.shape[0], image.shape[1]
+    else:
+        raise ValueError("Input image must be RGB, grayscale, or single-channel.")
+
+    min_brightness = float('inf')
+
+    for y in range(height - rect - 1):
+        for x in range(width - rect - 1):
+            if len(image.shape) == 3:
+                area = image[y:y + rect, x:x + rect, :]
+            else:
+                area = image[y:y + rect, x:x + rect]
+
+            brightness = np.mean(area) / 255.0
+            if brightness <= 0.01:
+                return brightness
+
+            if brightness < min_brightness:
+                min_brightness = brightness
+
+    return min_brightness
+
+
+def make_images(rng, height, width):
+    # bright page with some darker strokes, no near-black area, thus no early exit
+    gray = rng.integers(180, 256, size=(height, width), dtype=np.uint8)
+    gray[height // 3:height // 3 + 4, width // 4:width // 2] = rng.integers(20, 60, size=(4, width // 2 - width // 4), dtype=np.uint8)
+    # page with a black area in the lower half, thus with an early exit
+    black = gray.copy()
+    black[height // 2:height // 2 + 6, width // 2:width // 2 + 6] = 0
+    rgb = np.dstack([gray, rng.integers(150, 256, size=(height, width), dtype=np.uint8), gray])
+    return {
+        'gray': gray,
+        'gray_black': black,
+        'single_channel': gray.reshape(height, width, 1),
+        'rgb': rgb,
+    }
+
+
+def check_results(rng):
+    for height, width in ((12, 12), (7, 9), (64, 48), (150, 200)):
+        for name, image in make_images(rng, height, width).items():
+            for rect in (3, 5):
+                expected = find_darkest_areas_loop(image, rect=rect)
+                actual = find_darkest_areas(image, rect=rect)
+                if expected != actual:
+                    raise AssertionError(f'mismatch for {name} {height}x{width} rect={rect}: {expected} != {actual}')
+    print('results equal to loop-based implementation')
+
+
+def timed(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--loop-max-px', type=int, default=300 * 300, help='skip the loop-based timing above this pixel count')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    check_results(rng)
+
+    for height, width in ((300, 300), (1080, 1920), (3024, 4032)):
+        image = make_images(rng, height, width)['gray']
+        vectorized = timed(lambda: find_darkest_areas(image, rect=3), args.repeat)
+        line = f'{height}x{width}: vectorized {vectorized * 1000:.2f}ms'
+        if height * width <= args.loop_max_px:
+            loop = timed(lambda: find_darkest_areas_loop(image, rect=3), 1)
+            line += f' | loop {loop * 1000:.2f}ms'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
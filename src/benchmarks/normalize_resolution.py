@@ -0,0 +1,73 @@
+"""
+Checks the glyph height estimation on synthetic pages and times the preprocessing with and without the resolution normalization.
+
+Run from `src`: `python -m benchmarks.normalize_resolution`
+"""
+import argparse
+import random
+import time
+
+import cv2
+import numpy as np
+
+from helpers import optimize_image
+from helpers.font_find_size import estimate_glyph_height
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def make_page(font_scale: float, width: int, height: int, seed=42):
+    # lines of random words, returns the BGR page and the text height of the font in pixels
+    rng = random.Random(seed)
+    page = np.full((height, width, 3), 255, np.uint8)
+    thickness = max(1, round(font_scale * 2))
+    line_height = cv2.getTextSize('Xg', FONT, font_scale, thickness)[0][1] * 2
+    top = line_height
+    while top < height - line_height:
+        left = line_height
+        while True:
+            text = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFG') for _ in range(rng.randint(3, 9)))
+            text_width = cv2.getTextSize(text, FONT, font_scale, thickness)[0][0]
+            if left + text_width > width - line_height:
+                break
+            cv2.putText(page, text, (left, top), FONT, font_scale, (0, 0, 0), thickness)
+            left += text_width + line_height // 2
+        top += line_height
+    return page, cv2.getTextSize('x', FONT, font_scale, thickness)[0][1]
+
+
+def measure(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return min(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--optimize', action='store_true', help='with `optimize_images`')
+    args = parser.parse_args()
+
+    target = optimize_image.GLYPH_HEIGHT_TARGET or 24
+    for font_scale, width, height in ((0.3, 1240, 1754), (1, 2480, 3508), (3, 7440, 10524), (4, 9920, 14032)):
+        page, font_height = make_page(font_scale, width, height)
+        estimate_duration, glyph_height = measure(lambda: estimate_glyph_height(page), args.repeat)
+
+        optimize_image.GLYPH_HEIGHT_TARGET = target
+        normalized, (image, scale) = measure(lambda: optimize_image.optimize_image_array(page, 'page.png', args.optimize), args.repeat)
+        optimize_image.GLYPH_HEIGHT_TARGET = 0
+        original, _ = measure(lambda: optimize_image.optimize_image_array(page, 'page.png', args.optimize), args.repeat)
+        optimize_image.GLYPH_HEIGHT_TARGET = target
+
+        print(
+            f'{width}x{height} font height {font_height}px: glyph height {glyph_height}px in {estimate_duration * 1000:.1f}ms | '
+            f'scale {scale:.2f} to {image.shape[1]}x{image.shape[0]} | '
+            f'normalized {normalized * 1000:.1f}ms, original {original * 1000:.1f}ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares serializing `keep_details` results through the `OCROutputBatch` schema against the fast path of the rows and columns layouts,
+with the size of the responses uncompressed, with gzip and with zstd.
+
+Run from `src`: `python -m benchmarks.output_layout`
+"""
+import argparse
+import gzip
+import json
+import time
+
+from benchmarks.process_data import File, make_tsv
+from helpers.process_data import process_data
+from helpers.serialize import column_page, dumps, layout_pages, orjson, row_page, zstandard, COMPRESS_LEVEL_GZIP, COMPRESS_LEVEL_ZSTD
+from server import OCROutputBatch
+
+
+def measure(fn, repeat):
+    fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - start)
+    return min(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--pages', type=int, default=10)
+    args = parser.parse_args()
+
+    files = [File(f'page_{i}.png') for i in range(args.pages)]
+    schema = OCROutputBatch()
+    print(f'json: {"orjson" if orjson else "json"}, zstd: {"yes" if zstandard else "no, `zstandard` not installed"}')
+    for words in (1_000, 10_000, 100_000):
+        pages = process_data(files, make_tsv(words, pages=args.pages), keep_details=True)
+        data = {'_usages': [], 'outcome': pages}
+        if json.loads(dumps({'_usages': [], 'outcome': layout_pages(pages, 'rows')})) != schema.dump(data):
+            raise AssertionError('rows layout differs from the schema')
+        variants = {
+            'schema': lambda: json.dumps(schema.dump(data)).encode(),
+            'rows': lambda: dumps({'_usages': [], 'outcome': [row_page(page) for page in pages]}),
+            'columns': lambda: dumps({'_usages': [], 'outcome': [column_page(page) for page in pages]}),
+        }
+        for name, fn in variants.items():
+            duration, body = measure(fn, args.repeat)
+            gzip_duration, gzipped = measure(lambda: gzip.compress(body, compresslevel=COMPRESS_LEVEL_GZIP, mtime=0), args.repeat)
+            line = (
+                f'{words:7} words {name:8} | {duration * 1000:8.2f}ms {len(body) / 1024:9.1f}KiB | '
+                f'gzip {gzip_duration * 1000:7.2f}ms {len(gzipped) / 1024:8.1f}KiB'
+            )
+            if zstandard:
+                compressor = zstandard.ZstdCompressor(level=COMPRESS_LEVEL_ZSTD)
+                zstd_duration, zstd = measure(lambda: compressor.compress(body), args.repeat)
+                line += f' | zstd {zstd_duration * 1000:7.2f}ms {len(zstd) / 1024:8.1f}KiB'
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
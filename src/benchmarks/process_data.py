@@ -0,0 +1,186 @@
+"""
+Compares `process_data` against the previous two-pass implementation and times it for pages with 1k, 10k and 100k words.
+
+Run from `src`: `python -m benchmarks.process_data`
+"""
+import argparse
+import logging
+import random
+import time
+import tracemalloc
+
+from helpers.ocr_engine import TSV_HEADER
+from helpers.process_data import process_data
+
+
+class File:
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def make_tsv(words: int, pages=1, seed=42) -> str:
+    # rows like tesseract creates them: page, block, paragraph, line and word levels
+    rng = random.Random(seed)
+    rows = [TSV_HEADER]
+    words_per_page = words // pages
+    for page_num in range(1, pages + 1):
+        rows.append(f'1\t{page_num}\t0\t0\t0\t0\t0\t0\t2480\t3508\t-1\t')
+        block_num = 0
+        line_num = 0
+        word_num = 0
+        top = 0
+        left = 0
+        for i in range(words_per_page):
+            if i % 120 == 0:
+                block_num += 1
+                line_num = 0
+                rows.append(f'2\t{page_num}\t{block_num}\t0\t0\t0\t100\t{top}\t2000\t400\t-1\t')
+            if i % 12 == 0:
+                line_num += 1
+                word_num = 0
+                left = 100
+                top += 30
+                rows.append(f'4\t{page_num}\t{block_num}\t1\t{line_num}\t0\t100\t{top}\t2000\t24\t-1\t')
+            word_num += 1
+            text = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzäöü') for _ in range(rng.randint(1, 10)))
+            conf = rng.choice((0, 12.5, 55.25, 91.0, 96.5))
+            rows.append(f'5\t{page_num}\t{block_num}\t1\t{line_num}\t{word_num}\t{left}\t{top}\t{len(text) * 14}\t24\t{conf}\t{text}')
+            left += len(text) * 14 + 12
+    return '\n'.join(rows) + '\n'
+
+
+convert = {
+    'level': int,
+    'page_num': int,
+    'block_num': int,
+    'par_num': int,
+    'line_num': int,
+    'word_num': int,
+    'left': int,
+    'top': int,
+    'width': int,
+    'height': int,
+    'conf': float,
+}
+
+
+def process_data_two_pass(files, tsv, intra_block_breaks=True, keep_details=False):
+    # previous implementation, kept as reference for the results
+    columns = []
+    pages = []
+    page_data = None
+    block_data = None
+    for i, line in enumerate(tsv.split('\n')):
+        if i == 0:
+            for j, column in enumerate(line.split('\t')):
+                columns.append(column)
+            continue
+
+        row_data = {}
+        for j, value in enumerate(line.split('\t')):
+            column = columns[j]
+            if column in convert:
+                if value == '':
+                    value = None
+                else:
+                    value = convert[column](value)
+            row_data[column] = value
+
+        if 'page_num' not in row_data:
+            if 'level' in row_data and row_data['level'] is None:
+                continue
+            logging.info(f'invalid row-data {row_data}')
+            continue
+
+        if row_data['conf'] < 1:
+            continue
+        if not page_data or page_data['page'] != row_data['page_num']:
+            page_data = {
+                'page': row_data['page_num'],
+                'file': files[len(pages)].filename,
+                'blocks': [],
+            }
+            pages.append(page_data)
+            block_data = None
+        if not block_data or block_data['block'] != row_data['block_num']:
+            block_data = {
+                'block': row_data['block_num'],
+                'text': '',
+                'boxes': [],
+            }
+            page_data['blocks'].append(block_data)
+
+        block_data['boxes'].append(row_data)
+
+    for page in pages:
+        blocks_copy = page['blocks'].copy()
+        del page['blocks']
+        content = []
+        blocks = []
+        for block in blocks_copy:
+            last_box_y2 = None
+            for box in block['boxes']:
+                if intra_block_breaks and last_box_y2 and last_box_y2 < box['top']:
+                    block['text'] += '\n'
+                else:
+                    block['text'] += ' '
+                block['text'] += box['text']
+                last_box_y2 = box['top'] + box['height']
+
+            block['text'] = block['text'].strip()
+            if block['text'] == '':
+                continue
+            content.append(block['text'])
+            blocks.append(block)
+
+        if keep_details:
+            page['blocks'] = blocks
+        else:
+            page['content'] = '\n\n'.join(content)
+
+    return pages
+
+
+def measure(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(durations), peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    files = [File(f'page_{i}.png') for i in range(3)]
+    for intra_block_breaks in (True, False):
+        for keep_details in (True, False):
+            tsv = make_tsv(3000, pages=3)
+            expected = process_data_two_pass(files, tsv, intra_block_breaks, keep_details)
+            if process_data(files, tsv, intra_block_breaks, keep_details) != expected:
+                raise AssertionError(f'result differs for intra_block_breaks={intra_block_breaks} keep_details={keep_details}')
+            if process_data(files, iter(tsv.splitlines(keepends=True)), intra_block_breaks, keep_details) != expected:
+                raise AssertionError('result differs for TSV lines')
+    print('results equal to two-pass implementation')
+
+    for words in (1_000, 10_000, 100_000):
+        tsv = make_tsv(words)
+        for keep_details in (True, False):
+            single, single_peak = measure(lambda: process_data(files, tsv, keep_details=keep_details), args.repeat)
+            two_pass, two_pass_peak = measure(lambda: process_data_two_pass(files, tsv, keep_details=keep_details), args.repeat)
+            print(
+                f'{words} words keep_details={keep_details}: '
+                f'single-pass {single * 1000:.2f}ms / {single_peak / 1024 / 1024:.2f}MiB | '
+                f'two-pass {two_pass * 1000:.2f}ms / {two_pass_peak / 1024 / 1024:.2f}MiB'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures in fresh processes how long importing the app and the first requests take, and which imports are the slowest.
+
+Run from `src`: `python -m benchmarks.startup`
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, time
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+client = server.app.test_client()
+client.get('/info')
+first = time.perf_counter()
+client.get('/info')
+second = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_info': first - imported, 'cached_info': second - first}))
+'''
+
+
+def measure_startup(importtime=False) -> Tuple[Dict[str, float], str]:
+    """
+    Durations in seconds of a fresh process, with `importtime` also the `-X importtime` report.
+    """
+    args = [sys.executable, *(['-X', 'importtime'] if importtime else []), '-c', CHILD]
+    proc = subprocess.run(args, cwd=SRC_DIR, capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr
+
+
+def slowest_imports(report: str, count: int) -> List[Tuple[int, str]]:
+    # cumulative microseconds per top level package, wherever it was first imported, except the app itself
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if cumulative.strip().isdigit() and '.' not in name and name != 'server':
+            imports.append((int(cumulative), name))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    args = parser.parse_args()
+
+    # the first run also fills the bytecode and OS file caches
+    measure_startup()
+    runs = [measure_startup()[0] for _ in range(args.repeat)]
+    for name in ('import', 'first_info', 'cached_info'):
+        print(f'{name:12} min {min(run[name] for run in runs) * 1000:8.1f}ms max {max(run[name] for run in runs) * 1000:8.1f}ms')
+
+    _, report = measure_startup(importtime=True)
+    print('slowest imports:')
+    for cumulative, name in slowest_imports(report, args.top):
+        print(f'  {cumulative / 1000:8.1f}ms {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Times the preprocessing and parsing hot paths on synthetic documents and compares them to a stored baseline.
+
+Run from `src`:
+
+- `python -m benchmarks.suite --save` stores the results as baseline
+- `python -m benchmarks.suite` fails when a case is slower than the baseline by more than `--threshold`
+- `python -m benchmarks.suite --filter optimize_image` only runs matching cases
+
+Baselines only compare on the same machine, thus `benchmarks/baseline.json` isn't committed.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+import cv2
+from werkzeug.datastructures import FileStorage
+
+from benchmarks.documents import DOCUMENTS, encode
+from benchmarks.process_data import File, make_tsv
+from benchmarks.startup import measure_startup
+from helpers import usages
+from helpers.optimize_image import find_darkest_areas, optimize_image_array, PREPROCESS_VERSION
+from helpers.prepare_files import prepare_files
+from helpers.process_data import process_data
+from helpers.serialize import column_page, dumps, row_page
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class Case:
+    def __init__(self, name: str, fn: Callable, info: Callable[[], Dict] = None):
+        self.name = name
+        self.fn = fn
+        # details of a run, e.g. the binarization branch
+        self.info = info
+
+
+def measure(fn: Callable, repeat: int) -> Dict:
+    # the first run warms up caches and pools and isn't counted
+    fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return {'min': min(durations), 'median': statistics.median(durations)}
+
+
+def branch_of(image, optimize: bool) -> Callable[[], Dict]:
+    def info():
+        stages = usages.start()
+        try:
+            optimize_image_array(image, 'page.png', optimize)
+        finally:
+            usages.stop()
+        return {'branch': next(stage['branch'] for stage in stages if stage['stage'] == 'binarize')}
+    return info
+
+
+def files_of(data: List[bytes]) -> List[FileStorage]:
+    return [FileStorage(stream=io.BytesIO(content), filename=f'page_{i}.png') for i, content in enumerate(data)]
+
+
+def run_prepare_files(data: List[bytes]):
+    paths, list_path, _, _, _ = prepare_files(files_of(data), optimize=True)
+    for path in paths:
+        os.unlink(path)
+    if list_path not in paths:
+        os.unlink(list_path)
+
+
+def tesseract_case(image) -> Case:
+    from helpers.ocr import default_options, ocr_files
+
+    data = encode(image)
+    options = {**default_options, 'lang': 'eng'}
+    return Case('tesseract[text]', lambda: ocr_files(files_of([data]), options))
+
+
+def build_cases(with_tesseract: bool) -> List[Case]:
+    images = {name: make() for name, make in DOCUMENTS.items()}
+    cases = []
+    for name, image in images.items():
+        cases.append(Case(f'optimize_image[{name}]', lambda image=image: optimize_image_array(image, 'page.png', True), branch_of(image, True)))
+    cases.append(Case('optimize_image[text,no-optimize]', lambda: optimize_image_array(images['text'], 'page.png', False), branch_of(images['text'], False)))
+
+    gray = cv2.cvtColor(images['text'], cv2.COLOR_BGR2GRAY)
+    cases.append(Case('find_darkest_areas[text]', lambda: find_darkest_areas(gray, rect=3)))
+
+    batch = [encode(images[name]) for name in ('text', 'dark_mode', 'light_text', 'gray_paper', 'small_font')]
+    cases.append(Case('prepare_files[5 pages]', lambda: run_prepare_files(batch)))
+
+    tsv = make_tsv(10_000, pages=5)
+    files = [File(f'page_{i}.png') for i in range(5)]
+    cases.append(Case('process_data[10k words]', lambda: process_data(files, tsv)))
+    cases.append(Case('process_data[10k words,details]', lambda: process_data(files, tsv, keep_details=True)))
+    pages = process_data(files, tsv, keep_details=True)
+    cases.append(Case('serialize[10k words,rows]', lambda: dumps([row_page(page) for page in pages])))
+    cases.append(Case('serialize[10k words,columns]', lambda: dumps([column_page(page) for page in pages])))
+
+    if with_tesseract:
+        cases.append(tesseract_case(images['text']))
+    # a fresh process importing the app and answering `/info` twice
+    cases.append(Case('startup[import,/info]', measure_startup))
+    return cases
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        before = baseline['cases'][name]['min']
+        ratio = result['min'] / before if before else 1.0
+        result['baseline_ratio'] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append(f'{name}: {before * 1000:.2f}ms -> {result["min"] * 1000:.2f}ms ({ratio:.2f}x)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='only cases containing this')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='store the results as baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline, `0.2` for 20%%')
+    parser.add_argument('--output', help='also store the results to this JSON file')
+    args = parser.parse_args()
+
+    with_tesseract = shutil.which(os.environ.get('TESSERACT_CMD', 'tesseract')) is not None
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'cores': os.cpu_count(),
+            'preprocess_version': PREPROCESS_VERSION,
+        },
+        'cases': {},
+    }
+    for case in build_cases(with_tesseract):
+        if args.filter not in case.name:
+            continue
+        result = measure(case.fn, args.repeat)
+        if case.info:
+            result.update(case.info())
+        results['cases'][case.name] = result
+        details = ' '.join(f'{key}={value}' for key, value in result.items() if key not in ('min', 'median'))
+        print(f'{case.name:40} min {result["min"] * 1000:9.2f}ms median {result["median"] * 1000:9.2f}ms {details}')
+    if not with_tesseract:
+        print('tesseract not found, skipped the end to end case')
+
+    failed = False
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'stored baseline {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            failed = True
+            print(f'regressions beyond {args.threshold:.0%}:')
+            for regression in regressions:
+                print(f'  {regression}')
+        else:
+            print(f'no regressions beyond {args.threshold:.0%} against {args.baseline}')
+    else:
+        print(f'no baseline at {args.baseline}, store one with `--save`')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
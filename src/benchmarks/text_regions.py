@@ -0,0 +1,73 @@
+"""
+Compares OCR of only the detected text regions against the whole page, for a screenshot-like page with wide margins and a photo.
+
+Before timing, the mapping of the boxes is checked with simulated recognition, where each region returns the words it fully contains,
+all words must be found exactly once at their position on the page.
+
+Run from `src`: `python -m benchmarks.text_regions --width 3840 --height 2160`
+"""
+import argparse
+import time
+
+import cv2
+from PIL import Image
+
+from benchmarks.documents import screenshot_page
+from benchmarks.tiling import merged_words, word_accuracy
+from helpers.ocr_engine import get_engine, TSV_HEADER
+from helpers.text_regions import find_text_regions, image_to_data_regions, merge_regions
+
+
+def simulate_tsv(words, region):
+    rows = [TSV_HEADER, f'1\t1\t0\t0\t0\t0\t0\t0\t{region.right - region.left}\t{region.bottom - region.top}\t-1\t']
+    for i, (text, left, top, w, h) in enumerate(words):
+        if left >= region.left and top >= region.top and left + w <= region.right and top + h <= region.bottom:
+            rows.append(f'5\t1\t1\t1\t1\t{i}\t{left - region.left}\t{top - region.top}\t{w}\t{h}\t95.0\t{text}')
+    return '\n'.join(rows) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=3840)
+    parser.add_argument('--height', type=int, default=2160)
+    parser.add_argument('--lang', default='eng')
+    parser.add_argument('--skip-engine', action='store_true', help='only check the detection and mapping')
+    args = parser.parse_args()
+
+    page, words = screenshot_page(args.width, args.height)
+    gray = cv2.cvtColor(page, cv2.COLOR_BGR2GRAY)
+
+    start = time.perf_counter()
+    regions = find_text_regions(gray)
+    detect_duration = time.perf_counter() - start
+    coverage = sum((region.right - region.left) * (region.bottom - region.top) for region in regions) / gray.size
+
+    merged = merge_regions(regions, [simulate_tsv(words, region) for region in regions], args.width, args.height)
+    expected = sorted((text, left, top) for text, left, top, *_ in words)
+    found = sorted((cells[11], int(cells[6]), int(cells[7])) for cells in (line.split('\t') for line in merged.split('\n')[1:]) if cells[0] == '5')
+    if found != expected:
+        raise AssertionError(f'{len(found)} of {len(expected)} words at their position')
+    print(f'{len(regions)} regions covering {coverage:.1%} of the page detected in {detect_duration * 1000:.1f}ms, all {len(expected)} words at their position')
+    if args.skip_engine:
+        return
+
+    image = Image.fromarray(gray, mode='L')
+    image.format = 'PNG'
+    engine = get_engine()
+    expected = [text for text, *_ in words]
+
+    start = time.perf_counter()
+    single = engine.image_to_data([image], args.lang, [])
+    single_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cropped = image_to_data_regions(image, find_text_regions(gray), args.lang, [])
+    cropped_duration = time.perf_counter() - start
+
+    print(f'{args.width}x{args.height} with {len(expected)} words, engine {engine.name}')
+    print(f'whole page {single_duration:.2f}s accuracy {word_accuracy(expected, merged_words(single)):.4f}')
+    print(f'regions    {cropped_duration:.2f}s accuracy {word_accuracy(expected, merged_words(cropped)):.4f} ({len(regions)} regions)')
+
+
+if __name__ == '__main__':
+    main()
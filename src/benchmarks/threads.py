@@ -0,0 +1,86 @@
+"""
+Throughput and latency of concurrent tesseract calls, with the thread budget of the scheduler against fixed thread counts.
+
+Run from `src`: `python -m benchmarks.threads`, requires tesseract
+"""
+import argparse
+import shutil
+import statistics
+import threading
+import time
+from typing import Callable, List, Optional
+
+from PIL import Image
+
+from benchmarks.documents import text_page
+from helpers.ocr_engine import PytesseractEngine
+from helpers.scheduler import CPUS, OCR_MAX_THREADS, thread_budget
+
+
+def run_concurrent(call: Callable, concurrency: int, calls: int) -> List[float]:
+    # `calls` in total from `concurrency` threads, returns the duration of each call
+    durations = []
+    lock = threading.Lock()
+    remaining = [calls]
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            call()
+            with lock:
+                durations.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=16, help='calls per concurrency level')
+    parser.add_argument('--concurrency', default=f'1,2,4,{CPUS * 2}', help='comma separated levels')
+    parser.add_argument('--lang', default='eng')
+    args = parser.parse_args()
+
+    if not shutil.which('tesseract'):
+        print('tesseract not found')
+        return
+
+    page, _ = text_page(1240, 1754, font_scale=0.6)
+    image = Image.fromarray(page[:, :, 0], mode='L')
+    image.format = 'PNG'
+    engine = PytesseractEngine()
+    modes = {
+        'budget': None,
+        'single': 1,
+        f'fixed {OCR_MAX_THREADS}': OCR_MAX_THREADS,
+    }
+    print(f'{CPUS} CPUs, {args.calls} calls per level')
+    for concurrency in sorted({int(level) for level in args.concurrency.split(',')}):
+        for mode, fixed in modes.items():
+            def call(fixed: Optional[int] = fixed):
+                if fixed is None:
+                    engine.image_to_data([image], args.lang, [])
+                    return
+                with thread_budget(fixed):
+                    engine.image_to_data([image], args.lang, [])
+
+            start = time.perf_counter()
+            durations = run_concurrent(call, concurrency, args.calls)
+            total = time.perf_counter() - start
+            p95 = sorted(durations)[max(0, round(len(durations) * 0.95) - 1)]
+            print(
+                f'concurrency {concurrency:3} {mode:10} | {args.calls / total:6.2f} pages/s | '
+                f'latency median {statistics.median(durations) * 1000:8.1f}ms p95 {p95 * 1000:8.1f}ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Compares tiled OCR against the single-pass OCR of a large synthetic page, for latency and word accuracy.
+
+Before timing, the box merging is checked with simulated recognition, where each tile returns the words it fully contains.
+
+Run from `src`: `python -m benchmarks.tiling --width 7000 --height 5000`
+"""
+import argparse
+import random
+import time
+from collections import Counter
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from helpers.ocr_engine import get_engine, TSV_HEADER
+from helpers.tiling import merge_tiles, split_tiles, image_to_data_tiled
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def make_page(width: int, height: int, seed=42):
+    # lines of random words, returns the grayscale page and the word boxes `(text, left, top, width, height)`
+    rng = random.Random(seed)
+    page = np.full((height, width), 255, np.uint8)
+    words = []
+    top = 60
+    while top + 40 < height:
+        left = 40
+        while True:
+            text = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+            (w, h), baseline = cv2.getTextSize(text, FONT, 1.2, 2)
+            if left + w + 40 > width:
+                break
+            cv2.putText(page, text, (left, top + h), FONT, 1.2, 0, 2)
+            words.append((text, left, top, w, h + baseline))
+            left += w + rng.randint(25, 60)
+        top += rng.randint(55, 90)
+    return page, words
+
+
+def simulate_tsv(words, tile):
+    # the words the tile contains completely are recognized, cut words only with their visible part
+    rows = [TSV_HEADER]
+    for i, (text, left, top, w, h) in enumerate(words):
+        x0, y0 = max(left, tile.left), max(top, tile.top)
+        x1, y1 = min(left + w, tile.right), min(top + h, tile.bottom)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        visible = text if (x0, y0, x1, y1) == (left, top, left + w, top + h) else text[:max(1, len(text) * (x1 - x0) // w)]
+        rows.append(f'5\t1\t1\t1\t1\t{i}\t{x0 - tile.left}\t{y0 - tile.top}\t{x1 - x0}\t{y1 - y0}\t95.0\t{visible}')
+    return '\n'.join(rows) + '\n'
+
+
+def merged_words(tsv: str):
+    return [line.split('\t')[11] for line in tsv.split('\n')[1:] if line.startswith('5\t')]
+
+
+def word_accuracy(expected, recognized) -> float:
+    found = sum((Counter(expected) & Counter(recognized)).values())
+    return found / max(1, len(expected))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=7000)
+    parser.add_argument('--height', type=int, default=5000)
+    parser.add_argument('--lang', default='eng')
+    parser.add_argument('--skip-engine', action='store_true', help='only check the merging')
+    args = parser.parse_args()
+
+    page, words = make_page(args.width, args.height)
+    expected = [text for text, *_ in words]
+
+    tiles = split_tiles(page)
+    merged = merge_tiles(tiles, [simulate_tsv(words, tile) for tile in tiles], args.width, args.height)
+    if sorted(merged_words(merged)) != sorted(expected):
+        raise AssertionError(f'merged words differ, accuracy {word_accuracy(expected, merged_words(merged)):.4f}')
+    print(f'merging of {len(tiles)} tiles keeps all {len(expected)} words without duplicates')
+    if args.skip_engine:
+        return
+
+    image = Image.fromarray(page, mode='L')
+    image.format = 'PNG'
+    engine = get_engine()
+
+    start = time.perf_counter()
+    single = engine.image_to_data([image], args.lang, [])
+    single_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tiled = image_to_data_tiled(image, args.lang, [])
+    tiled_duration = time.perf_counter() - start
+
+    print(f'{args.width}x{args.height} with {len(expected)} words, engine {engine.name}')
+    print(f'single-pass {single_duration:.2f}s accuracy {word_accuracy(expected, merged_words(single)):.4f}')
+    print(f'tiled       {tiled_duration:.2f}s accuracy {word_accuracy(expected, merged_words(tiled)):.4f} ({len(tiles)} tiles)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+OCR for large batches of files without the HTTP API, in a pool of processes which each run the same pipeline as `/ocr`.
+
+Run from `src`:
+
+- `python -m bulk /data/scans --output results.jsonl` for all images and documents in a directory
+- `python -m bulk manifest.jsonl --output results.jsonl`, one `{"path": ..., "id": ..., "options": {...}}` per line,
+  `id` and `options` are optional and relative paths are relative to the manifest
+- `python -m bulk /data/scans --pdf-dir /data/pdfs` for searchable PDFs like `/ocr-to-pdf`
+
+Each finished file is recorded in the checkpoint, a stopped run continues with the remaining files when started again.
+Failed files are logged with their error and not tried again, unless with `--retry-failed`.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set
+
+from werkzeug.datastructures import FileStorage
+
+from helpers import deadline
+from helpers.input_pages import INPUT_EXTENSIONS
+from helpers.ocr import default_options_pdf, ocr_to_pdf, OptionError, parse_options, process_request
+from helpers.scheduler import CPUS
+from helpers.serialize import dumps, layout_pages, LAYOUT_ROWS
+
+PROGRESS_SECONDS = 10
+
+
+class Task(NamedTuple):
+    # identifies the file in the results, the checkpoint and the error log
+    key: str
+    path: str
+    options: Dict
+
+
+def walk_directory(directory: str) -> Iterator[Task]:
+    for root, dirs, names in os.walk(directory):
+        # sorted, so the order is the same when resuming
+        dirs.sort()
+        for name in sorted(names):
+            if Path(name).suffix.lower() in INPUT_EXTENSIONS:
+                path = os.path.join(root, name)
+                yield Task(os.path.relpath(path, directory), path, {})
+
+
+def read_manifest(manifest: str) -> Iterator[Task]:
+    base = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as file:
+        for line_num, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                path = entry['path']
+            except (ValueError, KeyError, TypeError):
+                raise ValueError(f'{manifest}:{line_num} is no JSON object with a `path`')
+            yield Task(str(entry.get('id', path)), os.path.join(base, path), entry.get('options') or {})
+
+
+class Checkpoint:
+    """
+    The finished files, one JSON line each: `{"key": ..., "status": "done" | "failed", "offset": ...}`.
+
+    `offset` is the size of the results file after the result of the file was written,
+    results written after the last checkpoint are truncated when resuming, so no file is in the results twice.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Set[str] = set()
+        self.failed: Set[str] = set()
+        self.offset = 0
+        if os.path.exists(path):
+            with open(path, 'r+b') as file:
+                content = file.read()
+                # without the last line of an interrupted write
+                file.truncate(content.rfind(b'\n') + 1)
+            for line in content.splitlines()[:content.count(b'\n')]:
+                entry = json.loads(line)
+                (self.done if entry['status'] == 'done' else self.failed).add(entry['key'])
+                if entry.get('offset') is not None:
+                    self.offset = entry['offset']
+        self.file = open(path, 'a')
+
+    def is_finished(self, key: str, retry_failed=False) -> bool:
+        return key in self.done or (key in self.failed and not retry_failed)
+
+    def add(self, key: str, status: str, offset: Optional[int] = None):
+        self.file.write(json.dumps({'key': key, 'status': status, 'offset': offset}) + '\n')
+        self.file.flush()
+        (self.done if status == 'done' else self.failed).add(key)
+        if status == 'done':
+            self.failed.discard(key)
+
+    def close(self):
+        self.file.close()
+
+
+def init_worker():
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    # Ctrl+C only reaches the main process, which lets the running files finish, instead of failing them in tesseract
+    os.setsid()
+
+
+def process_file(task: Task, options: Dict, pdf_path: Optional[str]) -> Dict:
+    """
+    Runs in the pool, returns the pages, or writes the PDF to `pdf_path`.
+    """
+    start = time.perf_counter()
+    options = parse_options(json.dumps({**options, **task.options}), pdf=bool(pdf_path))
+    # only with the `deadline` option, per file
+    with deadline.within(options.get('deadline')), open(task.path, 'rb') as stream:
+        file = FileStorage(stream=stream, filename=os.path.basename(task.path))
+        if pdf_path:
+            pdf = ocr_to_pdf(file, {**default_options_pdf, **options})
+            os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+            # complete or not at all, when the run is stopped while writing
+            with open(f'{pdf_path}.part', 'wb') as pdf_file:
+                pdf_file.write(pdf)
+            os.replace(f'{pdf_path}.part', pdf_path)
+            return {'key': task.key, 'pdf': pdf_path, 'ms': round((time.perf_counter() - start) * 1000)}
+        pages = process_request([file], options)
+    return {
+        'key': task.key,
+        'file': task.path,
+        'pages': layout_pages(pages, options.get('layout') or LAYOUT_ROWS),
+        'ms': round((time.perf_counter() - start) * 1000),
+    }
+
+
+def run_file(task: Task, options: Dict, pdf_path: Optional[str]) -> Dict:
+    # errors are returned instead of raised, as not every exception can be pickled
+    try:
+        return process_file(task, options, pdf_path)
+    except Exception as e:
+        return {'key': task.key, 'error': str(e) or type(e).__name__, 'type': type(e).__name__, 'traceback': traceback.format_exc()}
+
+
+def pdf_path_of(pdf_dir: str, key: str) -> str:
+    return os.path.join(pdf_dir, f'{os.path.splitext(key)[0]}.pdf')
+
+
+class Progress:
+    def __init__(self, total: int, with_pages: bool):
+        self.total = total
+        # the pages of PDFs aren't known
+        self.with_pages = with_pages
+        self.files = 0
+        self.pages = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self.reported = self.start
+
+    def add(self, result: Dict):
+        self.files += 1
+        self.pages += len(result.get('pages') or [])
+        self.failed += 1 if 'error' in result else 0
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.reported < PROGRESS_SECONDS:
+            return
+        self.reported = now
+        elapsed = max(now - self.start, 1e-6)
+        rate = self.files / elapsed
+        eta = (self.total - self.files) / rate if rate else None
+        logging.info(
+            f'{self.files}/{self.total} files, {self.failed} failed | {rate:.2f} files/s'
+            + (f', {self.pages / elapsed:.2f} pages/s' if self.with_pages else '')
+            + f' | elapsed {format_duration(elapsed)}, eta {format_duration(eta) if eta is not None else "-"}'
+        )
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+
+def run(tasks: List[Task], options: Dict, workers: int, checkpoint: Checkpoint, output: Optional[str], pdf_dir: Optional[str], error_log: str) -> Progress:
+    if output:
+        # results without a checkpoint are from an interrupted run and are processed again
+        with open(output, 'a+b') as file:
+            file.truncate(checkpoint.offset)
+    results = open(output, 'ab') if output else None
+    errors = open(error_log, 'a')
+    progress = Progress(len(tasks), with_pages=bool(output))
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker)
+    waiting = iter(tasks)
+    running = set()
+    stopping = threading.Event()
+    stopped_at = []
+
+    def on_stop(signal_number, frame):
+        if stopping.is_set():
+            # a signal to the process and its group, like from `timeout`, arrives twice
+            if time.monotonic() - stopped_at[0] > 1:
+                raise KeyboardInterrupt
+            return
+        logging.info('stopping after the running files, stop again to cancel them')
+        stopped_at.append(time.monotonic())
+        stopping.set()
+        for future in running:
+            # only those which haven't started yet
+            future.cancel()
+
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGTERM, on_stop)
+    try:
+        while True:
+            # a few more than the workers, so none waits for the next file, but not all files at once
+            for task in waiting if not stopping.is_set() else ():
+                running.add(pool.submit(run_file, task, options, pdf_path_of(pdf_dir, task.key) if pdf_dir else None))
+                if len(running) >= workers * 2:
+                    break
+            if not running:
+                break
+            done, running = wait(running, timeout=PROGRESS_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                result = future.result()
+                if 'error' in result:
+                    errors.write(json.dumps({'key': result['key'], 'error': result['error'], 'type': result['type'], 'traceback': result['traceback']}) + '\n')
+                    errors.flush()
+                    checkpoint.add(result['key'], 'failed')
+                    logging.warning(f'failed {result["key"]}: {result["error"]}')
+                elif results:
+                    results.write(dumps(result) + b'\n')
+                    results.flush()
+                    checkpoint.add(result['key'], 'done', results.tell())
+                else:
+                    checkpoint.add(result['key'], 'done')
+                progress.add(result)
+            progress.report()
+    except KeyboardInterrupt:
+        for process in multiprocessing.active_children():
+            process.terminate()
+        raise
+    finally:
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        pool.shutdown(wait=True, cancel_futures=True)
+        if results:
+            results.close()
+        errors.close()
+    progress.report(force=True)
+    if stopping.is_set():
+        raise KeyboardInterrupt
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR for all files of a directory or manifest.')
+    parser.add_argument('source', help='directory with images and documents, or a JSONL manifest')
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--output', help='JSONL file with one line per file: `key`, `file`, `pages` and `ms`')
+    output.add_argument('--pdf-dir', help='directory for a searchable PDF per file, with the directory structure of the source')
+    parser.add_argument('--options', default='{}', help='JSON options like for `/ocr`, a manifest entry overwrites them')
+    parser.add_argument('--workers', type=int, default=CPUS, help='processes, defaults to the CPUs')
+    parser.add_argument('--checkpoint', help='defaults to the output with `.checkpoint`')
+    parser.add_argument('--errors', help='JSONL log of the failed files, defaults to the output with `.errors.jsonl`')
+    parser.add_argument('--retry-failed', action='store_true', help='processes the failed files of a previous run again')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    # the processes share the CPUs like gunicorn workers, the files of each are processed one after another
+    os.environ['GUN_W'] = str(args.workers)
+    os.environ.setdefault('PREPROCESS_WORKERS', '0')
+
+    base = args.output or os.path.join(args.pdf_dir, 'bulk')
+    if args.pdf_dir:
+        os.makedirs(args.pdf_dir, exist_ok=True)
+    try:
+        # fails early instead of for every file
+        parse_options(args.options, pdf=bool(args.pdf_dir))
+    except (OptionError, ValueError) as e:
+        parser.error(f'invalid --options: {e}')
+    options = json.loads(args.options)
+
+    checkpoint = Checkpoint(args.checkpoint or f'{base}.checkpoint')
+    try:
+        tasks = list(read_manifest(args.source) if os.path.isfile(args.source) else walk_directory(args.source))
+        remaining = [task for task in tasks if not checkpoint.is_finished(task.key, args.retry_failed)]
+        logging.info(f'{len(tasks)} files, {len(tasks) - len(remaining)} already finished, {args.workers} workers')
+        progress = run(remaining, options, max(1, args.workers), checkpoint, args.output, args.pdf_dir, args.errors or f'{base}.errors.jsonl')
+    except KeyboardInterrupt:
+        logging.info('stopped, continues with the remaining files when started again')
+        sys.exit(130)
+    finally:
+        checkpoint.close()
+    if progress.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Read by gunicorn from the working directory `src`, arguments like `-w` take precedence.
+"""
+import os
+
+# imports the app with cv2 and numpy once in the master, the forked workers share those pages copy-on-write
+preload_app = os.environ.get('GUN_PRELOAD', '1') != '0'
+# seconds a worker may not respond before it is killed, above `OCR_DEADLINE_SECONDS` so slow requests fail with a 504 first
+timeout = int(os.environ.get('GUN_TIMEOUT', '30'))
+
+
+def when_ready(server):
+    # probed once for all workers, instead of starting `tesseract` in each of them
+    if preload_app:
+        from helpers.ocr_engine import get_engine_info
+        get_engine_info()
+
+
+def child_exit(server, worker):
+    # the live gauges of ended or recycled workers aren't reported by `/metrics` anymore, their counters and histograms are kept
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,87 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, NamedTuple, Optional
+
+# seconds a request may take, `0` for unlimited; below the gunicorn `timeout`, so a slow request fails alone instead of its worker being killed
+OCR_DEADLINE_SECONDS = float(os.environ.get('OCR_DEADLINE_SECONDS', '25'))
+
+
+class Deadline(NamedTuple):
+    # `time.monotonic()`, the clock is the same in the processes of the preprocess pool
+    at: float
+    seconds: float
+
+
+# the deadline of the current request or job, copied into the tile threads and handed to the preprocess pool
+_deadline: ContextVar[Optional[Deadline]] = ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """
+    The deadline passed while `stage` was running or before it started.
+    """
+
+    def __init__(self, stage: str, seconds: Optional[float] = None):
+        # as args, so it can be pickled from the preprocess pool
+        super().__init__(stage, seconds)
+        self.stage = stage
+        self.seconds = seconds
+
+    def __str__(self):
+        return f'Deadline of {self.seconds:g}s exceeded in stage `{self.stage}`' if self.seconds else f'Deadline exceeded in stage `{self.stage}`'
+
+
+def request_seconds(options: Dict) -> Optional[float]:
+    # the option can only shorten the deadline of the server
+    seconds = [float(value) for value in (options.get('deadline'), OCR_DEADLINE_SECONDS) if value]
+    return min(seconds) if seconds else None
+
+
+@contextmanager
+def within(seconds: Optional[float]) -> Iterator[Optional[Deadline]]:
+    """
+    Sets the deadline of the current context `seconds` from now, `None` keeps the current one; a nested deadline can only shorten it.
+    """
+    current = _deadline.get()
+    if seconds:
+        at = time.monotonic() + seconds
+        if current is None or at < current.at:
+            current = Deadline(at, seconds)
+    with restore(current):
+        yield current
+
+
+@contextmanager
+def restore(value: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    # e.g. in a process of the pool, with the deadline of the request
+    token = _deadline.set(value)
+    try:
+        yield value
+    finally:
+        _deadline.reset(token)
+
+
+def current() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """
+    Seconds until the deadline, `None` without one.
+    """
+    value = _deadline.get()
+    return None if value is None else value.at - time.monotonic()
+
+
+def check(stage: str):
+    # before starting the next stage or step
+    value = _deadline.get()
+    if value is not None and time.monotonic() >= value.at:
+        raise DeadlineExceeded(stage, value.seconds)
+
+
+def exceeded(stage: str) -> DeadlineExceeded:
+    value = _deadline.get()
+    return DeadlineExceeded(stage, value.seconds if value else None)
@@ -0,0 +1,163 @@
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from helpers.font_find_size import estimate_glyph_height
+from helpers.ocr_engine import get_engine
+from helpers.optimize_image import GLYPH_HEIGHT_TARGET
+from helpers.usages import Stage
+
+AUTO_LANG = 'auto'
+# languages `lang: auto` chooses from
+AUTO_LANG_CANDIDATES = os.environ.get('AUTO_LANG_CANDIDATES', os.environ.get('DEFAULT_LANG', 'eng+deu'))
+# recognized words the crop needs for a decision, pages with less are recognized with all candidates
+AUTO_LANG_MIN_WORDS = int(os.environ.get('AUTO_LANG_MIN_WORDS', '12'))
+# max. size of the crop used for detecting the language, at letters of about `GLYPH_HEIGHT_TARGET`
+CROP_WIDTH = 2000
+CROP_MIN_HEIGHT = 300
+
+# frequent short words and letters which are rare in the other languages,
+# languages without a profile can't be ruled out and are always kept
+LANG_PROFILES: Dict[str, Tuple[set, str]] = {
+    'eng': ({
+        'the', 'and', 'of', 'to', 'in', 'is', 'that', 'for', 'it', 'with', 'as', 'was', 'on', 'are', 'be',
+        'this', 'by', 'from', 'or', 'at', 'not', 'have', 'an', 'which', 'you', 'we', 'will', 'can', 'has',
+    }, ''),
+    'deu': ({
+        'der', 'die', 'und', 'in', 'den', 'von', 'zu', 'das', 'mit', 'sich', 'des', 'auf', 'für', 'ist', 'im',
+        'dem', 'nicht', 'ein', 'eine', 'als', 'auch', 'es', 'werden', 'aus', 'er', 'hat', 'dass', 'sie', 'nach',
+        'wird', 'bei', 'oder', 'wir', 'ich', 'sind', 'zur', 'zum', 'über', 'einer', 'wie', 'nur',
+    }, 'äöüß'),
+    'fra': ({
+        'le', 'la', 'les', 'de', 'des', 'et', 'un', 'une', 'du', 'en', 'est', 'que', 'qui', 'dans', 'pour',
+        'pas', 'sur', 'au', 'avec', 'ce', 'il', 'par', 'sont', 'nous', 'vous', 'aux',
+    }, 'éèêàçœù'),
+    'spa': ({
+        'el', 'la', 'de', 'que', 'y', 'en', 'los', 'del', 'se', 'las', 'por', 'un', 'para', 'con', 'una',
+        'su', 'al', 'es', 'lo', 'como', 'más', 'pero', 'sus',
+    }, 'ñ¿¡áíóú'),
+    'ita': ({
+        'il', 'di', 'che', 'la', 'e', 'un', 'per', 'non', 'una', 'del', 'della', 'con', 'sono', 'gli', 'le',
+        'si', 'da', 'nel', 'anche', 'alla', 'questo',
+    }, 'àèìòù'),
+    'nld': ({
+        'de', 'het', 'een', 'van', 'en', 'in', 'is', 'dat', 'op', 'te', 'zijn', 'voor', 'met', 'niet', 'die',
+        'aan', 'er', 'ook', 'als', 'bij', 'wordt', 'naar',
+    }, ''),
+    'por': ({
+        'de', 'a', 'o', 'que', 'e', 'do', 'da', 'em', 'um', 'para', 'com', 'não', 'uma', 'os', 'no', 'se',
+        'na', 'por', 'mais', 'as', 'dos', 'ao',
+    }, 'ãõçâêô'),
+}
+
+
+def candidates_of(lang: str) -> str:
+    return AUTO_LANG_CANDIDATES if lang == AUTO_LANG else lang
+
+
+def join_langs(langs: List[str]) -> str:
+    # the union, in the order of the candidates
+    models = {model for lang in langs for model in lang.split('+')}
+    ordered = [model for model in AUTO_LANG_CANDIDATES.split('+') if model in models]
+    return '+'.join(ordered + sorted(models - set(ordered)))
+
+
+def text_crop(image: Image.Image) -> Image.Image:
+    """
+    The band of the page with the most ink, enough lines for a decision but only a fraction of the page.
+
+    Pages with large letters are cropped proportionally larger and scaled down to letters of about `GLYPH_HEIGHT_TARGET`,
+    `info['scale']` of the crop is the applied scale.
+    """
+    array = np.asarray(image.convert('L') if image.mode != 'L' else image)
+    height, width = array.shape
+    glyph_height = estimate_glyph_height(array) if GLYPH_HEIGHT_TARGET else None
+    scale = GLYPH_HEIGHT_TARGET / glyph_height if glyph_height and glyph_height > GLYPH_HEIGHT_TARGET * 1.5 else 1.0
+    crop_width = round(CROP_WIDTH / scale)
+    crop_height = min(height, max(round(CROP_MIN_HEIGHT / scale), height // 8))
+    rows = np.cumsum((array < 128).sum(axis=1, dtype=np.int64))
+    window = rows[crop_height - 1:] - np.concatenate(([0], rows[:-crop_height]))
+    top = int(np.argmax(window))
+    left = 0
+    if width > crop_width:
+        columns = (array[top:top + crop_height] < 128).sum(axis=0)
+        center = int(np.average(np.arange(width), weights=columns)) if columns.any() else width // 2
+        left = min(max(0, center - crop_width // 2), width - crop_width)
+    if scale == 1.0:
+        crop = image.crop((left, top, left + min(width, crop_width), top + crop_height))
+    else:
+        band = array[top:top + crop_height, left:left + min(width, crop_width)]
+        size = (max(1, round(band.shape[1] * scale)), max(1, round(band.shape[0] * scale)))
+        crop = Image.fromarray(cv2.resize(band, size, interpolation=cv2.INTER_AREA))
+    crop.format = image.format
+    crop.info['scale'] = scale
+    return crop
+
+
+def classify(words: List[str], candidates: List[str]) -> Tuple[Optional[List[str]], Dict[str, float]]:
+    """
+    Scores the candidates by their frequent words and letters, returns the languages needed or `None` if unsure.
+    """
+    profiled = [lang for lang in candidates if lang in LANG_PROFILES]
+    words = [word.lower().strip('.,;:!?()[]"\'') for word in words]
+    words = [word for word in words if word]
+    scores = {}
+    for lang in profiled:
+        common, letters = LANG_PROFILES[lang]
+        hits = sum(1 for word in words if word in common) + 2 * sum(1 for word in words if letters and any(letter in word for letter in letters))
+        scores[lang] = round(hits / len(words), 3) if words else 0.0
+    if len(words) < AUTO_LANG_MIN_WORDS or not profiled or max(scores.values()) < 0.05:
+        return None, scores
+    top = max(scores.values())
+    # a second language with a similar score is kept, e.g. for documents with mixed languages
+    return [lang for lang in candidates if lang not in LANG_PROFILES or scores[lang] >= top * 0.5], scores
+
+
+def detect_lang(image: Image.Image, candidates: str = AUTO_LANG_CANDIDATES) -> Optional[str]:
+    """
+    Recognizes a crop of the page with all candidates and returns the languages of its words, `None` if unsure.
+    """
+    if '+' not in candidates:
+        return candidates
+    with Stage('detect_lang', candidates=candidates) as info:
+        crop = text_crop(image)
+        start = time.perf_counter()
+        tsv = get_engine().image_to_data([crop], candidates, [])
+        crop_ms = (time.perf_counter() - start) * 1000
+        words = []
+        for line in tsv.splitlines()[1:]:
+            cells = line.split('\t')
+            if len(cells) == 12 and cells[0] == '5' and cells[11].strip() and float(cells[10]) >= 60:
+                words.append(cells[11].strip())
+        langs, scores = classify(words, candidates.split('+'))
+        lang = '+'.join(langs) if langs else None
+        info.update(lang=lang, words=len(words), scores=scores)
+        if lang:
+            # assuming the time of recognizing grows with the number of models and the text of the page, less the recognizing of the crop itself
+            page_share = (crop.width * crop.height) / crop.info['scale'] ** 2 / (image.width * image.height)
+            info['estimated_saved_ms'] = round(crop_ms / page_share * (1 - len(langs) / len(candidates.split('+'))) - crop_ms, 1)
+    logging.debug(f'detected lang {lang} of {candidates} with {len(words)} words {scores}')
+    return lang
+
+
+class AutoLang:
+    """
+    Resolves `lang: auto` for one file, detected on its pages until one has enough text.
+    """
+
+    def __init__(self, lang: str):
+        self.lang = candidates_of(lang)
+        self.detected = lang != AUTO_LANG
+
+    def for_page(self, image: Image.Image) -> str:
+        if not self.detected:
+            lang = detect_lang(image, self.lang)
+            if lang:
+                self.lang = lang
+                self.detected = True
+        return self.lang
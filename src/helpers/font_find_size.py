@@ -1,29 +1,73 @@
+import math
+from typing import Optional
+
 import cv2
+import numpy as np
+
+# below this many letter-like components, the estimated size isn't reliable
+MIN_LETTERS = 20
+
+
+def find_single_letter_sizes(binary: np.ndarray, min_height: int, max_height: int) -> np.ndarray:
+    """
+    Sizes `(width, height)` of letter-like connected components in a binary image with white text on black.
+
+    Components which are too small or too large, much wider than high (lines, touching words) or barely filled (frames) are skipped.
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    # the first component is the background
+    width = stats[1:, cv2.CC_STAT_WIDTH]
+    height = stats[1:, cv2.CC_STAT_HEIGHT]
+    area = stats[1:, cv2.CC_STAT_AREA]
+    letters = (height >= min_height) & (height <= max_height) & (width <= height * 2) & (area >= width * height * 0.1)
+    return np.stack([width[letters], height[letters]], axis=1)
+
+
+def estimate_glyph_height(image: np.ndarray, max_pixels=2_000_000) -> Optional[float]:
+    """
+    Most common height of the letters in a BGR or grayscale image in pixels, `None` when not enough letters are found.
+
+    Measured in a crop of the center with full resolution, which is much faster than the whole page and contains enough letters
+    for most documents; only when not, a reduced copy of the whole page is measured.
+    """
+    height, width = image.shape[:2]
+    size = int(math.sqrt(max_pixels))
+    if height * width <= max_pixels:
+        return _median_letter_height(image, height // 10)
 
+    top = max(0, (height - size) // 2)
+    left = max(0, (width - size) // 2)
+    glyph_height = _median_letter_height(image[top:top + size, left:left + size], size // 3)
+    if glyph_height is not None:
+        return glyph_height
 
-def find_single_letter_sizes(image, min_area, max_area):
-    # todo: this fn should find sizes of letters by contour boxes,
-    #       but mostly detects the whole text area instead of single letters
-    alpha = 0.8  # Controls contrast (1.0 is neutral)
-    beta = 0  # Controls brightness (0 is neutral)
-    image = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-    image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 7, 2)
+    factor = math.ceil(math.sqrt(height * width / max_pixels))
+    reduced = cv2.resize(image, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    glyph_height = _median_letter_height(reduced, reduced.shape[0] // 10)
+    return glyph_height * factor if glyph_height is not None else None
 
-    # Find contours in the binary image
-    contours, _ = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    potential_sizes = []
+def _median_letter_height(image: np.ndarray, max_height: int) -> Optional[float]:
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if image.mean() < 100:
+        # white-on-black
+        image = cv2.bitwise_not(image)
 
-    for contour in contours:
-        # Calculate the area of the contour
-        area = cv2.contourArea(contour)
+    _, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    sizes = find_single_letter_sizes(binary, min_height=3, max_height=max(3, max_height))
+    if len(sizes) < MIN_LETTERS:
+        return None
+    return float(most_common_height(sizes[:, 1]))
 
-        # Get the bounding box of the contour
-        x, y, w, h = cv2.boundingRect(contour)
-        print(f'contour: {area} | {w} {h}')
 
-        # Check if the area of the contour is within the specified range
-        if min_area <= area <= max_area:
-            potential_sizes.append((w, h))
+def most_common_height(heights: np.ndarray) -> float:
+    """
+    The median of the heights within ±10% of the most common height, which is the x-height for most texts.
 
-    return potential_sizes
+    Unlike the median of all heights, it doesn't jump between the x-height and the height of capitals and ascenders.
+    """
+    heights = np.sort(heights)
+    counts = np.searchsorted(heights, heights * 1.1, side='right') - np.searchsorted(heights, heights * 0.9, side='left')
+    common = heights[counts.argmax()]
+    return np.median(heights[(heights >= common * 0.9) & (heights <= common * 1.1)])
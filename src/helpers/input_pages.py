@@ -0,0 +1,89 @@
+import os
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+from PIL import Image
+
+from helpers import deadline
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+DOCUMENT_EXTENSIONS = ['.pdf', '.tif', '.tiff']
+INPUT_EXTENSIONS = IMAGE_EXTENSIONS + DOCUMENT_EXTENSIONS
+
+# resolution for rasterizing PDF pages, overwritten by option `dpi`
+PDF_DPI = int(os.environ.get('PDF_DPI', '300'))
+# highest resolution of option `dpi`, an A4 page has about 140 megapixels at 1200 dpi
+MAX_PDF_DPI = 1200
+
+
+def is_document(file) -> bool:
+    """
+    Multi-page inputs, which are split into pages before preprocessing.
+    """
+    return Path(file.filename or '').suffix.lower() in DOCUMENT_EXTENSIONS
+
+
+def page_file_name(file, page_num: int) -> str:
+    # name for intermediate files of a single page, which also must be writable by `cv2.imwrite`
+    return f'{Path(file.filename).stem}_{page_num}.png'
+
+
+def iter_document_pages(file, dpi: int = PDF_DPI) -> Iterator[Tuple[int, np.ndarray, float]]:
+    """
+    Yields `(page_num, image, scale)` with the decoded grayscale image for each page, one after another to keep the memory usage flat.
+
+    Pages larger than `DECODE_MAX_MEGAPIXELS` are reduced, `scale` maps them back to the full resolution.
+    """
+    if Path(file.filename).suffix.lower() == '.pdf':
+        yield from iter_pdf_pages(file, dpi)
+    else:
+        yield from iter_tiff_pages(file)
+
+
+def iter_pdf_pages(file, dpi: int) -> Iterator[Tuple[int, np.ndarray, float]]:
+    # not at the top, `helpers.limits` uses this module
+    from helpers.limits import check_pixels, reduction
+
+    try:
+        import pypdfium2
+    except ImportError:
+        raise ValueError('PDF input requires the package `pypdfium2`')
+
+    pdf = pypdfium2.PdfDocument(file.stream)
+    try:
+        for i in range(len(pdf)):
+            deadline.check('decode')
+            page = pdf[i]
+            try:
+                width, height = (round(size * dpi / 72) for size in page.get_size())
+                check_pixels(width, height, f'{file.filename} page {i + 1}')
+                factor = reduction(width * height)
+                bitmap = page.render(scale=dpi / 72 / factor, grayscale=True)
+                # copy, as the bitmap buffer is released with the page
+                image = bitmap.to_numpy().copy()
+                bitmap.close()
+            finally:
+                page.close()
+            yield i + 1, image, 1.0 / factor
+    finally:
+        pdf.close()
+
+
+def iter_tiff_pages(file) -> Iterator[Tuple[int, np.ndarray, float]]:
+    from helpers.limits import reduction
+
+    with Image.open(file.stream) as tiff:
+        for i in range(getattr(tiff, 'n_frames', 1)):
+            deadline.check('decode')
+            # frames are decoded on seek, not when opening
+            tiff.seek(i)
+            frame = tiff.convert('L')
+            factor = reduction(frame.width * frame.height)
+            if factor != 1:
+                # the decoders of TIFF can't reduce, but all following steps get cheaper
+                reduced = frame.reduce(factor)
+                frame.close()
+                frame = reduced
+            yield i + 1, np.asarray(frame), 1.0 / factor
+            frame.close()
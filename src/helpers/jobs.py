@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import string
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+JOBS_DIR = os.environ.get('JOBS_DIR', '/tmp/abc-soup-jobs')
+# job threads per server process, by default only dedicated worker processes `python -m helpers.ocr_jobs` run the jobs
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', '0'))
+# job threads of a dedicated worker process
+JOBS_PROCESS_WORKERS = int(os.environ.get('JOBS_PROCESS_WORKERS', '1'))
+# max. queued jobs, further jobs are rejected
+JOBS_MAX_QUEUED = int(os.environ.get('JOBS_MAX_QUEUED', '100'))
+# seconds until finished jobs and their results are removed
+JOBS_RESULT_TTL = int(os.environ.get('JOBS_RESULT_TTL', '3600'))
+# seconds until a running job is considered lost, e.g. when its worker was killed
+JOBS_RUNNING_TIMEOUT = int(os.environ.get('JOBS_RUNNING_TIMEOUT', '3600'))
+# seconds without heartbeat until a worker is considered gone
+WORKER_HEARTBEAT_TIMEOUT = 30
+
+# `kind` => fn(files, options) => (content_type, result)
+JobHandler = Callable[[List[FileStorage], Dict], Tuple[str, bytes]]
+_handlers: Dict[str, JobHandler] = {}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class NoWorkers(Exception):
+    pass
+
+
+def register_handler(kind: str, handler: JobHandler):
+    _handlers[kind] = handler
+
+
+@contextmanager
+def connect():
+    db = sqlite3.connect(os.path.join(JOBS_DIR, 'jobs.sqlite'), timeout=10, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    try:
+        db.execute('PRAGMA journal_mode=WAL')
+        yield db
+    finally:
+        db.close()
+
+
+def init_store():
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with connect() as db:
+        db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT,
+            priority INTEGER,
+            status TEXT,
+            options TEXT,
+            files TEXT,
+            content_type TEXT,
+            error TEXT,
+            created REAL,
+            started REAL,
+            finished REAL,
+            worker TEXT
+        )''')
+        # stores of earlier versions, without the worker running the job
+        if 'worker' not in [row['name'] for row in db.execute('PRAGMA table_info(jobs)')]:
+            db.execute('ALTER TABLE jobs ADD COLUMN worker TEXT')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created)')
+        db.execute('CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, seen REAL)')
+
+
+def job_dir(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def check_accepting(db: sqlite3.Connection):
+    if not db.execute('SELECT 1 FROM workers WHERE seen > ?', (time.time() - WORKER_HEARTBEAT_TIMEOUT,)).fetchone():
+        raise NoWorkers()
+    if db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0] >= JOBS_MAX_QUEUED:
+        raise QueueFull()
+
+
+def enqueue(kind: str, files: List[FileStorage], options: Dict, priority: int = 0) -> str:
+    """
+    Stores the files and adds the job to the queue, raises `QueueFull` or `NoWorkers` when the job can't be accepted.
+    """
+    # before storing the files, so a full queue doesn't cost their upload
+    with connect() as db:
+        check_accepting(db)
+
+    job_id = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    os.makedirs(job_dir(job_id))
+    try:
+        stored_files = []
+        for i, file in enumerate(files):
+            path = os.path.join(job_dir(job_id), f'{i}_{secure_filename(file.filename or "file")}')
+            file.save(path)
+            stored_files.append((file.filename, path))
+
+        with connect() as db:
+            # checked again with the insert in one transaction, else concurrent requests could all pass the limit
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                check_accepting(db)
+                db.execute(
+                    "INSERT INTO jobs (id, kind, priority, status, options, files, created) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                    (job_id, kind, priority, json.dumps(options), json.dumps(stored_files), time.time()),
+                )
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+    except BaseException:
+        shutil.rmtree(job_dir(job_id), ignore_errors=True)
+        raise
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[Dict]:
+    with connect() as db:
+        row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if not row:
+            return None
+        job = {
+            'job_id': row['id'],
+            'kind': row['kind'],
+            'priority': row['priority'],
+            'status': row['status'],
+            'error': row['error'],
+            'created': row['created'],
+            'started': row['started'],
+            'finished': row['finished'],
+            'content_type': row['content_type'],
+            'files': [filename for filename, _ in json.loads(row['files'])],
+        }
+        if row['status'] == 'queued':
+            job['queue_position'] = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority > ? OR (priority = ? AND created < ?))",
+                (row['priority'], row['priority'], row['created']),
+            ).fetchone()[0]
+        return job
+
+
+def result_path(job_id: str) -> str:
+    return os.path.join(job_dir(job_id), 'result')
+
+
+def claim_job(worker_id: Optional[str] = None) -> Optional[sqlite3.Row]:
+    with connect() as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, created LIMIT 1",
+            ).fetchone()
+            if row:
+                db.execute("UPDATE jobs SET status = 'running', started = ?, worker = ? WHERE id = ?", (time.time(), worker_id, row['id']))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+    return row
+
+
+def run_job(row: sqlite3.Row):
+    files = [
+        FileStorage(stream=open(path, 'rb'), filename=filename)
+        for filename, path in json.loads(row['files'])
+    ]
+    try:
+        content_type, result = _handlers[row['kind']](files, json.loads(row['options']))
+        with open(result_path(row['id']), 'wb') as file:
+            file.write(result)
+        status, error = 'done', None
+    except Exception as e:
+        logging.exception(f'job {row["id"]} failed')
+        content_type, status, error = None, 'failed', str(e) or type(e).__name__
+    finally:
+        for file in files:
+            file.close()
+        for _, path in json.loads(row['files']):
+            os.unlink(path)
+
+    finish_job(row['id'], status, error, content_type)
+
+
+def finish_job(job_id: str, status: str, error: Optional[str] = None, content_type: Optional[str] = None):
+    with connect() as db:
+        db.execute(
+            'UPDATE jobs SET status = ?, error = ?, content_type = ?, finished = ? WHERE id = ?',
+            (status, error, content_type, time.time(), job_id),
+        )
+
+
+def cleanup():
+    now = time.time()
+    with connect() as db:
+        db.execute(
+            "UPDATE jobs SET status = 'failed', error = 'job lost', finished = ? WHERE status = 'running' AND started < ?",
+            (now, now - JOBS_RUNNING_TIMEOUT),
+        )
+        # the worker was stopped or killed while running it, e.g. with its container
+        db.execute(
+            "UPDATE jobs SET status = 'failed', error = 'job lost, its worker stopped', finished = ? "
+            "WHERE status = 'running' AND worker IS NOT NULL AND worker NOT IN (SELECT id FROM workers WHERE seen > ?)",
+            (now, now - WORKER_HEARTBEAT_TIMEOUT),
+        )
+        expired = [row['id'] for row in db.execute(
+            "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished < ?",
+            (now - JOBS_RESULT_TTL,),
+        ).fetchall()]
+        for job_id in expired:
+            db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        db.execute('DELETE FROM workers WHERE seen < ?', (now - WORKER_HEARTBEAT_TIMEOUT,))
+    for job_id in expired:
+        shutil.rmtree(job_dir(job_id), ignore_errors=True)
+
+
+def heartbeat(worker_id: str):
+    with connect() as db:
+        db.execute('INSERT OR REPLACE INTO workers (id, seen) VALUES (?, ?)', (worker_id, time.time()))
+
+
+def keep_alive(worker_id: str, stop: threading.Event):
+    # separate from the job loop, as a single job may run longer than the heartbeat timeout
+    while not stop.wait(WORKER_HEARTBEAT_TIMEOUT / 5):
+        try:
+            heartbeat(worker_id)
+        except sqlite3.Error:
+            logging.exception(f'jobs worker {worker_id} failed to send heartbeat')
+
+
+def work(stop: threading.Event, worker_id: Optional[str] = None, poll_interval=0.5):
+    last_cleanup = 0
+    while not stop.is_set():
+        try:
+            now = time.time()
+            if now - last_cleanup > 60:
+                cleanup()
+                last_cleanup = now
+            row = claim_job(worker_id)
+        except sqlite3.Error:
+            logging.exception('jobs worker failed to claim')
+            row = None
+        if row:
+            try:
+                run_job(row)
+            except Exception as e:
+                # e.g. its files are gone or the database is locked, the worker goes on with the next job
+                logging.exception(f'jobs worker failed to run job {row["id"]}')
+                try:
+                    finish_job(row['id'], 'failed', str(e) or type(e).__name__)
+                except sqlite3.Error:
+                    # marked as lost by `cleanup` after `JOBS_RUNNING_TIMEOUT`
+                    logging.exception(f'jobs worker failed to mark job {row["id"]} as failed')
+        else:
+            stop.wait(poll_interval)
+
+
+_started_pid = None
+_stop = threading.Event()
+
+
+def start_workers(count: int = JOBS_WORKERS):
+    """
+    Starts the job threads once per process, safe to call on every request as forked processes start their own.
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    init_store()
+    if count <= 0:
+        return
+    # unique also for a restarted container with the same host name and pid, so its lost jobs are detected
+    worker_id = f'{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+    # registered before the threads run, so jobs are accepted immediately
+    heartbeat(worker_id)
+    threading.Thread(target=keep_alive, args=(worker_id, _stop), name='jobs-heartbeat', daemon=True).start()
+    for i in range(count):
+        threading.Thread(target=work, args=(_stop, worker_id), name=f'jobs-{i}', daemon=True).start()
+    logging.info(f'started {count} jobs workers')
+
+
+def stop_workers():
+    _stop.set()
+
+
+def wait_workers():
+    # waits until stopped, running jobs are finished first
+    while not _stop.wait(1):
+        pass
+    for thread in threading.enumerate():
+        if thread.name.startswith('jobs-'):
+            thread.join()
@@ -0,0 +1,258 @@
+import logging
+import os
+import threading
+import time
+import warnings
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from helpers import deadline
+from helpers.input_pages import PDF_DPI, is_document
+from helpers.scheduler import WORKERS
+from helpers.usages import ADMISSION_REJECTED, Stage
+
+# max. size of a request, larger uploads are rejected while receiving them, `0` for unlimited
+MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', '200'))
+# requests larger than this are received into temporary files instead of memory, see `SpoolingRequest` of the server
+UPLOAD_SPOOL_KB = int(os.environ.get('UPLOAD_SPOOL_KB', '512'))
+# max. pixels of an image or document page, larger ones are rejected before decoding
+MAX_IMAGE_PIXELS = int(float(os.environ.get('MAX_IMAGE_MEGAPIXELS', '200')) * 1_000_000)
+# images and PDF pages with more pixels are decoded at a half, quarter or eighth of their resolution
+DECODE_MAX_PIXELS = int(float(os.environ.get('DECODE_MAX_MEGAPIXELS', '50')) * 1_000_000)
+# bytes a page needs per decoded pixel while it is preprocessed and recognized, for estimating requests
+MEMORY_PER_PIXEL = float(os.environ.get('MEMORY_PER_PIXEL', '8'))
+# memory of the requests a worker processes at once, `0` uses a share of the memory limit of the container, `-1` disables it
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', '0'))
+# seconds a request waits for memory of other requests, before it is rejected
+MEMORY_WAIT_SECONDS = float(os.environ.get('MEMORY_WAIT_SECONDS', '10'))
+
+# PIL rejects images with twice as many pixels with `DecompressionBombError` when opening them, e.g. TIFF frames,
+# the warning for smaller ones is left out as they are rejected with `TooLarge` anyway
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+
+
+class TooLarge(Exception):
+    pass
+
+
+class Busy(Exception):
+    pass
+
+
+def memory_limit() -> Optional[int]:
+    """
+    Bytes the container may use, `None` if unlimited.
+    """
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as file:
+                value = file.read().strip()
+        except OSError:
+            continue
+        # `max` for cgroup v2, a huge number for cgroup v1
+        if value.isdigit() and int(value) < 1 << 60:
+            return int(value)
+        return None
+    return None
+
+
+def default_budget() -> Optional[int]:
+    if MEMORY_BUDGET_MB > 0:
+        return MEMORY_BUDGET_MB * 1024 * 1024
+    limit = memory_limit()
+    if MEMORY_BUDGET_MB < 0 or not limit:
+        return None
+    # the rest for the app itself, the preprocess pool and the page cache
+    return int(limit * 0.75 / max(1, WORKERS))
+
+
+def file_source(file) -> Union[bytes, str]:
+    """
+    The path of a file received to disk, else its content.
+    """
+    path = getattr(file.stream, 'name', None)
+    if isinstance(path, str) and os.path.isfile(path):
+        file.stream.flush()
+        return path
+    return file.read()
+
+
+def check_pixels(width: int, height: int, name: str):
+    if width * height > MAX_IMAGE_PIXELS:
+        ADMISSION_REJECTED.labels('pixels').inc()
+        raise TooLarge(f'{name} has {width}x{height} pixels, at most {MAX_IMAGE_PIXELS / 1_000_000:g} megapixels are supported')
+
+
+def reduction(pixels: int) -> int:
+    # the smallest of the factors the decoders support, which gets the image below `DECODE_MAX_PIXELS`
+    for factor in (1, 2, 4):
+        if pixels <= DECODE_MAX_PIXELS * factor * factor:
+            return factor
+    return 8
+
+
+def page_sizes(file, dpi: int = PDF_DPI) -> List[Tuple[int, int]]:
+    """
+    The size of each page from the headers without decoding, empty if unreadable, which the decoding reports later.
+    """
+    position = file.stream.tell()
+    try:
+        if Path(file.filename or '').suffix.lower() == '.pdf':
+            import pypdfium2
+            pdf = pypdfium2.PdfDocument(file.stream)
+            try:
+                return [(round(width * dpi / 72), round(height * dpi / 72)) for width, height in (pdf.get_page_size(i) for i in range(len(pdf)))]
+            finally:
+                pdf.close()
+        with Image.open(file.stream) as image:
+            sizes = []
+            for i in range(getattr(image, 'n_frames', 1)):
+                image.seek(i)
+                sizes.append(image.size)
+            return sizes
+    except Image.DecompressionBombError as e:
+        ADMISSION_REJECTED.labels('pixels').inc()
+        raise TooLarge(f'{file.filename}: {e}')
+    except Exception as e:
+        logging.debug(f'no page sizes of {file.filename}: {e}')
+        return []
+    finally:
+        file.stream.seek(position)
+
+
+def estimate_memory(files, options: Dict, all_pages_held=False) -> int:
+    """
+    Bytes needed for processing `files`, raises `TooLarge` for pages with too many pixels.
+
+    With `all_pages_held` the preprocessed images are kept until all are recognized, else only the pages in progress.
+    """
+    from helpers.preprocess_pool import PREPROCESS_MAX_PARALLEL
+
+    dpi = int(options.get('dpi') or PDF_DPI)
+    working = []
+    held = 0
+    for file in files:
+        sizes = page_sizes(file, dpi)
+        for width, height in sizes:
+            check_pixels(width, height, file.filename)
+        if not sizes:
+            continue
+        # TIFF frames are decoded fully and reduced afterwards
+        tiff = Path(file.filename or '').suffix.lower() in ('.tif', '.tiff')
+        decoded = [width * height if tiff else width * height // reduction(width * height) ** 2 for width, height in sizes]
+        working.append(max(decoded) * MEMORY_PER_PIXEL)
+        if all_pages_held and not is_document(file):
+            held += sum(decoded)
+    # images are preprocessed in parallel, pages of documents one after another
+    return int(held + sum(sorted(working, reverse=True)[:max(1, PREPROCESS_MAX_PARALLEL)]))
+
+
+class Reservation:
+    def __init__(self, budget: 'MemoryBudget', reserved: int):
+        self.budget = budget
+        self.reserved = reserved
+
+    def release(self):
+        # safe to call more than once, e.g. by a stream and when its response is closed
+        reserved, self.reserved = self.reserved, 0
+        if reserved:
+            self.budget.release(reserved)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class MemoryBudget:
+    """
+    Memory of the requests and jobs running in this worker, requests wait until enough is released.
+    """
+
+    def __init__(self, budget: Optional[int]):
+        self.budget = budget
+        self.reserved = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, needed: int, wait: Optional[float] = MEMORY_WAIT_SECONDS) -> Reservation:
+        """
+        Reserves `needed` bytes, waits at most `wait` seconds or without limit if `None`, but not beyond the deadline of the request.
+        """
+        if self.budget is None:
+            return Reservation(self, 0)
+        self.check(needed)
+        until = None if wait is None else time.monotonic() + wait
+        request_remaining = deadline.remaining()
+        by_deadline = request_remaining is not None and (wait is None or request_remaining < wait)
+        if by_deadline:
+            until = time.monotonic() + request_remaining
+        with self._condition:
+            self.waiting += 1
+            try:
+                while self.reserved + needed > self.budget:
+                    remaining = None if until is None else until - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        if by_deadline:
+                            raise deadline.exceeded('admit')
+                        ADMISSION_REJECTED.labels('busy').inc()
+                        raise Busy(f'Not enough memory available, {mib(self.reserved)} of {mib(self.budget)} MiB in use')
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.reserved += needed
+        return Reservation(self, needed)
+
+    def check(self, needed: int):
+        if self.budget is not None and needed > self.budget:
+            ADMISSION_REJECTED.labels('memory').inc()
+            raise TooLarge(f'Needs about {mib(needed)} MiB of memory, a request may use at most {mib(self.budget)} MiB')
+
+    def release(self, reserved: int):
+        with self._condition:
+            self.reserved -= reserved
+            self._condition.notify_all()
+
+    def info(self) -> Dict:
+        return {
+            'budget_mb': mib(self.budget) if self.budget is not None else None,
+            'reserved_mb': mib(self.reserved),
+            'waiting': self.waiting,
+        }
+
+
+def mib(size: int) -> int:
+    return round(size / 1024 / 1024)
+
+
+_budget = MemoryBudget(default_budget())
+
+
+def admit(files, options: Dict, all_pages_held=False, wait: Optional[float] = MEMORY_WAIT_SECONDS) -> Reservation:
+    """
+    Reserves the estimated memory of processing `files` before anything is decoded.
+
+    Raises `TooLarge` when a page or the whole request exceeds the limits, `Busy` when the memory isn't released in time.
+    """
+    with Stage('admit', files=len(files)) as info:
+        needed = estimate_memory(files, options, all_pages_held)
+        info['memory_mb'] = mib(needed)
+        return _budget.acquire(needed, wait)
+
+
+def check(files, options: Dict, all_pages_held=False):
+    # for queued jobs, which later wait for the memory instead; with the same `all_pages_held` as their `admit`
+    _budget.check(estimate_memory(files, options, all_pages_held))
+
+
+def info() -> Dict:
+    return {
+        **_budget.info(),
+        'max_upload_mb': MAX_UPLOAD_MB or None,
+        'max_image_megapixels': MAX_IMAGE_PIXELS / 1_000_000,
+        'decode_max_megapixels': DECODE_MAX_PIXELS / 1_000_000,
+    }
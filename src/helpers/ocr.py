@@ -0,0 +1,425 @@
+import copy
+import json
+import logging
+import os
+import random
+import string
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from helpers.deadline import DeadlineExceeded
+from helpers.ocr_cache import get_cache, MISSING
+from helpers.ocr_engine import get_engine, TSV_HEADER
+from helpers.detect_lang import AUTO_LANG, AutoLang, join_langs
+from helpers.input_pages import is_document, iter_document_pages, MAX_PDF_DPI, page_file_name, PDF_DPI
+from helpers.optimize_image import optimize_image, optimize_image_array, preprocess_steps, to_pil_image
+from helpers.prepare_files import prepare_files, prepare_images, OCR_HANDOFF
+from helpers.preprocess_pool import optimize_files
+from helpers.process_data import process_data
+from helpers.refine import refine_page, refine_pages
+from helpers.serialize import LAYOUTS
+from helpers.text_regions import image_to_data_regions, text_regions
+from helpers.tiling import image_to_data_tiled, page_rows, use_tiles
+from helpers.usages import Stage
+
+
+def build_config(options: Dict):
+    psm = options.get('psm', None)  # https://tesseract-ocr.github.io/tessdoc/ImproveQuality.html#page-segmentation-method
+    preserve_interword_spaces = options.get('preserve_interword_spaces', None)  # preserve_interword_spaces=1
+
+    config = []
+    if psm is not None:
+        config.append(fr'--psm {psm}')
+    if preserve_interword_spaces is not None:
+        config.append(fr'-c preserve_interword_spaces={preserve_interword_spaces}')
+
+    return config
+
+
+class OptionError(ValueError):
+    pass
+
+
+def parse_options(form_options, pdf=False):
+    """
+    The options of a request, raises `OptionError` for invalid ones; with `pdf` for the endpoints creating PDFs.
+    """
+    options = json.loads(form_options) if form_options else default_options
+    if pdf and options.get('regions'):
+        # the text layer of a PDF is recognized by the engine from the whole page, it can't be assembled from regions
+        raise OptionError('regions is not supported for PDF output')
+    if 'lang' in options and isinstance(options['lang'], list):
+        options['lang'] = '+'.join(options['lang'])
+    if options.get('preprocess') is not None and not isinstance(options['preprocess'], (str, bool)):
+        raise OptionError('preprocess must be a profile name, comma separated steps or a boolean')
+    if options.get('preprocess'):
+        try:
+            preprocess_steps(options['preprocess'])
+        except ValueError as e:
+            raise OptionError(str(e))
+    if options.get('layout') not in (None, *LAYOUTS):
+        raise OptionError(f'unknown layout {options["layout"]}, one of {", ".join(LAYOUTS)}')
+    seconds = options.get('deadline')
+    if seconds is not None and (isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0):
+        raise OptionError('deadline must be a positive number of seconds')
+    dpi = options.get('dpi')
+    if dpi is not None and (isinstance(dpi, bool) or not isinstance(dpi, int) or not 1 <= dpi <= MAX_PDF_DPI):
+        raise OptionError(f'dpi must be a whole number from 1 to {MAX_PDF_DPI}')
+
+    return {
+        **default_options,
+        **options,
+    }
+
+
+default_options_pdf = {
+    'lang': os.environ.get('DEFAULT_LANG', 'eng+deu'),
+    'optimize_images': True,
+    'save_intermediate': False,
+}
+
+default_options = {
+    **default_options_pdf,
+    'optimize_images': False,
+    'intra_block_breaks': True,
+    'keep_details': False,
+}
+
+
+def preprocess_option(options: Dict) -> Union[bool, str]:
+    # a `preprocess` profile or steps replace `optimize_images`
+    return options.get('preprocess') or options['optimize_images']
+
+
+def process_request(files: List[FileStorage], options: Dict):
+    if any(is_document(file) for file in files):
+        # documents are processed page by page, to not keep all pages in memory
+        pages = []
+        for page_num, file, page, error in iter_process_request(files, options):
+            if error:
+                raise error
+            if page:
+                pages.append(page)
+        return pages
+
+    cache = get_cache()
+    if not cache or options['save_intermediate']:
+        # intermediate files are only created when not cached
+        return ocr_files(files, options)
+
+    keys = [cache.make_key(file, options) for file in files]
+    cached = [cache.get(key) for key in keys]
+    # files with the same content are only processed once
+    missing = {}
+    for i, page in enumerate(cached):
+        if page is MISSING and keys[i] not in missing:
+            missing[keys[i]] = i
+    if missing:
+        pages = ocr_files([files[i] for i in missing.values()], options)
+        pages_by_num = {page['page']: page for page in pages}
+        for j, key in enumerate(missing):
+            page = pages_by_num.get(j + 1)
+            # pages without text are cached as `None`
+            missing[key] = {name: value for name, value in page.items() if name not in ('page', 'file')} if page else None
+            cache.set(key, missing[key])
+        # duplicates get a copy, as the page numbers of the boxes are changed
+        cached = [copy.deepcopy(missing[key]) if page is MISSING else page for key, page in zip(keys, cached)]
+
+    return [
+        with_page_num(page, i + 1, files[i].filename)
+        for i, page in enumerate(cached)
+        if page is not None
+    ]
+
+
+def process_first_page(file: FileStorage, options: Dict) -> Optional[Dict]:
+    """
+    The first page with text, further pages of a document aren't decoded.
+    """
+    for page_num, _, page, error in iter_process_request([file], options):
+        if error:
+            raise error
+        if page:
+            return page
+    return None
+
+
+def with_page_num(page: Dict, page_num: int, filename: str):
+    for block in page.get('blocks', []):
+        for box in block['boxes']:
+            box['page_num'] = page_num
+    return {**page, 'page': page_num, 'file': filename}
+
+
+def ocr_files(files: List[FileStorage], options: Dict):
+    lang = options['lang']
+    optimize_images = preprocess_option(options)
+    save_intermediate = options['save_intermediate']
+    intra_block_breaks = options['intra_block_breaks']
+    keep_details = options['keep_details']
+    config = build_config(options)
+
+    refine = bool(options.get('refine'))
+
+    if OCR_HANDOFF == 'memory':
+        images, infer_id = prepare_images(files, optimize=optimize_images, save_intermediate=save_intermediate, keep_normalized=refine)
+        scales = [image.info.get('scale', 1.0) for image in images]
+        if lang == AUTO_LANG:
+            # all pages are recognized at once, thus with the languages of all of them
+            lang = join_langs([AutoLang(lang).for_page(image) for image in images])
+        regions = [page_regions(image, options) for image in images]
+        tiled = [use_tiles(image, options) for image in images]
+        if any(regions) or any(tiled):
+            # cropped and large pages are recognized in parts, thus each page separately and joined with its page number
+            text: str = TSV_HEADER + '\n' + ''.join(
+                page_rows(image_to_data_page(image, regions[i], tiled[i], lang, config), i + 1)
+                for i, image in enumerate(images)
+            )
+        else:
+            text: str = get_engine().image_to_data(images, lang, config)
+        if refine:
+            text = refine_pages(images, text, lang, config)
+    else:
+        image_paths, infer_file, infer_id, scales, normalized = prepare_files(files, optimize=optimize_images, save_intermediate=save_intermediate, keep_normalized=refine)
+        try:
+            if lang == AUTO_LANG:
+                langs = []
+                for image_path in image_paths:
+                    with Image.open(image_path) as image:
+                        langs.append(AutoLang(lang).for_page(image))
+                lang = join_langs(langs)
+            text: str = get_engine().image_to_data(infer_file, lang, config)
+            if refine:
+                images = [Image.open(image_path) for image_path in image_paths]
+                for image, page in zip(images, normalized):
+                    image.info['normalized'] = page
+                try:
+                    text = refine_pages(images, text, lang, config)
+                finally:
+                    for image in images:
+                        image.close()
+        finally:
+            for image_path in image_paths:
+                os.unlink(image_path)
+            if infer_file not in image_paths:
+                os.unlink(infer_file)
+
+    with Stage('process_data', pages=len(files)):
+        return process_data(files, text, intra_block_breaks, keep_details, scales)
+
+
+def page_regions(image, options: Dict):
+    # tiles when explicitly requested, else with option `regions` the text regions of a page which is mostly empty
+    return None if options.get('tiles') else text_regions(image, options)
+
+
+def image_to_data_page(image, regions, tiled: bool, lang: str, config: List[str]) -> str:
+    if regions:
+        return image_to_data_regions(image, regions, lang, config)
+    if tiled:
+        return image_to_data_tiled(image, lang, config)
+    return get_engine().image_to_data([image], lang, config)
+
+
+def iter_process_request(files: List[FileStorage], options: Dict) -> Iterator[Tuple[Optional[int], FileStorage, Optional[Dict], Optional[Exception]]]:
+    """
+    Processes the files one after another, yields `(page_num, file, page, error)` as soon as a page is ready.
+
+    `page_num` is the position of an image in `files`, or the page number inside of a PDF/TIFF document.
+    `page` is `None` for pages without text or when failed, the preprocessing of the next images runs while OCR is running.
+    `DeadlineExceeded` is raised instead of yielded, as all further pages would fail as well.
+    """
+    cache = get_cache() if not options['save_intermediate'] else None
+    keys = [cache.make_key(file, options) for file in files] if cache else [None] * len(files)
+    cached = [cache.get(key) if cache and not is_document(file) else MISSING for file, key in zip(files, keys)]
+    missing = [i for i, page in enumerate(cached) if page is MISSING and not is_document(files[i])]
+
+    infer_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    images = optimize_files(
+        [files[i] for i in missing],
+        preprocess_option(options),
+        [f'/app/shared-assets/{infer_id}_{i}_' if options['save_intermediate'] else None for i in missing],
+        return_exceptions=True,
+        keep_normalized=bool(options.get('refine')),
+    )
+    for i, file in enumerate(files):
+        if is_document(file):
+            yield from iter_process_document(file, options, keys[i], f'{infer_id}_{i}')
+            continue
+
+        page = cached[i]
+        if page is MISSING:
+            image = next(images)
+            try:
+                if isinstance(image, Exception):
+                    raise image
+                page = ocr_image(image, file, options, f'{infer_id}_{i}')
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                logging.exception(f'failed to process page {i + 1} {file.filename}')
+                yield i + 1, file, None, e
+                continue
+            if cache:
+                cache.set(keys[i], page)
+        yield i + 1, file, with_page_num(page, i + 1, file.filename) if page else None, None
+
+
+def iter_process_document(file: FileStorage, options: Dict, key: Optional[str], infer_id: str):
+    """
+    Decodes, optimizes and runs OCR for one page after another of a PDF/TIFF document.
+    """
+    cache = get_cache() if key else None
+    dpi = int(options.get('dpi') or PDF_DPI)
+    pages = iter_document_pages(file, dpi)
+    # the first page with enough text decides for the whole document
+    auto_lang = AutoLang(options['lang'])
+    while True:
+        try:
+            page_num, image, decode_scale = next(pages)
+        except StopIteration:
+            return
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logging.exception(f'failed to read document {file.filename}')
+            yield None, file, None, e
+            return
+
+        page_key = f'{key}:{dpi}:{page_num}' if cache else None
+        page = cache.get(page_key) if cache else MISSING
+        if page is MISSING:
+            try:
+                page_file = page_file_name(file, page_num)
+                output_base = f'/app/shared-assets/{infer_id}_' if options['save_intermediate'] else None
+                optimized, scale, *normalized = optimize_image_array(
+                    image, page_file, preprocess_option(options), output_base, owned=True, return_normalized=bool(options.get('refine')),
+                )
+                del image
+                pil_image = to_pil_image(optimized, page_file, output_base, scale * decode_scale, *normalized)
+                page = ocr_image(pil_image, file, options, f'{infer_id}_{page_num}', auto_lang.for_page(pil_image))
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                logging.exception(f'failed to process page {page_num} {file.filename}')
+                yield page_num, file, None, e
+                continue
+            if cache:
+                cache.set(page_key, page)
+        yield page_num, file, with_page_num(page, page_num, file.filename) if page else None, None
+
+
+def ocr_image(image, file: FileStorage, options: Dict, image_id: str, lang: Optional[str] = None) -> Optional[Dict]:
+    """
+    OCR for a single preprocessed image, returns the page without `page` and `file`.
+
+    `lang` replaces the option, e.g. when already detected for a document.
+    """
+    lang = lang or AutoLang(options['lang']).for_page(image)
+    config = build_config(options)
+    regions = page_regions(image, options)
+    if regions:
+        text: str = image_to_data_regions(image, regions, lang, config)
+    elif use_tiles(image, options):
+        text: str = image_to_data_tiled(image, lang, config)
+    elif OCR_HANDOFF == 'memory':
+        text: str = get_engine().image_to_data([image], lang, config)
+    else:
+        path = f'/tmp/{image_id}.{image.format.lower()}'
+        with Stage('write_temp', file=file.filename):
+            image.save(path, format=image.format)
+        try:
+            text: str = get_engine().image_to_data(path, lang, config)
+        finally:
+            os.unlink(path)
+    if options.get('refine'):
+        text = refine_page(image, text, lang, config)
+
+    with Stage('process_data', file=file.filename):
+        pages = process_data([file], text, options['intra_block_breaks'], options['keep_details'], [image.info.get('scale', 1.0)])
+    if not pages:
+        return None
+    return {name: value for name, value in pages[0].items() if name not in ('page', 'file')}
+
+
+def ocr_to_pdf(file: FileStorage, options: Dict) -> bytes:
+    lang = options['lang']
+    optimize_images = preprocess_option(options)
+    save_intermediate = options['save_intermediate']
+    config = build_config(options)
+
+    if is_document(file):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_path, _ = ocr_files_to_pdf([file], options, tmp_dir)
+            with open(pdf_path, 'rb') as pdf_file:
+                return pdf_file.read()
+
+    infer_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    pil_image = optimize_image(file, optimize_images, f'/app/shared-assets/pdf_{infer_id}_' if save_intermediate else None)
+    lang = AutoLang(lang).for_page(pil_image)
+
+    # a list is handed over in-memory, a single image is stored to disk by pytesseract
+    return get_engine().image_to_pdf([pil_image] if OCR_HANDOFF == 'memory' else pil_image, lang, config)
+
+
+def iter_optimized_pages(files: List[FileStorage], options: Dict, infer_id: str) -> Iterator[Image.Image]:
+    """
+    All pages of `files` in order, images are preprocessed in the pool and documents one page after another.
+    """
+    image_indexes = [i for i, file in enumerate(files) if not is_document(file)]
+    images = optimize_files(
+        [files[i] for i in image_indexes],
+        preprocess_option(options),
+        [f'/app/shared-assets/pdf_{infer_id}_{i}_' if options['save_intermediate'] else None for i in image_indexes],
+    )
+    for i, file in enumerate(files):
+        if not is_document(file):
+            yield next(images)
+            continue
+        output_base = f'/app/shared-assets/pdf_{infer_id}_{i}_' if options['save_intermediate'] else None
+        for page_num, image, decode_scale in iter_document_pages(file, int(options.get('dpi') or PDF_DPI)):
+            page_file = page_file_name(file, page_num)
+            optimized, scale = optimize_image_array(image, page_file, preprocess_option(options), output_base, owned=True)
+            del image
+            yield to_pil_image(optimized, page_file, output_base, scale * decode_scale)
+
+
+def ocr_files_to_pdf(files: List[FileStorage], options: Dict, output_dir: str) -> Tuple[str, int]:
+    """
+    Creates one searchable PDF with all pages of `files` in `output_dir`, returns its path and the bytes of the largest page in memory.
+
+    Each page is stored after preprocessing, so only a single page is in memory and the engine appends them from a list file.
+    """
+    infer_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    paths = []
+    list_path = os.path.join(output_dir, 'pages.txt')
+    page_memory_peak = 0
+    try:
+        # all pages are recognized at once, the first page with enough text decides
+        auto_lang = AutoLang(options['lang'])
+        for n, image in enumerate(iter_optimized_pages(files, options, infer_id), 1):
+            if not auto_lang.detected:
+                auto_lang.for_page(image)
+            path = os.path.join(output_dir, f'page_{n}.{image.format.lower()}')
+            # the buffer of the preprocessed page, one byte per pixel and band
+            page_bytes = image.width * image.height * len(image.getbands())
+            page_memory_peak = max(page_memory_peak, page_bytes)
+            with Stage('write_temp', page=n, bytes=page_bytes):
+                image.save(path, format=image.format)
+            paths.append(path)
+            image.close()
+        if not paths:
+            raise ValueError('No pages to process')
+
+        with open(list_path, 'w') as list_file:
+            list_file.write('\n'.join(paths))
+        pdf_path = get_engine().image_to_pdf_file(list_path, auto_lang.lang, build_config(options), os.path.join(output_dir, 'output'))
+    finally:
+        # also on errors, the directory may be one of the caller which is kept
+        for path in [*paths, list_path]:
+            if os.path.exists(path):
+                os.unlink(path)
+    return pdf_path, page_memory_peak
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from helpers.detect_lang import candidates_of
+from helpers.optimize_image import PREPROCESS_VERSION
+
+# options which change the result of a page
+CACHE_OPTIONS = ('lang', 'psm', 'preserve_interword_spaces', 'optimize_images', 'intra_block_breaks', 'keep_details', 'tiles', 'regions', 'preprocess', 'refine')
+
+MISSING = object()
+
+
+def tessdata_fingerprint(lang: str) -> str:
+    """
+    Size and mtime of the models used for `lang`, so updated models don't return old results.
+    """
+    tessdata = os.environ.get('TESSDATA_PREFIX', '/usr/share/tesseract-ocr/5/tessdata/')
+    parts = []
+    for model in lang.split('+'):
+        try:
+            stat = os.stat(os.path.join(tessdata, f'{model}.traineddata'))
+            parts.append(f'{model}:{stat.st_size}:{int(stat.st_mtime)}')
+        except OSError:
+            parts.append(f'{model}:-')
+    return ','.join(parts)
+
+
+class OCRCache:
+    """
+    Content addressed cache for parsed pages, with an in-memory LRU per process and an optional SQLite file shared by all workers.
+    """
+
+    def __init__(self, memory_bytes: int, disk_path: Optional[str] = None, disk_entries: int = 0, version: str = ''):
+        self.memory_bytes = memory_bytes
+        self.disk_path = disk_path
+        self.disk_entries = disk_entries
+        self.version = f'{PREPROCESS_VERSION}:{version}'
+        self.stats = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0}
+        self._memory: 'OrderedDict[str, str]' = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._tessdata: Dict[str, str] = {}
+        if disk_path:
+            with self._connect() as db:
+                db.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, version TEXT, value TEXT, accessed REAL)')
+                db.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+                # entries of other versions can never be hit again
+                db.execute('DELETE FROM pages WHERE version != ?', (self.version,))
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.disk_path, timeout=10)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def make_key(self, file, options: Dict) -> str:
+        """
+        Hashes the file content and the options which influence the result, the file is rewound afterwards.
+        """
+        # for `auto` the models of all candidates
+        lang = candidates_of(options['lang'])
+        if lang not in self._tessdata:
+            self._tessdata[lang] = tessdata_fingerprint(lang)
+
+        digest = hashlib.sha256()
+        while True:
+            chunk = file.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+        file.seek(0)
+        digest.update(json.dumps({
+            **{option: options.get(option) for option in CACHE_OPTIONS},
+            'tessdata': self._tessdata[lang],
+        }, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str, default=MISSING):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.stats['hits_memory'] += 1
+                return json.loads(value)
+
+        if self.disk_path:
+            with self._connect() as db:
+                row = db.execute('SELECT value FROM pages WHERE key = ? AND version = ?', (key, self.version)).fetchone()
+                if row:
+                    db.execute('UPDATE pages SET accessed = ? WHERE key = ?', (time.time(), key))
+            if row:
+                self._set_memory(key, row[0])
+                with self._lock:
+                    self.stats['hits_disk'] += 1
+                return json.loads(row[0])
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return default
+
+    def set(self, key: str, value):
+        serialized = json.dumps(value)
+        self._set_memory(key, serialized)
+        if self.disk_path:
+            with self._connect() as db:
+                db.execute(
+                    'INSERT OR REPLACE INTO pages (key, version, value, accessed) VALUES (?, ?, ?, ?)',
+                    (key, self.version, serialized, time.time()),
+                )
+                if self.disk_entries:
+                    db.execute(
+                        'DELETE FROM pages WHERE key IN (SELECT key FROM pages ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                        (self.disk_entries,),
+                    )
+
+    def _set_memory(self, key: str, serialized: str):
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= len(self._memory.pop(key))
+            if len(serialized) > self.memory_bytes:
+                return
+            self._memory[key] = serialized
+            self._memory_size += len(serialized)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._tessdata.clear()
+        if self.disk_path:
+            with self._connect() as db:
+                db.execute('DELETE FROM pages')
+
+    def info(self) -> Dict:
+        with self._lock:
+            return {
+                **self.stats,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_size,
+                'disk': bool(self.disk_path),
+            }
+
+
+_cache = None
+
+
+def get_cache() -> Optional[OCRCache]:
+    """
+    The cache of this process, `None` if disabled with `OCR_CACHE_MEMORY_MB=0` and no `OCR_CACHE_DIR`.
+    """
+    global _cache
+    if _cache is None:
+        memory_mb = float(os.environ.get('OCR_CACHE_MEMORY_MB', '64'))
+        cache_dir = os.environ.get('OCR_CACHE_DIR')
+        if memory_mb <= 0 and not cache_dir:
+            return None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        _cache = OCRCache(
+            memory_bytes=int(memory_mb * 1024 * 1024),
+            disk_path=os.path.join(cache_dir, 'ocr-cache.sqlite') if cache_dir else None,
+            disk_entries=int(os.environ.get('OCR_CACHE_DISK_ENTRIES', '100000')),
+            version=os.environ.get('OCR_CACHE_VERSION', ''),
+        )
+        logging.info(f'using OCR cache {_cache.info()}')
+    return _cache
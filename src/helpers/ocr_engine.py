@@ -0,0 +1,376 @@
+import functools
+import io
+import logging
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+from pytesseract import pytesseract
+
+from helpers import deadline
+from helpers.scheduler import current_threads, process_threads, thread_budget
+from helpers.usages import Stage
+
+# OpenMP reads it once when tesserocr is loaded, thus the workers split the CPUs evenly instead of a budget per call
+os.environ.setdefault('OMP_THREAD_LIMIT', str(process_threads()))
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# the header the tesseract cli writes for `tsv` output, `GetTSVText` only returns the rows
+TSV_HEADER = 'level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext'
+# for files which only some renderers need, memory backed if available
+TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def parse_config(config: List[str]) -> Tuple[Optional[int], Dict[str, str]]:
+    """
+    Parses the cli-style config built by `build_config`, e.g. `['--psm 4', '-c preserve_interword_spaces=1']`.
+    """
+    psm = None
+    variables = {}
+    args = shlex.split(' '.join(config))
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--psm' and i + 1 < len(args):
+            psm = int(args[i + 1])
+            i += 1
+        elif arg == '-c' and i + 1 < len(args) and '=' in args[i + 1]:
+            name, value = args[i + 1].split('=', 1)
+            variables[name] = value
+            i += 1
+        else:
+            raise ValueError(f'unsupported tesseract config `{arg}`')
+        i += 1
+    return psm, variables
+
+
+def timed(fn):
+    # each engine call is an `ocr` stage of the request, with a thread budget
+    @functools.wraps(fn)
+    def wrapper(self, image, lang: str, *args, **kwargs):
+        deadline.check('ocr')
+        with thread_budget(self.threads) as threads, Stage('ocr', engine=self.name, lang=lang, output=fn.__name__, threads=threads):
+            return fn(self, image, lang, *args, **kwargs)
+    return wrapper
+
+
+def read_image_list(image) -> List:
+    """
+    Resolves the input like tesseract: a path to a `.txt` file is a list of image paths, anything else a single image.
+    """
+    if isinstance(image, list):
+        return image
+    if isinstance(image, str) and image.endswith('.txt'):
+        with open(image) as file:
+            return [line.strip() for line in file if line.strip()]
+    return [image]
+
+
+class PytesseractEngine:
+    """
+    Runs the `tesseract` binary per call, the models are loaded again for every call.
+
+    PIL images are passed as uncompressed multi-page TIFF by stdin, instead of using files.
+    Each call gets `OMP_THREAD_LIMIT` of its thread budget.
+    """
+    name = 'pytesseract'
+    # a budget per call
+    threads = None
+    # calls of a request running at once, e.g. tiles, without limit as each runs its own process
+    max_parallel = None
+
+    def _run(self, image, lang: str, config: List[str], renderer: str, output_base='stdout') -> bytes:
+        # a path can also be a `.txt` file listing the images
+        stdin = None
+        if not isinstance(image, str):
+            images = image if isinstance(image, list) else [image]
+            buffer = io.BytesIO()
+            images[0].save(buffer, format='TIFF', save_all=True, append_images=images[1:])
+            stdin = buffer.getvalue()
+            image = 'stdin'
+        args = [
+            pytesseract.tesseract_cmd, image, output_base,
+            '-l', lang,
+            *shlex.split(' '.join(config)),
+            '-c', f'{renderer}=1',
+        ]
+        threads = current_threads()
+        logging.debug(f'{args} with {threads} threads')
+        remaining = deadline.remaining()
+        try:
+            proc = subprocess.run(
+                args, input=stdin, capture_output=True, env={**os.environ, 'OMP_THREAD_LIMIT': str(threads)},
+                timeout=None if remaining is None else max(0.001, remaining),
+            )
+        except FileNotFoundError:
+            raise pytesseract.TesseractNotFoundError()
+        except subprocess.TimeoutExpired:
+            # `tesseract` is already killed and waited for, a partly written PDF is removed with its temporary directory
+            raise deadline.exceeded('ocr')
+        if proc.returncode:
+            raise pytesseract.TesseractError(proc.returncode, proc.stderr.decode('utf-8', errors='replace'))
+        return proc.stdout
+
+    def info(self) -> Dict:
+        # not `pytesseract.get_languages`, it caches the first result for the whole process
+        try:
+            version = subprocess.run([pytesseract.tesseract_cmd, '--version'], capture_output=True, stdin=subprocess.DEVNULL)
+            languages = subprocess.run([pytesseract.tesseract_cmd, '--list-langs'], capture_output=True, stdin=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise pytesseract.TesseractNotFoundError()
+        return {
+            'engine': self.name,
+            'languages': sorted(line.strip() for line in languages.stdout.decode().splitlines() if pytesseract.LANG_PATTERN.match(line.strip())),
+            'tesseract_version': (version.stdout or version.stderr).decode().split()[1].split('-')[0],
+        }
+
+    @timed
+    def image_to_data(self, image, lang: str, config: List[str]) -> str:
+        return self._run(image, lang, config, 'tessedit_create_tsv').decode('utf-8')
+
+    @timed
+    def image_to_pdf(self, image, lang: str, config: List[str]) -> bytes:
+        return self._run(image, lang, config, 'tessedit_create_pdf')
+
+    @timed
+    def image_to_pdf_file(self, image_list: str, lang: str, config: List[str], output_base: str) -> str:
+        self._run(image_list, lang, config, 'tessedit_create_pdf', output_base)
+        return f'{output_base}.pdf'
+
+
+def timeout_ms() -> int:
+    # for tesserocr, where `0` is unlimited
+    remaining = deadline.remaining()
+    return 0 if remaining is None else max(1, int(remaining * 1000))
+
+
+def cancelled(timeout: int) -> bool:
+    # tesseract cancels at about the deadline, by its own clock
+    return bool(timeout) and deadline.remaining() < 0.05
+
+
+class TesserocrEngine:
+    """
+    Keeps initialized tesseract API handles per `lang` combination alive in this process.
+
+    At most `pool_size` idle handles are kept, the least recently used ones are ended first.
+    Recognition is cancelled by tesseract at the deadline, the handle stays usable.
+    """
+    name = 'tesserocr'
+    threads = int(os.environ['OMP_THREAD_LIMIT'])
+
+    def __init__(self, pool_size: int, path: str):
+        self.pool_size = pool_size
+        # more parallel calls of a request than kept handles would load the models again for each of them
+        self.max_parallel = pool_size
+        self.path = path
+        self._idle: 'OrderedDict[str, List]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def info(self) -> Dict:
+        # in process, without a handle of the pool
+        return {
+            'engine': self.name,
+            'languages': sorted(tesserocr.get_languages(self.path)[1]),
+            'tesseract_version': tesserocr.tesseract_version().split()[1].split('-')[0],
+        }
+
+    def _create(self, lang: str):
+        logging.debug(f'tesserocr init handle for {lang}')
+        return tesserocr.PyTessBaseAPI(path=self.path, lang=lang)
+
+    def _evict(self):
+        # ends the least recently used idle handles, until the pool has free capacity
+        while sum(len(handles) for handles in self._idle.values()) > self.pool_size:
+            lang, handles = next(iter(self._idle.items()))
+            handles.pop(0).End()
+            if not handles:
+                del self._idle[lang]
+            logging.debug(f'tesserocr evicted handle for {lang}')
+
+    @contextmanager
+    def _api(self, lang: str, config: List[str]):
+        psm, variables = parse_config(config)
+        with self._lock:
+            handles = self._idle.get(lang)
+            api = handles.pop() if handles else None
+        if api is None:
+            api = self._create(lang)
+
+        # remembering the defaults, as the handle is reused with other options
+        defaults = {name: api.GetVariableAsString(name) for name in variables}
+        ok = False
+        try:
+            api.SetPageSegMode(psm if psm is not None else tesserocr.PSM.AUTO)
+            for name, value in variables.items():
+                if not api.SetVariable(name, value):
+                    raise ValueError(f'unsupported tesseract variable `{name}`')
+            yield api
+            ok = True
+        except deadline.DeadlineExceeded:
+            # cancelled by tesseract itself, `Clear` resets the handle
+            ok = True
+            raise
+        finally:
+            api.Clear()
+            for name, value in defaults.items():
+                if value is not None:
+                    api.SetVariable(name, value)
+            if not ok:
+                # not reusing a handle in an unknown state
+                api.End()
+            else:
+                with self._lock:
+                    self._idle.setdefault(lang, []).append(api)
+                    self._idle.move_to_end(lang)
+                    self._evict()
+
+    @timed
+    def image_to_data(self, image, lang: str, config: List[str]) -> str:
+        rows = [TSV_HEADER + '\n']
+        with self._api(lang, config) as api:
+            for page_number, page in enumerate(read_image_list(image)):
+                if isinstance(page, Image.Image):
+                    api.SetImage(page)
+                else:
+                    api.SetImageFile(page)
+                timeout = timeout_ms()
+                if not api.Recognize(timeout=timeout) and cancelled(timeout):
+                    raise deadline.exceeded('ocr')
+                rows.append(api.GetTSVText(page_number))
+        return ''.join(rows)
+
+    @timed
+    def image_to_pdf(self, image, lang: str, config: List[str]) -> bytes:
+        with tempfile.TemporaryDirectory(dir=TMP_DIR) as tmp_dir:
+            if isinstance(image, list):
+                # the pdf renderer only works with files
+                image_path = os.path.join(tmp_dir, 'input.tif')
+                image[0].save(image_path, format='TIFF', save_all=True, append_images=image[1:])
+            elif isinstance(image, Image.Image):
+                image_path = os.path.join(tmp_dir, 'input.png')
+                image.save(image_path, format='PNG')
+            else:
+                image_path = image
+            with open(self._process_pages(image_path, lang, config, os.path.join(tmp_dir, 'output')), 'rb') as file:
+                return file.read()
+
+    @timed
+    def image_to_pdf_file(self, image_list: str, lang: str, config: List[str], output_base: str) -> str:
+        return self._process_pages(image_list, lang, config, output_base)
+
+    def _process_pages(self, image_list: str, lang: str, config: List[str], output_base: str) -> str:
+        with self._api(lang, config) as api:
+            api.SetVariable('tessedit_create_pdf', '1')
+            try:
+                # pages are read and appended one after another, the timeout applies to each page
+                timeout = timeout_ms()
+                if not api.ProcessPages(output_base, image_list, timeout=timeout):
+                    # not falling back to pytesseract when cancelled
+                    if cancelled(timeout):
+                        raise deadline.exceeded('ocr')
+                    raise RuntimeError('tesserocr failed to create the PDF')
+            finally:
+                api.SetVariable('tessedit_create_pdf', '0')
+        return f'{output_base}.pdf'
+
+
+class FallbackEngine:
+    """
+    Uses the `primary` engine, but falls back to `fallback` when e.g. a handle can't be initialized.
+    """
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = primary.name
+        self.max_parallel = primary.max_parallel
+
+    def info(self) -> Dict:
+        try:
+            return self.primary.info()
+        except Exception as e:
+            logging.warning(f'{self.primary.name} failed, using {self.fallback.name}: {e}')
+            return self.fallback.info()
+
+    def image_to_data(self, image, lang: str, config: List[str]) -> str:
+        try:
+            return self.primary.image_to_data(image, lang, config)
+        except RuntimeError as e:
+            logging.warning(f'{self.primary.name} failed, using {self.fallback.name}: {e}')
+            return self.fallback.image_to_data(image, lang, config)
+
+    def image_to_pdf(self, image, lang: str, config: List[str]) -> bytes:
+        try:
+            return self.primary.image_to_pdf(image, lang, config)
+        except RuntimeError as e:
+            logging.warning(f'{self.primary.name} failed, using {self.fallback.name}: {e}')
+            return self.fallback.image_to_pdf(image, lang, config)
+
+    def image_to_pdf_file(self, image_list: str, lang: str, config: List[str], output_base: str) -> str:
+        try:
+            return self.primary.image_to_pdf_file(image_list, lang, config, output_base)
+        except RuntimeError as e:
+            logging.warning(f'{self.primary.name} failed, using {self.fallback.name}: {e}')
+            return self.fallback.image_to_pdf_file(image_list, lang, config, output_base)
+
+
+_engine = None
+
+
+def get_engine():
+    """
+    The engine of this process, configured with `OCR_ENGINE`: `auto` (default), `tesserocr` or `pytesseract`.
+    """
+    global _engine
+    if _engine is not None:
+        return _engine
+
+    engine_name = os.environ.get('OCR_ENGINE', 'auto')
+    if engine_name not in ('auto', 'tesserocr', 'pytesseract'):
+        raise ValueError(f'unsupported OCR_ENGINE `{engine_name}`')
+    if engine_name == 'tesserocr' and tesserocr is None:
+        raise RuntimeError('OCR_ENGINE `tesserocr` requires the `tesserocr` package')
+
+    if engine_name != 'pytesseract' and tesserocr is not None:
+        _engine = FallbackEngine(
+            TesserocrEngine(
+                pool_size=int(os.environ.get('OCR_ENGINE_POOL_SIZE', '2')),
+                path=os.environ.get('TESSDATA_PREFIX', '/usr/share/tesseract-ocr/5/tessdata/'),
+            ),
+            PytesseractEngine(),
+        )
+    else:
+        _engine = PytesseractEngine()
+    logging.info(f'using OCR engine {_engine.name}')
+    return _engine
+
+
+_info: Optional[Dict] = None
+_info_lock = threading.Lock()
+
+
+def get_engine_info(refresh=False) -> Dict:
+    """
+    Languages and version of the engine, probed once per process and cached until `refresh`.
+
+    Probed in the gunicorn master when preloading, thus the forked workers start with it.
+    """
+    global _info
+    with _info_lock:
+        if _info is None or refresh:
+            engine = get_engine()
+            with Stage('engine_info', engine=engine.name):
+                _info = {**engine.info(), 'probed_at': time.time()}
+        return _info
@@ -0,0 +1,67 @@
+import functools
+import json
+import logging
+import signal
+import sys
+from typing import Dict, List
+
+from werkzeug.datastructures import FileStorage
+
+from helpers import deadline, jobs, limits, usages
+from helpers.ocr import process_first_page, process_request, ocr_to_pdf
+
+
+def with_usages(handler):
+    # the stages of each job are collected like for a request
+    @functools.wraps(handler)
+    def wrapper(files: List[FileStorage], options: Dict):
+        usages.start()
+        try:
+            # queued jobs wait for the memory of running requests and jobs instead of failing,
+            # only limited by the `deadline` option, as they don't block a request
+            with deadline.within(options.get('deadline')), limits.admit(files, options, all_pages_held=True, wait=None):
+                return handler(files, options)
+        except deadline.DeadlineExceeded as e:
+            usages.DEADLINE_EXCEEDED.labels(e.stage).inc()
+            raise
+        finally:
+            usages.stop()
+    return wrapper
+
+
+@with_usages
+def handle_ocr(files: List[FileStorage], options: Dict):
+    page = process_first_page(files[0], options)
+    return 'application/json', json.dumps({
+        '_usages': usages.current(),
+        'outcome': page,
+    }).encode()
+
+
+@with_usages
+def handle_ocr_batch(files: List[FileStorage], options: Dict):
+    pages = process_request(files, options)
+    return 'application/json', json.dumps({
+        '_usages': usages.current(),
+        'outcome': pages,
+    }).encode()
+
+
+@with_usages
+def handle_ocr_to_pdf(files: List[FileStorage], options: Dict):
+    return 'application/pdf', ocr_to_pdf(files[0], options)
+
+
+jobs.register_handler('ocr', handle_ocr)
+jobs.register_handler('ocr-batch', handle_ocr_batch)
+jobs.register_handler('ocr-to-pdf', handle_ocr_to_pdf)
+
+if __name__ == '__main__':
+    # dedicated worker process, the default for running jobs: `python -m helpers.ocr_jobs`
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    jobs.start_workers(max(1, jobs.JOBS_PROCESS_WORKERS))
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: jobs.stop_workers())
+    try:
+        jobs.wait_workers()
+    except KeyboardInterrupt:
+        jobs.stop_workers()
@@ -1,215 +1,685 @@
+import io
 import logging
-from typing import Optional
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 from PIL import Image
 from pytesseract.pytesseract import prepare
+from werkzeug.utils import secure_filename
 
 import cv2
 import numpy as np
 
+from helpers import deadline
+from helpers.font_find_size import estimate_glyph_height
+from helpers.limits import check_pixels, file_source, reduction, TooLarge
+from helpers.usages import Stage, BINARIZATION
 
-def optimize_image(file, optimize=False, output_base: Optional[str] = None):
+# height of lowercase letters in pixels pages are scaled to, when the estimated height is far off, `0` disables the scaling
+GLYPH_HEIGHT_TARGET = int(os.environ.get('GLYPH_HEIGHT_TARGET', '24'))
+# max. pixels of an upscaled page
+GLYPH_UPSCALE_MAX_PIXELS = 40_000_000
+
+# gray levels at both ends which count as ink or paper for the already-binary detection
+PAPER_LEVELS = 16
+BINARY_MIN_SHARE = 0.99
+# between-class variance of Otsu's threshold relative to the total variance, `1` for exactly two gray levels
+BIMODAL_MIN_SEPARABILITY = float(os.environ.get('PREPROCESS_BIMODAL_MIN', '0.92'))
+
+# bytes of scratch arrays each thread keeps for the next pages, `0` disables reusing them
+PREPROCESS_BUFFERS_MB = int(os.environ.get('PREPROCESS_BUFFERS_MB', '64'))
+
+# increase when changing the preprocessing results, invalidates cached OCR results
+PREPROCESS_VERSION = f'4:{GLYPH_HEIGHT_TARGET}:{BIMODAL_MIN_SEPARABILITY}'
+
+
+# decoder flags per reduction of the resolution
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def optimize_image(file, optimize: Union[bool, str] = False, output_base: Optional[str] = None):
     input_file_name = f'{file.filename}'
-    img_bytes = np.frombuffer(file.read(), dtype='uint8')
-    image = cv2.imdecode(img_bytes, cv2.IMREAD_COLOR)
-    initial_brightness = image.mean()
+    image, scale = optimize_image_bytes(file_source(file), input_file_name, optimize, output_base)
+    return to_pil_image(image, input_file_name, output_base, scale)
 
-    # Detect white-on-black or dark-mode images
-    if initial_brightness < 100:
-        # Invert the image (assuming it's originally white-on-black)
-        image = cv2.bitwise_not(image)
 
-    if optimize:
-        alpha = 1.1  # Controls contrast (1.0 is neutral)
-        beta = 0  # Controls brightness (0 is neutral)
+def decode_image(data: Union[bytes, str], input_file_name: str) -> Tuple[np.ndarray, float]:
+    """
+    Decodes straight to grayscale, as the preprocessing only uses that; large images at a reduced resolution.
+
+    `data` is the content or the path of the file, returns the image and its scale.
+    """
+    deadline.check('decode')
+    with Stage('decode', file=input_file_name) as info:
+        try:
+            with Image.open(data if isinstance(data, str) else io.BytesIO(data)) as header:
+                width, height = header.size
+        except Image.DecompressionBombError as e:
+            raise TooLarge(f'{input_file_name}: {e}')
+        except Exception:
+            # unsupported by PIL, left to OpenCV
+            width, height = 0, 0
+        check_pixels(width, height, input_file_name)
+        factor = reduction(width * height)
+        if isinstance(data, str):
+            image = cv2.imread(data, REDUCED_GRAYSCALE[factor])
+        else:
+            image = cv2.imdecode(np.frombuffer(data, dtype='uint8'), REDUCED_GRAYSCALE[factor])
+        if image is None:
+            raise ValueError(f'Unsupported or broken image {input_file_name}')
+        info['width'] = width or image.shape[1]
+        info['height'] = height or image.shape[0]
+        if factor != 1:
+            info['reduced'] = factor
+    return image, 1.0 / factor
+
+
+def optimize_image_bytes(
+    data: Union[bytes, str], input_file_name: str, optimize: Union[bool, str] = False, output_base: Optional[str] = None, return_normalized=False,
+) -> Union[Tuple[np.ndarray, float], Tuple[np.ndarray, float, np.ndarray]]:
+    """
+    Decodes and optimizes the image, `data` is its content or path; returns the grayscale image as array and the scale applied to it,
+    with `return_normalized` also the page before the steps, see `optimize_image_array`.
+    """
+    image, decode_scale = decode_image(data, input_file_name)
+    image, scale, *normalized = optimize_image_array(image, input_file_name, optimize, output_base, owned=True, return_normalized=return_normalized)
+    return (image, scale * decode_scale, *normalized)
+
+
+def normalize_resolution(image: np.ndarray, input_file_name: str, state: Optional['PreprocessState'] = None) -> Tuple[np.ndarray, float, Optional[float]]:
+    """
+    Scales the image so the letters are about `GLYPH_HEIGHT_TARGET` high when they are much larger, tiny letters are scaled up to two thirds of it.
+
+    Returns the image, the applied scale and the letter height in the returned image, `None` if unknown.
+    """
+    if not GLYPH_HEIGHT_TARGET:
+        return image, 1.0, None
+    glyph_height = estimate_glyph_height(image)
+    if glyph_height is None:
+        return image, 1.0, None
+
+    scale = 1.0
+    if glyph_height > GLYPH_HEIGHT_TARGET * 1.5:
+        # most uploads are scanned with a much higher resolution than needed
+        scale = GLYPH_HEIGHT_TARGET / glyph_height
+    elif glyph_height < GLYPH_HEIGHT_TARGET / 3 and image.shape[0] * image.shape[1] * (GLYPH_HEIGHT_TARGET / glyph_height) ** 2 <= GLYPH_UPSCALE_MAX_PIXELS:
+        # tiny text is recognized badly, but upscaling is expensive for everything after it, thus only to the lower end
+        scale = GLYPH_HEIGHT_TARGET * 2 / 3 / glyph_height
+    logging.debug(f'glyph height {glyph_height:.1f} | scale {scale:.3f} | {input_file_name}')
+    if scale == 1.0:
+        return image, scale, glyph_height
+
+    size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+    dst = state.out((size[1], size[0])) if state else None
+    image = cv2.resize(image, size, dst=dst, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    return image, scale, glyph_height * scale
+
+
+def block_size(base: int, glyph_height: Optional[float]) -> int:
+    # the tuned block sizes fit letters of about `GLYPH_HEIGHT_TARGET`, adapted for pages which aren't scaled
+    if not glyph_height or not GLYPH_HEIGHT_TARGET:
+        return base
+    return max(3, round(base * glyph_height / GLYPH_HEIGHT_TARGET) | 1)
+
+
+def clahe_grid(base: int, image: np.ndarray, glyph_height: Optional[float]) -> Tuple[int, int]:
+    # tiles should span multiple text lines, too small tiles over-enhance the inside of large letters
+    if not glyph_height:
+        return base, base
+    grid = max(1, min(base, min(image.shape[:2]) // round(glyph_height * 8)))
+    return grid, grid
+
+
+class Buffers:
+    """
+    Scratch arrays of the pipeline by shape, reused for the next results instead of allocating a full page for each of them.
+
+    Per thread, as the steps run in the request threads and the preprocess pool; pages of a batch mostly have the same size.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.free: Dict[Tuple[int, ...], List[np.ndarray]] = {}
+        self.size = 0
+
+    def take(self, shape: Tuple[int, ...]) -> np.ndarray:
+        arrays = self.free.get(shape)
+        if arrays:
+            array = arrays.pop()
+            self.size -= array.nbytes
+            return array
+        return np.empty(shape, np.uint8)
+
+    def give(self, array: np.ndarray):
+        if array.nbytes > self.max_bytes:
+            return
+        # moved to the end, the least recently used shapes are dropped first
+        self.free[array.shape] = self.free.pop(array.shape, [])
+        self.free[array.shape].append(array)
+        self.size += array.nbytes
+        while self.size > self.max_bytes:
+            shape = next(iter(self.free))
+            self.size -= self.free[shape].pop(0).nbytes
+            if not self.free[shape]:
+                del self.free[shape]
+
+
+def get_buffers() -> Optional[Buffers]:
+    if not PREPROCESS_BUFFERS_MB:
+        return None
+    if not hasattr(_local, 'buffers'):
+        _local.buffers = Buffers(PREPROCESS_BUFFERS_MB * 1024 * 1024)
+    return _local.buffers
+
+
+class PreprocessState:
+    """
+    What the steps know about the page, filled while the pipeline runs.
+    """
+
+    def __init__(self, input_file_name: str, analysis: Dict[str, bool], glyph_height: Optional[float], output_base: Optional[str]):
+        self.input_file_name = input_file_name
+        self.analysis = analysis
+        self.glyph_height = glyph_height
+        self.output_base = output_base
+        # the profile, `auto` replaces it with the branch of its heuristics
+        self.branch = 'none'
+        # steps not applied, with the reason of the pre-analysis
+        self.skipped: List[Tuple[str, str]] = []
+        # of the steps of the profile, without the steps which composite steps like `auto` run
+        self.skipped_top = 0
+        # while a step runs, its nested steps aren't steps of the profile
+        self.nested = False
+        self.buffers = get_buffers()
+        # the arrays only the pipeline refers to by their id, which may be overwritten and given back to `buffers`
+        self.owned: Dict[int, np.ndarray] = {}
+
+    def save(self, image: np.ndarray, step_name: str):
+        if self.output_base:
+            cv2.imwrite(f'{self.output_base}{step_name}_{self.input_file_name}', image)
+
+    def out(self, shape: Tuple[int, ...]) -> Optional[np.ndarray]:
+        """
+        An array for the `dst` of an OpenCV function, `None` lets OpenCV allocate it.
+        """
+        if self.buffers is None:
+            return None
+        array = self.buffers.take(shape)
+        self.owned[id(array)] = array
+        return array
+
+    def out_like(self, image: np.ndarray) -> Optional[np.ndarray]:
+        return self.out(image.shape)
+
+    def in_place(self, image: np.ndarray) -> Optional[np.ndarray]:
+        # for functions which compute each pixel only from the same pixel of their input
+        if self.buffers is not None and id(image) in self.owned:
+            return image
+        return self.out_like(image)
+
+    def own(self, image: np.ndarray):
+        # e.g. the decoded image, which the caller doesn't use anymore
+        if self.buffers is not None and image.dtype == np.uint8 and image.flags.c_contiguous and image.flags.writeable:
+            self.owned[id(image)] = image
+
+    def release(self, image: np.ndarray):
+        if self.owned.pop(id(image), None) is not None:
+            self.buffers.give(image)
+
+    def detach(self, image: np.ndarray) -> np.ndarray:
+        # the result is handed to the caller, e.g. shared by the PIL image, and not reused
+        self.owned.pop(id(image), None)
+        return image
+
+
+class Step(NamedTuple):
+    fn: Callable[[np.ndarray, PreprocessState], np.ndarray]
+    # results of the pre-analysis for which the step can't improve the page
+    skip_when: Tuple[str, ...] = ()
+
+
+STEPS: Dict[str, Step] = {}
+
+
+def step(name: str, skip_when: Tuple[str, ...] = ()):
+    def register(fn):
+        STEPS[name] = Step(fn, skip_when)
+        return fn
+    return register
+
+
+# all profiles start with the grayscale page, inverted when it is mostly dark
+PROFILES: Dict[str, List[str]] = {
+    'none': [],
+    # the tuned heuristics, used for `optimize_images: true`
+    'auto': ['contrast', 'auto'],
+    'clahe': ['contrast', 'clahe'],
+    'bilateral': ['contrast', 'bilateral'],
+    'threshold': ['contrast', 'threshold'],
+    'bright': ['contrast', 'bright'],
+    'clahe+threshold': ['contrast', 'clahe_threshold', 'dilate_erode'],
+    'equalhist': ['contrast', 'equalhist', 'dilate_erode'],
+    'otsu': ['otsu'],
+}
+
+DILATE_KERNEL = np.ones((2, 2), np.uint8)
+
+_local = threading.local()
+
+
+def get_clahe(clip_limit: float, grid: Tuple[int, int]):
+    # CLAHE objects keep buffers between `apply` calls, thus they are cached per thread
+    cache = _local.__dict__.setdefault('clahe', {})
+    key = (clip_limit, grid)
+    if key not in cache:
+        if len(cache) >= 32:
+            del cache[next(iter(cache))]
+        cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=grid)
+    return cache[key]
+
 
-        image = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-        if output_base:
-            cv2.imwrite(f'{output_base}t0_{input_file_name}', image)
+def analyze(image: np.ndarray) -> Dict[str, bool]:
+    """
+    Pre-analysis of the grayscale page by its histogram: `binary` for bilevel scans, `bimodal` for evenly lit pages with clear text.
+    """
+    histogram = cv2.calcHist([image], [0], None, [256], [0, 256]).ravel()
+    return {
+        'binary': bool((histogram[:PAPER_LEVELS].sum() + histogram[-PAPER_LEVELS:].sum()) / histogram.sum() >= BINARY_MIN_SHARE),
+        'bimodal': otsu_separability(histogram) >= BIMODAL_MIN_SEPARABILITY,
+    }
 
-        # if initial_brightness < 220:
-        #     # lighten very slightly
-        #     if initial_brightness < 200:
-        #         gamma = 0.98
-        #     else:
-        #         gamma = 0.99
-        #     image = np.uint8(np.power(image / 255.0, gamma) * 255.0)
 
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)  # threshold expects grayscale
+def otsu_separability(histogram: np.ndarray) -> float:
+    """
+    How well Otsu's threshold splits the histogram into two classes, `0` to `1`.
+    """
+    total = histogram.sum()
+    if not total:
+        return 0.0
+    probabilities = histogram / total
+    levels = np.arange(len(histogram))
+    weights = np.cumsum(probabilities)
+    means = np.cumsum(probabilities * levels)
+    mean = means[-1]
+    variance = (probabilities * (levels - mean) ** 2).sum()
+    if not variance:
+        return 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean * weights - means) ** 2 / (weights * (1 - weights))
+    return float(np.nanmax(between[:-1]) / variance)
 
+
+def profile_name(preprocess: Union[bool, str]) -> str:
+    if isinstance(preprocess, bool):
+        return 'auto' if preprocess else 'none'
+    return preprocess if preprocess in PROFILES else 'steps'
+
+
+def preprocess_steps(preprocess: Union[bool, str]) -> List[str]:
+    """
+    The steps for a profile name or comma separated step names, `True` is `auto` and `False` is `none`.
+    """
+    profile = profile_name(preprocess)
+    if profile != 'steps':
+        return PROFILES[profile]
+    names = [name.strip() for name in preprocess.split(',') if name.strip()]
+    unknown = [name for name in names if name not in STEPS]
+    if unknown or not names:
+        raise ValueError(f'unknown preprocessing `{preprocess}`, use one of {list(PROFILES)} or comma separated steps of {list(STEPS)}')
+    return names
+
+
+def is_skipped(names: List[str], state: PreprocessState) -> bool:
+    return all(any(state.analysis[reason] for reason in STEPS[name].skip_when) for name in names)
+
+
+def run_steps(image: np.ndarray, names: List[str], state: PreprocessState) -> np.ndarray:
+    nested = state.nested
+    for name in names:
+        # between the steps, a single one isn't interrupted
+        deadline.check('preprocess')
+        current = STEPS[name]
+        reason = next((reason for reason in current.skip_when if state.analysis[reason]), None)
+        if reason:
+            state.skipped.append((name, reason))
+            if not nested:
+                state.skipped_top += 1
+            continue
+        state.nested = True
+        try:
+            result = current.fn(image, state)
+        finally:
+            state.nested = nested
+        if result is not image:
+            state.release(image)
+        image = result
+        state.save(image, name)
+    return image
+
+
+@step('contrast', skip_when=('binary',))
+def contrast(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # alpha controls the contrast (1.0 is neutral), beta the brightness (0 is neutral)
+    # if initial_brightness < 220:
+    #     # lighten very slightly
+    #     if initial_brightness < 200:
+    #         gamma = 0.98
+    #     else:
+    #         gamma = 0.99
+    #     image = np.uint8(np.power(image / 255.0, gamma) * 255.0)
+    return cv2.convertScaleAbs(image, dst=state.in_place(image), alpha=1.1, beta=0)
+
+
+# cv2.ADAPTIVE_THRESH_GAUSSIAN_C:
+# - suitable when the document has varying lighting conditions, such as shadows or uneven lighting
+# - can help preserve finer details and text readability, especially for small and bold fonts
+# - due to the Gaussian weighting, tends to provide smoother results
+# cv2.ADAPTIVE_THRESH_MEAN_C:
+# - performs well on documents with uniform lighting
+# - can be effective for normal fonts but may lose some details with bold fonts, especially in the presence of skewed text
+# - can result in sharper transitions between foreground (text) and background.
+
+# - `binary_method` `threshold` seems to work better for small bold
+# - softer modifications yielded better results for bigger fonts and already good input, cropped to text-boxes (clahe/None)
+# - harder modifications yielded better results for very small fonts or complex/dirty input
+# steps of `auto` per branch, the other variants are kept for experimenting
+METHOD_STEPS = {
+    'clahe': ['clahe'],
+    'bilateral': ['bilateral'],
+    'threshold': ['threshold'],
+    None: [],
+}
+DARK_STEPS = {
+    'clahe': ['clahe_dark'],
+    'bilateral': ['bilateral_dark'],
+    'threshold': ['gaussian_threshold'],
+    'equalhist': ['equalhist', 'dilate_erode'],
+    'clahe+threshold': ['clahe_threshold', 'dilate_erode'],
+}
+BINARY_METHOD = 'clahe'
+BINARY_DARK = 'clahe'
+
+
+@step('auto', skip_when=('binary',))
+def auto_binarize(image: np.ndarray, state: PreprocessState) -> np.ndarray:
     brightness = image.mean()
+    if brightness <= 231 and all(is_skipped(names, state) for names in (DARK_STEPS[BINARY_DARK], METHOD_STEPS[BINARY_METHOD])):
+        # the dark and the default branch wouldn't change the page, thus the darkest areas aren't needed
+        image = run_steps(image, DARK_STEPS[BINARY_DARK], state)
+        state.branch = f'skip:{state.skipped[-1][1]}'
+        return image
 
     # todo: the rect area should be calculated based on the dpi on the input image and maybe font size in segment
-    white_balance_darkest = find_darkest_areas(image, rect=3)
-    logging.debug(f'brightness {initial_brightness} | {white_balance_darkest} < {brightness} | {(image.shape[0], image.shape[1])} | {input_file_name}')
-
-    # cv2.ADAPTIVE_THRESH_GAUSSIAN_C:
-    # - suitable when the document has varying lighting conditions, such as shadows or uneven lighting
-    # - can help preserve finer details and text readability, especially for small and bold fonts
-    # - due to the Gaussian weighting, tends to provide smoother results
-    # cv2.ADAPTIVE_THRESH_MEAN_C:
-    # - performs well on documents with uniform lighting
-    # - can be effective for normal fonts but may lose some details with bold fonts, especially in the presence of skewed text
-    # - can result in sharper transitions between foreground (text) and background.
-
-    # - `binary_method` `threshold` seems to work better for small bold
-    # - softer modifications yielded better results for bigger fonts and already good input, cropped to text-boxes (clahe/None)
-    # - harder modifications yielded better results for very small fonts or complex/dirty input
-    binary_method = 'clahe'  # clahe, bilateral, threshold, None
-    binary_dark = 'clahe'  # clahe, bilateral, threshold, clahe+threshold
-    if optimize:
-        # todo: the letter sparsity should influence the `white_balance_darkest` threshold,
-        #       wider letter-spacings but bold text has higher white-balance,
-        #       but such dark texts would also benefit for serif or complex fonts
-        if white_balance_darkest < 0.086 or brightness < 200:
-            logging.debug(f'binary_dark {binary_dark}')
-            # assumption: when a small area is dark or in general darker-than-white,
-            # the text is most likely a fatter font
-            if output_base:
-                cv2.imwrite(f'{output_base}t1_{input_file_name}', image)
-
-            # todo: clahe and bilateral should be configured based on the input image dpi
-            # todo: also the blockSize of adaptiveThreshold would benefit from letter sizes
-            if binary_dark == 'clahe':
-                clahe = cv2.createCLAHE(clipLimit=1.4, tileGridSize=(6, 6))
-                image = clahe.apply(image)
-            elif binary_dark == 'bilateral':
-                image = cv2.bilateralFilter(image, d=6, sigmaColor=40, sigmaSpace=60)
-            elif binary_dark == 'equalhist':
-                # > equalizeHist introduces more artifacts than clahe+threshold on grayish backgrounds
-                image = cv2.equalizeHist(image)
-                if output_base:
-                    cv2.imwrite(f'{output_base}eqh_{input_file_name}', image)
-                image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2)
-                # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-            elif binary_dark == 'clahe+threshold':
-                # clahe = cv2.createCLAHE(clipLimit=1.5, tileGridSize=(6, 6))
-                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(6, 6))
-                image = clahe.apply(image)
-                if output_base:
-                    cv2.imwrite(f'{output_base}cl0_{input_file_name}', image)
-                # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-                # THRESH_MEAN seems to work better with preserving details at edges,
-                # e.g. § in bigger fonts is mostly detected as 8 with GAUSSIAN (blockSize 11, clip 2.0/tileGrid 6,6 + dilate-erode)
-                # > but same result was already "only `equalizeHist`" and better for equalHist + dilate-erode
-                image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2)
-                # if white_balance_darkest < 0.042 or brightness < 200:
-                #     # for low general white balance, more background focus for more area normalization
-                #     # - benefits white-on-dark artifact reduction
-                #     image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2.0)
-                # else:
-                #     # todo: check if used at all and for these if useful
-                #     image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 7, 1.97)
-            else:
-                image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-
-            if output_base:
-                cv2.imwrite(f'{output_base}t2_{input_file_name}', image)
-
-            if binary_dark == 'clahe+threshold' or binary_dark == 'equalhist':
-                # dilate+erode only seem to make sense for bigger fonts,
-                # needs e.g. min. "char size" to check when to use,
-                # maybe also requires config based on the input image dpi
-                # seems to be useful to make large bold letters better, together with clahe+threshold
-                kernel = np.ones((2, 2), np.uint8)
-                dil_image = cv2.dilate(image, kernel, iterations=1)
-                er_image = cv2.erode(dil_image, kernel, iterations=1)
-                if output_base:
-                    cv2.imwrite(f'{output_base}dil_{input_file_name}', dil_image)
-                    cv2.imwrite(f'{output_base}er_{input_file_name}', er_image)
-
-                image = er_image
-        elif brightness > 231:
-            logging.debug(f'binary bright')
-            # ~233-237 may be light-typos
-            # ~230-233 may be light colors
-            # todo: decrease the threshold to ~232 when supporting font-size based conditions
-            # todo: this makes very light-typos in light colors in small sizes very bad (equalHist)
-            # assumption: very light image suggests very light colored text
-            # less likely to cause clipping or over-enhancement of very light grayscale values for low clipLimits
-            # assumption: the darker, the more it could be light-typo not light-text
-            clahe = cv2.createCLAHE(clipLimit=2.6 if brightness > 238 else 2.4 if brightness > 234 else 2.2, tileGridSize=(4, 4))
-            image = clahe.apply(image)
-            if output_base:
-                cv2.imwrite(f'{output_base}eqh_{input_file_name}', image)
-            # gaussian threshold as (maybe small) light text is darkened first to reduce artifacts
-            # note: gaussian not helpful for light color+typo
-            if brightness > 236:
-                # adapt. gauss. blockSize=3 C=1.8 for very small, light color + light typo
-                image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 3, 1.85)
-            else:
-                # adapt. gauss. blockSize=7 C=1.9 for between-small-and-normal, light-to-normal color + normal typo
-                # especially lower blockSizes had too many artifacts from clahe
-                image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 7, 1.9)
-            # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-            # if output_dir:
-            #     cv2.imwrite(f'{output_base}eqhtr_{input_file_name}', image)
-            # todo: add blur again, only for bigger fonts
-            # image = cv2.GaussianBlur(image, (3, 3), 0)  # very slight blur for artifact reduction
-        else:
-            logging.debug(f'binary_method {binary_method}')
-            # todo: clahe and bilateral should be configured based on the input image dpi
-            # todo: add here also a clahe+threshold variant
-            if binary_method == 'clahe':
-                # 4,4 is too small for most title fonts
-                clahe = cv2.createCLAHE(clipLimit=2 if brightness > 216 else 1.6, tileGridSize=(6, 6))
-                image = clahe.apply(image)
-            elif binary_method == 'bilateral':
-                image = cv2.bilateralFilter(image, d=4, sigmaColor=40, sigmaSpace=70)
-            elif binary_method == 'threshold':
-                # todo: try out when found problematic smaller fonts if `ADAPTIVE_THRESH_GAUSSIAN_C` works better in general;
-                #       edit: mean seems to make problems with smaller, rather light, skewed texts (but GAUSSIAN is not really better)
-                #       edit: but gaussian makes typical scientific fonts very bad it seems
-                # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-                # todo: improve with font size checks, for light-typos (not light colors) not really usable as default
-                # `blockSize=5` looks best for small font, but has more artifacts
-                # `blockSize=7` looks best for normal font, but has destroys more light-typos
-                # image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 11, 2)
-                # todo: validate that very small clahe appliance with medium grid-size helps the default for light colors/typos
-                # clahe = cv2.createCLAHE(clipLimit=1.3, tileGridSize=(6, 6))
-                # image = clahe.apply(image)
-                # todo: experiment with lower C values as default for lighter/serif texts
-                image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 1.9)
-                # image = cv2.GaussianBlur(image, (3, 3), 0)  # very slight blur for artifact reduction
+    with Stage('darkest_areas', file=state.input_file_name):
+        white_balance_darkest = find_darkest_areas(image, rect=3)
+    logging.debug(f'{white_balance_darkest} < {brightness} | {(image.shape[0], image.shape[1])} | {state.input_file_name}')
+
+    # todo: the letter sparsity should influence the `white_balance_darkest` threshold,
+    #       wider letter-spacings but bold text has higher white-balance,
+    #       but such dark texts would also benefit for serif or complex fonts
+    if white_balance_darkest < 0.086 or brightness < 200:
+        # assumption: when a small area is dark or in general darker-than-white,
+        # the text is most likely a fatter font
+        logging.debug(f'binary_dark {BINARY_DARK}')
+        state.branch = f'dark:{BINARY_DARK}'
+        return run_steps(image, DARK_STEPS[BINARY_DARK], state)
+    if brightness > 231:
+        # ~233-237 may be light-typos
+        # ~230-233 may be light colors
+        # todo: decrease the threshold to ~232 when supporting font-size based conditions
+        logging.debug(f'binary bright')
+        state.branch = 'bright'
+        return run_steps(image, ['bright'], state)
+    logging.debug(f'binary_method {BINARY_METHOD}')
+    state.branch = f'default:{BINARY_METHOD}'
+    return run_steps(image, METHOD_STEPS[BINARY_METHOD], state)
+
+
+@step('clahe_dark', skip_when=('binary', 'bimodal'))
+def clahe_dark(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    return get_clahe(1.4, clahe_grid(6, image, state.glyph_height)).apply(image, state.out_like(image))
+
+
+@step('bilateral_dark', skip_when=('binary', 'bimodal'))
+def bilateral_dark(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    return cv2.bilateralFilter(image, d=6, sigmaColor=40, sigmaSpace=60, dst=state.out_like(image))
+
+
+@step('gaussian_threshold', skip_when=('binary',))
+def gaussian_threshold(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    return cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size(11, state.glyph_height), 2, state.out_like(image))
+
+
+@step('equalhist', skip_when=('binary',))
+def equalhist(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # > equalizeHist introduces more artifacts than clahe+threshold on grayish backgrounds
+    equalized = cv2.equalizeHist(image, state.out_like(image))
+    state.save(equalized, 'eqh')
+    # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # a separate `dst` is also used by `adaptiveThreshold` for the local means
+    image = cv2.adaptiveThreshold(equalized, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size(11, state.glyph_height), 2, state.out_like(equalized))
+    state.release(equalized)
+    return image
+
+
+@step('clahe_threshold', skip_when=('binary',))
+def clahe_threshold(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # clahe = cv2.createCLAHE(clipLimit=1.5, tileGridSize=(6, 6))
+    enhanced = get_clahe(2.0, clahe_grid(6, image, state.glyph_height)).apply(image, state.out_like(image))
+    state.save(enhanced, 'cl0')
+    # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # THRESH_MEAN seems to work better with preserving details at edges,
+    # e.g. § in bigger fonts is mostly detected as 8 with GAUSSIAN (blockSize 11, clip 2.0/tileGrid 6,6 + dilate-erode)
+    # > but same result was already "only `equalizeHist`" and better for equalHist + dilate-erode
+    # if white_balance_darkest < 0.042 or brightness < 200:
+    #     # for low general white balance, more background focus for more area normalization
+    #     # - benefits white-on-dark artifact reduction
+    #     image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 11, 2.0)
+    # else:
+    #     # todo: check if used at all and for these if useful
+    #     image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 7, 1.97)
+    image = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size(11, state.glyph_height), 2, state.out_like(enhanced))
+    state.release(enhanced)
+    return image
+
+
+@step('dilate_erode')
+def dilate_erode(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # dilate+erode only seem to make sense for bigger fonts,
+    # needs e.g. min. "char size" to check when to use,
+    # maybe also requires config based on the input image dpi
+    # seems to be useful to make large bold letters better, together with clahe+threshold
+    dil_image = cv2.dilate(image, DILATE_KERNEL, dst=state.out_like(image), iterations=1)
+    state.save(dil_image, 'dil')
+    image = cv2.erode(dil_image, DILATE_KERNEL, dst=state.out_like(dil_image), iterations=1)
+    state.release(dil_image)
+    return image
+
+
+@step('bright', skip_when=('binary',))
+def bright(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # todo: this makes very light-typos in light colors in small sizes very bad (equalHist)
+    # assumption: very light image suggests very light colored text
+    # less likely to cause clipping or over-enhancement of very light grayscale values for low clipLimits
+    # assumption: the darker, the more it could be light-typo not light-text
+    brightness = image.mean()
+    enhanced = get_clahe(2.6 if brightness > 238 else 2.4 if brightness > 234 else 2.2, clahe_grid(4, image, state.glyph_height)).apply(image, state.out_like(image))
+    state.save(enhanced, 'eqh')
+    # gaussian threshold as (maybe small) light text is darkened first to reduce artifacts
+    # note: gaussian not helpful for light color+typo
+    # image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # todo: add blur again, only for bigger fonts
+    # image = cv2.GaussianBlur(image, (3, 3), 0)  # very slight blur for artifact reduction
+    if brightness > 236:
+        # adapt. gauss. blockSize=3 C=1.8 for very small, light color + light typo
+        image = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size(3, state.glyph_height), 1.85, state.out_like(enhanced))
+    else:
+        # adapt. gauss. blockSize=7 C=1.9 for between-small-and-normal, light-to-normal color + normal typo
+        # especially lower blockSizes had too many artifacts from clahe
+        image = cv2.adaptiveThreshold(enhanced, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size(7, state.glyph_height), 1.9, state.out_like(enhanced))
+    state.release(enhanced)
+    return image
+
+
+@step('clahe', skip_when=('binary', 'bimodal'))
+def clahe(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # 4,4 is too small for most title fonts
+    return get_clahe(2 if image.mean() > 216 else 1.6, clahe_grid(6, image, state.glyph_height)).apply(image, state.out_like(image))
+
+
+@step('bilateral', skip_when=('binary', 'bimodal'))
+def bilateral(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # todo: bilateral should also be configured based on the glyph height
+    return cv2.bilateralFilter(image, d=4, sigmaColor=40, sigmaSpace=70, dst=state.out_like(image))
+
+
+@step('threshold', skip_when=('binary',))
+def threshold(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # todo: try out when found problematic smaller fonts if `ADAPTIVE_THRESH_GAUSSIAN_C` works better in general;
+    #       edit: mean seems to make problems with smaller, rather light, skewed texts (but GAUSSIAN is not really better)
+    #       edit: but gaussian makes typical scientific fonts very bad it seems
+    # todo: improve with font size checks, for light-typos (not light colors) not really usable as default
+    # `blockSize=5` looks best for small font, but has more artifacts
+    # `blockSize=7` looks best for normal font, but has destroys more light-typos
+    # todo: validate that very small clahe appliance with medium grid-size helps the default for light colors/typos
+    # todo: experiment with lower C values as default for lighter/serif texts
+    # image = cv2.GaussianBlur(image, (3, 3), 0)  # very slight blur for artifact reduction
+    return cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size(11, state.glyph_height), 1.9, state.out_like(image))
+
+
+@step('otsu', skip_when=('binary',))
+def otsu(image: np.ndarray, state: PreprocessState) -> np.ndarray:
+    # a single global threshold, enough for evenly lit pages
+    return cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, state.in_place(image))[1]
+
+
+def optimize_image_array(
+    image: np.ndarray, input_file_name: str, optimize: Union[bool, str] = False, output_base: Optional[str] = None, owned=False,
+    return_normalized=False,
+) -> Union[Tuple[np.ndarray, float], Tuple[np.ndarray, float, np.ndarray]]:
+    """
+    Optimizes an already decoded BGR or grayscale image, returns the grayscale image as array and the scale applied to it.
+
+    `optimize` selects the steps, see `preprocess_steps`. With `owned` the caller doesn't use `image` afterwards,
+    it may be overwritten and reused for later pages, else it is left unchanged. With `return_normalized` the grayscale
+    page before the steps is returned third, e.g. for recognizing parts of it again with other steps.
+    """
+    names = preprocess_steps(optimize)
+    deadline.check('preprocess')
+    state = PreprocessState(input_file_name, {'binary': False, 'bimodal': False}, None, output_base)
+    if owned:
+        state.own(image)
+    if len(image.shape) == 3:
+        # first, as everything after it is cheaper with a single channel
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, state.out(image.shape[:2]))
+        state.release(image)
+        image = gray
+    if names:
+        # before scaling, which blurs the edges of bilevel scans
+        with Stage('analyze', file=input_file_name) as info:
+            state.analysis = analyze(image)
+            info.update(state.analysis)
+
+    # before any filtering, as the filters get cheaper with fewer pixels
+    with Stage('normalize', file=input_file_name) as info:
+        normalized, scale, state.glyph_height = normalize_resolution(image, input_file_name, state)
+        if normalized is not image:
+            state.release(image)
+        image = normalized
+        info['glyph_height'] = state.glyph_height
+        info['scale'] = round(scale, 3)
+
+    initial_brightness = image.mean()
+    # Detect white-on-black or dark-mode images
+    if initial_brightness < 100:
+        # Invert the image (assuming it's originally white-on-black)
+        image = cv2.bitwise_not(image, dst=state.in_place(image))
+    logging.debug(f'brightness {initial_brightness} | {(image.shape[0], image.shape[1])} | {input_file_name}')
+
+    # the steps may overwrite the page
+    normalized = image.copy() if return_normalized and names else None
+    state.branch = profile_name(optimize)
+    with Stage('binarize', file=input_file_name, width=image.shape[1], height=image.shape[0]) as info:
+        image = run_steps(image, names, state)
+        if names and state.skipped_top == len(names):
+            # the fast path of the pre-analysis, the page was already good enough for all steps
+            state.branch = f'skip:{state.skipped[-1][1]}'
+        info['branch'] = state.branch
+        info['skipped'] = [name for name, _ in state.skipped]
+    BINARIZATION.labels(state.branch).inc()
 
     # todo: as come images externally are cropped very near text,
     #       maybe add here a white padding, as now its guaranteed to not influence cutting/coloring
-    pil_image = Image.fromarray(image, mode="L")  # L for grayscale
+    image = state.detach(image)
+    if return_normalized:
+        return image, scale, image if normalized is None else normalized
+    return image, scale
+
+
+def to_pil_image(image: np.ndarray, input_file_name: str, output_base: Optional[str] = None, scale=1.0, normalized: Optional[np.ndarray] = None):
+    # L for grayscale, shares the memory of the array instead of copying it
+    image = np.ascontiguousarray(image)
+    pil_image = Image.frombuffer('L', (image.shape[1], image.shape[0]), image, 'raw', 'L', 0, 1)
 
     # applying the default pytesseract image preparation, but storing the image to disk,
     # from disk disables the prep internally and provides batch processing support
     pil_image, extension = prepare(pil_image)
-    # todo: multiple files can have the same name
-    # todo: the extension must be replaced for certain input files
+    # for mapping the boxes back to the coordinates of the input
+    pil_image.info['scale'] = scale
+    if normalized is not None:
+        # the grayscale page before the preprocessing steps, in the same coordinates
+        pil_image.info['normalized'] = normalized
     if output_base:
-        pil_image.save(f'{output_base}{input_file_name}', format=pil_image.format)
+        # the extension of the input file may not match the format
+        pil_image.save(f'{output_base}{Path(secure_filename(input_file_name)).stem}.{extension.lower()}', format=pil_image.format)
     return pil_image
 
 
 def find_darkest_areas(image, rect=5):
+    """
+    Returns the brightness (0-1) of the darkest `rect x rect` area in the image.
+
+    Uses a summed-area table instead of a per-pixel loop, the result is equal to the previous
+    loop-based implementation: the first area (row-major order) with a brightness `<= 0.01` wins,
+    otherwise the overall minimum; the last two rows/columns of area-offsets aren't included.
+    """
     if len(image.shape) == 3 and image.shape[-1] == 3:
         # RGB image
-        height, width, _ = image.shape
+        height, width, channels = image.shape
+        # summing the channels first, only needs a single-channel integral image
+        image = image.sum(axis=2, dtype=np.uint16)
     elif len(image.shape) == 2 or (len(image.shape) == 3 and image.shape[-1] == 1):
         # Grayscale image or single-channel image
-        height, width = image.shape
+        height, width = image.shape[0], image.shape[1]
+        channels = 1
+        image = image.reshape(height, width)
     else:
         raise ValueError("Input image must be RGB, grayscale, or single-channel.")
 
-    min_brightness = float('inf')
-
-    for y in range(height - rect - 1):
-        for x in range(width - rect - 1):
-            if len(image.shape) == 3:
-                area = image[y:y + rect, x:x + rect, :]
-            else:
-                area = image[y:y + rect, x:x + rect]
+    rows = height - rect - 1
+    cols = width - rect - 1
+    if rows <= 0 or cols <= 0:
+        return float('inf')
 
-            brightness = np.mean(area) / 255.0
-            if brightness <= 0.01:
-                return brightness
+    # float64 sums are exact for integers, int32 would overflow for big images
+    integral = cv2.integral(image, sdepth=cv2.CV_64F)
+    sums = (
+        integral[rect:rect + rows, rect:rect + cols]
+        - integral[:rows, rect:rect + cols]
+        - integral[rect:rect + rows, :cols]
+        + integral[:rows, :cols]
+    )
+    brightness = sums / (rect * rect * channels) / 255.0
 
-            if brightness < min_brightness:
-                min_brightness = brightness
+    very_dark = brightness <= 0.01
+    if very_dark.any():
+        return float(brightness.flat[np.argmax(very_dark)])
 
-    return min_brightness
+    return float(brightness.min())
@@ -1,27 +1,50 @@
+import os
 import random
 import string
 
-from helpers.optimize_image import optimize_image
+from helpers.preprocess_pool import optimize_files
+from helpers.usages import Stage
 
+# `memory` passes the images directly to the engine, `disk` stores them in `/tmp` for the engine
+OCR_HANDOFF = os.environ.get('OCR_HANDOFF', 'memory')
 
-def prepare_files(files, optimize=False, save_intermediate=False):
+
+def prepare_images(files, optimize=False, save_intermediate=False, keep_normalized=False):
+    infer_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    output_bases = [f'/app/shared-assets/{infer_id}_{i}_' if save_intermediate else None for i in range(len(files))]
+    return list(optimize_files(files, optimize, output_bases, keep_normalized=keep_normalized)), infer_id
+
+
+def prepare_files(files, optimize=False, save_intermediate=False, keep_normalized=False):
     infer_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    output_bases = [f'/app/shared-assets/{infer_id}_{i}_' if save_intermediate else None for i in range(len(files))]
     paths = []
-    for i, file in enumerate(files):
-        input_file_name = f'{file.filename}'
-        pil_image = optimize_image(file, optimize, f'/app/shared-assets/{infer_id}_{i}_' if save_intermediate else None)
-        # todo: the extension must be replaced for certain input files
-        if save_intermediate:
-            pil_image.save(f'/app/shared-assets/{infer_id}_{i}_{input_file_name}', format=pil_image.format)
-        pil_image.save(f'/tmp/{infer_id}_{i}_{input_file_name}', format=pil_image.format)
-        paths.append(f'/tmp/{infer_id}_{i}_{input_file_name}')
-
-    if len(paths) == 1:
-        # when only a single path, no batch processing needed
-        return paths, paths[0], infer_id
-
-    # creating a text file with all files for batching
-    with open(f'/tmp/{infer_id}.txt', "w") as file:
-        file.write('\n'.join(paths))
-
-    return paths, f'/tmp/{infer_id}.txt', infer_id
+    scales = []
+    # the pages before the preprocessing steps stay in memory, `None` without `keep_normalized`
+    normalized = []
+    list_path = f'/tmp/{infer_id}.txt'
+    try:
+        for i, pil_image in enumerate(optimize_files(files, optimize, output_bases, keep_normalized=keep_normalized)):
+            # not using the filename, as multiple files can have the same name
+            path = f'/tmp/{infer_id}_{i}.{pil_image.format.lower()}'
+            paths.append(path)
+            with Stage('write_temp', file=files[i].filename):
+                pil_image.save(path, format=pil_image.format)
+            scales.append(pil_image.info.get('scale', 1.0))
+            normalized.append(pil_image.info.get('normalized'))
+
+        if len(paths) == 1:
+            # when only a single path, no batch processing needed
+            return paths, paths[0], infer_id, scales, normalized
+
+        # creating a text file with all files for batching
+        with open(list_path, "w") as file:
+            file.write('\n'.join(paths))
+    except BaseException:
+        # the caller only removes the files of a successful call, e.g. a later file may fail to decode
+        for path in [*paths, list_path]:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+
+    return paths, list_path, infer_id, scales, normalized
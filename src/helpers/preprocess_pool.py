@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from helpers import deadline, usages
+from helpers.limits import file_source
+from helpers.optimize_image import optimize_image_bytes, to_pil_image
+from helpers.scheduler import CPUS, WORKERS
+
+
+# processes per gunicorn worker, `0` or `1` disables the pool; by default the workers share the CPUs
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', max(1, CPUS // max(1, WORKERS))))
+# max. files of a single request which are preprocessed at the same time
+PREPROCESS_MAX_PARALLEL = int(os.environ.get('PREPROCESS_MAX_PARALLEL', max(1, PREPROCESS_WORKERS // 2)))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn instead of fork, as forking a process with running cv2/OpenMP threads can deadlock
+        _pool = ProcessPoolExecutor(
+            max_workers=PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+        logging.debug(f'preprocess pool with {PREPROCESS_WORKERS} processes')
+    return _pool
+
+
+def _optimize_to_shared_memory(
+    data: Union[bytes, str], input_file_name: str, optimize: bool, output_base: Optional[str], request_deadline: Optional[deadline.Deadline] = None,
+    keep_normalized=False,
+):
+    # runs in the pool, the result is handed back by shared memory instead of pickling the array
+    stages = usages.start()
+    try:
+        with deadline.restore(request_deadline):
+            image, scale, *normalized = optimize_image_bytes(data, input_file_name, optimize, output_base, return_normalized=keep_normalized)
+    finally:
+        usages.stop()
+    # the page before the steps has the same shape, both are stacked
+    arrays = [image, *normalized]
+    shape = (len(arrays), *image.shape)
+    shm = SharedMemory(create=True, size=max(1, image.nbytes * len(arrays)))
+    try:
+        stacked = np.ndarray(shape, dtype=image.dtype, buffer=shm.buf)
+        for i, array in enumerate(arrays):
+            stacked[i] = array
+        del stacked
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name, shape, image.dtype.str, scale, stages
+
+
+def _from_shared_memory(name: str, shape, dtype: str, scale: float, stages: List[Dict]) -> Tuple[np.ndarray, float]:
+    # the stacked page and the page before the steps, if kept
+    usages.extend(stages)
+    shm = SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy(), scale
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _release_shared_memory(future: Future):
+    # for results which aren't used, e.g. when the deadline passed while they were preprocessed
+    if not future.cancelled() and future.exception() is None:
+        shm = SharedMemory(name=future.result()[0])
+        shm.close()
+        shm.unlink()
+
+
+def optimize_files(files, optimize=False, output_bases: Optional[List[Optional[str]]] = None, return_exceptions=False, keep_normalized=False) -> Iterator:
+    """
+    Optimizes all files in the pool, at most `PREPROCESS_MAX_PARALLEL` at once, yields the PIL images in input order.
+
+    With `return_exceptions` the exception of a failed file is yielded instead of the image, and the other files are still processed.
+    With `keep_normalized` the images keep their page before the preprocessing steps, see `to_pil_image`.
+    """
+    output_bases = output_bases or [None] * len(files)
+    if len(files) == 1 or PREPROCESS_WORKERS <= 1:
+        for file, output_base in zip(files, output_bases):
+            try:
+                image, scale, *normalized = optimize_image_bytes(file_source(file), f'{file.filename}', optimize, output_base, return_normalized=keep_normalized)
+                yield to_pil_image(image, f'{file.filename}', output_base, scale, *normalized)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                yield e
+        return
+
+    pool = get_pool()
+    window = deque()
+    next_i = 0
+    try:
+        for i, file in enumerate(files):
+            while next_i < len(files) and len(window) < PREPROCESS_MAX_PARALLEL:
+                # uploads received to disk are read by the pool from their path
+                window.append(pool.submit(
+                    _optimize_to_shared_memory, file_source(files[next_i]), f'{files[next_i].filename}', optimize, output_bases[next_i], deadline.current(), keep_normalized,
+                ))
+                next_i += 1
+            remaining = deadline.remaining()
+            try:
+                result = window[0].result(timeout=None if remaining is None else max(0.0, remaining))
+            except FutureTimeoutError:
+                raise deadline.exceeded('preprocess')
+            except Exception as e:
+                window.popleft()
+                if not return_exceptions:
+                    raise
+                yield e
+                continue
+            window.popleft()
+            arrays, scale = _from_shared_memory(*result)
+            yield to_pil_image(arrays[0], f'{file.filename}', output_bases[i], scale, *arrays[1:])
+    finally:
+        # when one failed or the deadline passed: files not started are cancelled,
+        # the shared memory of the others is released when they are done, without waiting for them
+        for future in window:
+            future.cancel()
+            future.add_done_callback(_release_shared_memory)
@@ -1,105 +1,165 @@
+import io
 import logging
-from typing import List
+from typing import Iterable, List, Optional, Union
 
 from werkzeug.datastructures import FileStorage
 
-convert = {
-    'level': int,
-    'page_num': int,
-    'block_num': int,
-    'par_num': int,
-    'line_num': int,
-    'word_num': int,
-    'left': int,
-    'top': int,
-    'width': int,
-    'height': int,
-    'conf': float,
-}
+
+def _int(value: str):
+    return int(value) if value != '' else None
+
+
+class Box:
+    """
+    A word of the tesseract TSV, only converted to a dict when the details are returned.
+    """
+    __slots__ = ('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height', 'conf', 'text')
+
+    def __init__(self, cells: List[str], scale=1.0):
+        self.level = _int(cells[0])
+        self.page_num = _int(cells[1])
+        self.block_num = _int(cells[2])
+        self.par_num = _int(cells[3])
+        self.line_num = _int(cells[4])
+        self.word_num = _int(cells[5])
+        self.left = _int(cells[6])
+        self.top = _int(cells[7])
+        self.width = _int(cells[8])
+        self.height = _int(cells[9])
+        self.conf = float(cells[10]) if cells[10] != '' else None
+        self.text = cells[11]
+        if scale != 1.0:
+            # back to the coordinates of the input, before the image was scaled
+            self.left = round(self.left / scale)
+            self.top = round(self.top / scale)
+            self.width = round(self.width / scale)
+            self.height = round(self.height / scale)
+
+    def as_dict(self):
+        return {
+            'level': self.level,
+            'page_num': self.page_num,
+            'block_num': self.block_num,
+            'par_num': self.par_num,
+            'line_num': self.line_num,
+            'word_num': self.word_num,
+            'left': self.left,
+            'top': self.top,
+            'width': self.width,
+            'height': self.height,
+            'conf': self.conf,
+            'text': self.text,
+        }
 
 
 def process_data(
     files: List[FileStorage],
-    tsv: str,
+    tsv: Union[str, Iterable[str]],
     intra_block_breaks=True,  # adds line breaks when text is below each other
     keep_details=False,
+    scales: Optional[List[float]] = None,  # per page, the scale applied to the image before OCR
 ):
-    # todo: reduce loops
-    columns = []
+    """
+    Groups the words of the tesseract TSV into pages and blocks in a single pass, `tsv` can also be an iterable of lines.
+    """
+    lines = io.StringIO(tsv) if isinstance(tsv, str) else iter(tsv)
+    columns = next(lines, '').rstrip('\n').split('\t')
+    if columns == ['']:
+        # no output at all, e.g. of an empty image
+        return []
+    # the cells in the order of `Box`, for engines which write the columns in another order
+    order = None
+    if columns != list(Box.__slots__):
+        missing = [column for column in Box.__slots__ if column not in columns]
+        if missing:
+            raise ValueError(f'TSV without the columns {missing}')
+        order = [columns.index(column) for column in Box.__slots__]
+
     pages = []
     page_data = None
-    block_data = None
-    for i, line in enumerate(tsv.split('\n')):
-        if i == 0:
-            for j, column in enumerate(line.split('\t')):
-                columns.append(column)
-            continue
+    page_num = None
+    content = None
+    blocks = None
+    block_num = None
+    block_text = None
+    block_boxes = None
+    last_box_y2 = None
+    scale = 1.0
+
+    def end_block():
+        text = ''.join(block_text).strip()
+        if text == '':
+            # ignoring "empty text" blocks (NOT boxes)
+            return
+        content.append(text)
+        if keep_details:
+            blocks.append({
+                'block': block_num,
+                'text': text,
+                'boxes': [box.as_dict() for box in block_boxes],
+            })
+
+    def end_page():
+        if block_text is not None:
+            end_block()
+        if keep_details:
+            page_data['blocks'] = blocks
+        else:
+            page_data['content'] = '\n\n'.join(content)
 
-        row_data = {}
-        for j, value in enumerate(line.split('\t')):
-            column = columns[j]
-            if column in convert:
-                if value == '':
-                    value = None
-                else:
-                    value = convert[column](value)
-            row_data[column] = value
-
-        if 'page_num' not in row_data:
-            if 'level' in row_data and row_data['level'] is None:
+    for line in lines:
+        cells = line.rstrip('\n').split('\t')
+        if order is not None and len(cells) == len(columns):
+            cells = [cells[i] for i in order]
+        if len(cells) != 12:
+            if len(cells) == 1 and cells[0] == '':
                 # somehow always a row with just `level: None` exists
                 continue
-            logging.info(f'invalid row-data {row_data}')
+            logging.info(f'invalid row-data {dict(zip(columns, cells))}')
             continue
 
-        if row_data['conf'] < 1:
+        conf = cells[10]
+        if conf == '' or float(conf) < 1:
             # low confidence score
             continue
-        if not page_data or page_data['page'] != row_data['page_num']:
+
+        row_page_num = int(cells[1])
+        if page_num != row_page_num:
             # separating data for different files (e.g. batch mode)
+            if page_data:
+                end_page()
+            page_num = row_page_num
             page_data = {
-                'page': row_data['page_num'],
-                'file': files[len(pages)].filename,
-                'blocks': [],
+                'page': page_num,
+                # pages without any text are missing, thus using the number and not the count of pages
+                'file': files[page_num - 1].filename,
             }
             pages.append(page_data)
-            block_data = None
-        if not block_data or block_data['block'] != row_data['block_num']:
-            block_data = {
-                'block': row_data['block_num'],
-                'text': '',
-                'boxes': [],
-            }
-            page_data['blocks'].append(block_data)
-
-        block_data['boxes'].append(row_data)
-
-    for page in pages:
-        blocks_copy = page['blocks'].copy()  # copy to filter in next loop
-        del page['blocks']
-        content = []
-        blocks = []
-        for block in blocks_copy:
+            content = []
+            blocks = []
+            block_text = None
+            scale = scales[page_num - 1] if scales else 1.0
+        row_block_num = int(cells[2])
+        if block_text is None or block_num != row_block_num:
+            if block_text is not None:
+                end_block()
+            block_num = row_block_num
+            block_text = []
+            block_boxes = []
             last_box_y2 = None
-            for box in block['boxes']:
-                if intra_block_breaks and last_box_y2 and last_box_y2 < box['top']:
-                    # previous box is above current one
-                    block['text'] += '\n'
-                else:
-                    block['text'] += ' '
-                block['text'] += box['text']
-                last_box_y2 = box['top'] + box['height']
-
-            block['text'] = block['text'].strip()
-            if block['text'] == '':
-                # ignoring "empty text" blocks (NOT boxes)
-                continue
-            content.append(block['text'])
-            blocks.append(block)
 
-        if keep_details:
-            page['blocks'] = blocks
+        top = int(cells[7])
+        if intra_block_breaks and last_box_y2 and last_box_y2 < top:
+            # previous box is above current one
+            block_text.append('\n')
         else:
-            page['content'] = '\n\n'.join(content)
+            block_text.append(' ')
+        block_text.append(cells[11])
+        last_box_y2 = top + int(cells[9])
+        if keep_details:
+            block_boxes.append(Box(cells, scale))
+
+    if page_data:
+        end_page()
 
     return pages
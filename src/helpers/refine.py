@@ -0,0 +1,203 @@
+import logging
+import os
+import time
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+from PIL import Image
+
+from helpers import deadline, usages
+from helpers.ocr_engine import get_engine, TSV_HEADER
+from helpers.optimize_image import optimize_image_array, to_pil_image
+from helpers.scheduler import share
+from helpers.tiling import run_bounded
+from helpers.usages import Stage
+
+# blocks with a lower mean confidence of their words are recognized again
+REFINE_MIN_CONF = float(os.environ.get('REFINE_MIN_CONF', '60'))
+# max. blocks per page which are recognized again, the largest weak ones first
+REFINE_MAX_BLOCKS = int(os.environ.get('REFINE_MAX_BLOCKS', '8'))
+# time for all alternatives of a page, alternatives which didn't finish in time are ignored
+REFINE_BUDGET_MS = int(os.environ.get('REFINE_BUDGET_MS', '3000'))
+# score an alternative must be better than the words of the page
+REFINE_MIN_GAIN = float(os.environ.get('REFINE_MIN_GAIN', '5'))
+# pixels around the words of a block in the crop
+REFINE_PADDING = 12
+
+# `(preprocess, psm)` tried for each weak block, in this order when the budget is short;
+# the crops are taken from the normalized grayscale page, before the preprocessing steps of the request
+REFINE_ALTERNATIVES: List[Tuple[str, int]] = [
+    ('none', 6),
+    ('otsu', 6),
+    ('clahe+threshold', 6),
+    ('threshold', 6),
+    ('none', 11),
+]
+
+
+class Block(NamedTuple):
+    page_num: int
+    block_num: int
+    # the rows of all levels, in the order of the TSV
+    rows: List[List[str]]
+    left: int
+    top: int
+    right: int
+    bottom: int
+    score: float
+    chars: int
+
+
+def words_of(rows: List[List[str]]) -> List[List[str]]:
+    return [cells for cells in rows if cells[0] == '5' and cells[11].strip()]
+
+
+def score(words: List[List[str]], chars: int = 0) -> float:
+    """
+    Mean confidence weighted by the length of the words, fewer characters than `chars` count as missing.
+    """
+    total = sum(len(cells[11].strip()) for cells in words)
+    if not total:
+        return 0.0
+    return sum(max(0.0, float(cells[10])) * len(cells[11].strip()) for cells in words) / max(total, chars)
+
+
+def weak_blocks(rows: List[List[str]], width: int, height: int) -> List[Block]:
+    """
+    The blocks whose words are recognized with low confidence, the largest first.
+    """
+    by_block: Dict[Tuple[int, int], List[List[str]]] = {}
+    for cells in rows:
+        by_block.setdefault((int(cells[1]), int(cells[2])), []).append(cells)
+    blocks = []
+    for (page_num, block_num), block_rows in by_block.items():
+        words = words_of(block_rows)
+        if not block_num or not words:
+            continue
+        block_score = score(words)
+        if block_score >= REFINE_MIN_CONF:
+            continue
+        blocks.append(Block(
+            page_num, block_num, block_rows,
+            left=max(0, min(int(cells[6]) for cells in words) - REFINE_PADDING),
+            top=max(0, min(int(cells[7]) for cells in words) - REFINE_PADDING),
+            right=min(width, max(int(cells[6]) + int(cells[8]) for cells in words) + REFINE_PADDING),
+            bottom=min(height, max(int(cells[7]) + int(cells[9]) for cells in words) + REFINE_PADDING),
+            score=block_score,
+            chars=sum(len(cells[11].strip()) for cells in words),
+        ))
+    blocks.sort(key=lambda block: (block.right - block.left) * (block.bottom - block.top), reverse=True)
+    return blocks[:REFINE_MAX_BLOCKS]
+
+
+def with_psm(config: List[str], psm: int) -> List[str]:
+    return [option for option in config if not option.startswith('--psm')] + [f'--psm {psm}']
+
+
+def recognize(crop: np.ndarray, name: str, preprocess: str, psm: int, lang: str, config: List[str], until: float) -> Tuple[List[List[str]], float]:
+    # runs in a copy of the context, its stages are only summarized in the `refine` stage
+    usages.start()
+    # cancelled with the end of the refine budget, not only with the request
+    with deadline.within(max(0.001, until - time.monotonic())):
+        image, scale = optimize_image_array(crop, name, preprocess)
+        pil_image = to_pil_image(image, name, None, scale)
+        with share(1):
+            tsv = get_engine().image_to_data([pil_image], lang, with_psm(config, psm))
+    return [line.split('\t') for line in tsv.split('\n')[1:] if line.count('\t') == 11], scale
+
+
+def splice(block: Block, words: List[List[str]], scale: float) -> List[List[str]]:
+    # the words of the crop in page coordinates, all in the block they replace
+    rows = []
+    for cells in words:
+        cells = list(cells)
+        cells[1] = str(block.page_num)
+        cells[2] = str(block.block_num)
+        cells[6] = str(block.left + round(int(cells[6]) / scale))
+        cells[7] = str(block.top + round(int(cells[7]) / scale))
+        cells[8] = str(round(int(cells[8]) / scale))
+        cells[9] = str(round(int(cells[9]) / scale))
+        rows.append(cells)
+    return rows
+
+
+def refine_page(image: Image.Image, tsv: str, lang: str, config: List[str]) -> str:
+    """
+    Recognizes the blocks of the page TSV with low confidence again, with other preprocessing and page segmentation,
+    and replaces their words when an alternative scores better.
+
+    Runs the alternatives in parallel within `REFINE_BUDGET_MS`, thus the time grows with the weak regions and not the page.
+    The blocks are cropped from the page before the preprocessing steps when `image` kept it, see `to_pil_image`.
+    """
+    rows = [line.split('\t') for line in tsv.split('\n')[1:] if line.count('\t') == 11]
+    with Stage('refine') as info:
+        blocks = weak_blocks(rows, image.width, image.height)
+        info['blocks'] = len(blocks)
+        if not blocks:
+            return tsv
+        array = image.info.get('normalized')
+        if array is None:
+            array = np.asarray(image.convert('L') if image.mode != 'L' else image)
+        # the first alternative of every block, then the second and so on
+        jobs = [(block, alternative) for alternative in REFINE_ALTERNATIVES for block in blocks]
+        best: Dict[int, Tuple[float, List[List[str]]]] = {}
+        # an alternative is only an improvement, it ends with the deadline of the request instead of failing it
+        budget = REFINE_BUDGET_MS / 1000
+        remaining = deadline.remaining()
+        until = time.monotonic() + (budget if remaining is None else max(0.0, min(budget, remaining - 0.1)))
+        tried = 0
+
+        def run(job: Tuple[Block, Tuple[str, int]]) -> Tuple[List[List[str]], float]:
+            block, (preprocess, psm) = job
+            crop = np.ascontiguousarray(array[block.top:block.bottom, block.left:block.right])
+            return recognize(crop, f'block_{block.block_num}.png', preprocess, psm, lang, config, until)
+
+        # the running ones end with their deadline at `until`, those not started by then are dropped
+        for (block, _), future in run_bounded(run, jobs, until):
+            tried += 1
+            try:
+                words, scale = future.result()
+            except Exception as e:
+                logging.warning(f'refining block {block.block_num} failed: {e}')
+                continue
+            words = words_of(words)
+            alternative_score = score(words, block.chars)
+            to_beat = best[block.block_num][0] if block.block_num in best else block.score + REFINE_MIN_GAIN
+            if alternative_score > to_beat:
+                best[block.block_num] = (alternative_score, splice(block, words, scale))
+
+        replaced = {block.block_num: block for block in blocks if block.block_num in best}
+        info.update(
+            tried=tried,
+            timed_out=tried < len(jobs),
+            improved=len(replaced),
+            scores={str(block.block_num): [round(block.score, 1), round(best[block.block_num][0], 1)] for block in replaced.values()},
+        )
+        if not replaced:
+            return tsv
+
+        refined = []
+        for cells in rows:
+            block_num = int(cells[2])
+            if block_num not in replaced:
+                refined.append(cells)
+            elif cells is replaced[block_num].rows[0]:
+                # at the position of the block, as `process_data` joins the words of a block in order
+                refined.extend(best[block_num][1])
+        return TSV_HEADER + '\n' + ''.join('\t'.join(cells) + '\n' for cells in refined)
+
+
+def refine_pages(images: List[Image.Image], tsv: str, lang: str, config: List[str]) -> str:
+    """
+    `refine_page` for the TSV of multiple pages, `images` in the order of their page numbers.
+    """
+    pages: Dict[int, List[str]] = {}
+    for line in tsv.split('\n')[1:]:
+        cells = line.split('\t', 2)
+        if len(cells) == 3 and cells[1].isdigit():
+            pages.setdefault(int(cells[1]), []).append(line)
+    refined = [TSV_HEADER + '\n']
+    for page_num, lines in pages.items():
+        page_tsv = refine_page(images[page_num - 1], TSV_HEADER + '\n' + '\n'.join(lines) + '\n', lang, config)
+        refined.extend(line + '\n' for line in page_tsv.split('\n')[1:] if line)
+    return ''.join(refined)
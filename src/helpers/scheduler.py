@@ -0,0 +1,170 @@
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def cpu_quota() -> float:
+    """
+    CPUs this container may use: the cgroup quota if one is set, else the cores this process may run on.
+    """
+    cores = available_cores()
+    try:
+        # cgroup v2, e.g. `200000 100000` or `max 100000`
+        with open('/sys/fs/cgroup/cpu.max') as file:
+            quota, period = file.read().split()[:2]
+        if quota != 'max':
+            return min(cores, int(quota) / int(period))
+        return cores
+    except (OSError, ValueError):
+        pass
+    for cgroup_dir in ('/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct'):
+        try:
+            # cgroup v1, `-1` when unlimited
+            with open(os.path.join(cgroup_dir, 'cpu.cfs_quota_us')) as file:
+                quota = int(file.read())
+            with open(os.path.join(cgroup_dir, 'cpu.cfs_period_us')) as file:
+                period = int(file.read())
+            if quota > 0 and period > 0:
+                return min(cores, quota / period)
+        except (OSError, ValueError):
+            continue
+    return cores
+
+
+# whole CPUs for sizing pools and thread budgets, at least one
+CPUS = max(1, math.floor(cpu_quota()))
+# max. threads of a single tesseract call, tesseract doesn't get faster with more
+OCR_MAX_THREADS = int(os.environ.get('OCR_MAX_THREADS', '4'))
+# the gunicorn workers, which share the CPUs
+WORKERS = int(os.environ.get('GUN_W', '1'))
+# shared by all workers of this container to know the running calls
+THREADS_REGISTRY = os.environ.get('THREADS_REGISTRY', os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'abc-soup-threads.json'))
+
+# the budget of the running call in this context, nested calls use it instead of registering again
+_budget: ContextVar[Optional[int]] = ContextVar('thread_budget', default=None)
+
+
+def process_threads() -> int:
+    # for engines in this process, where OpenMP reads the limit only once
+    return max(1, min(OCR_MAX_THREADS, CPUS // max(1, WORKERS)))
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _registry() -> Iterator[Dict[str, int]]:
+    # the threads per running call, as `{"pid:id": threads}`, locked while it is changed
+    with open(THREADS_REGISTRY, 'a+') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            file.seek(0)
+            try:
+                entries = json.loads(file.read() or '{}')
+            except ValueError:
+                entries = {}
+            # calls of ended or killed processes
+            entries = {key: threads for key, threads in entries.items() if _alive(int(key.split(':')[0]))}
+            yield entries
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(entries))
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _acquire(key: str, threads: Optional[int]) -> int:
+    try:
+        with _registry() as entries:
+            if threads is None:
+                # idle: up to `OCR_MAX_THREADS`, busy: a fair share of what isn't used by the running calls, at least one
+                allocated = sum(entries.values())
+                threads = max(1, min(OCR_MAX_THREADS, CPUS - allocated, CPUS // (len(entries) + 1)))
+            entries[key] = threads
+        return threads
+    except OSError as e:
+        logging.warning(f'thread registry {THREADS_REGISTRY} not usable: {e}')
+        return threads or process_threads()
+
+
+def _release(key: str):
+    try:
+        with _registry() as entries:
+            entries.pop(key, None)
+    except OSError:
+        pass
+
+
+@contextmanager
+def thread_budget(threads: Optional[int] = None) -> Iterator[int]:
+    """
+    Registers a call for all workers of this container and yields the threads it may use.
+
+    With `threads` it uses a fixed number, e.g. for engines which can't change it per call.
+    """
+    current = _budget.get()
+    if current is not None:
+        yield current
+        return
+    key = f'{os.getpid()}:{uuid.uuid4().hex[:12]}'
+    budget = _acquire(key, threads)
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+        _release(key)
+
+
+@contextmanager
+def share(threads: int) -> Iterator[int]:
+    """
+    Uses a part of the budget of the surrounding call, e.g. for its tiles which run in parallel.
+    """
+    token = _budget.set(threads)
+    try:
+        yield threads
+    finally:
+        _budget.reset(token)
+
+
+def current_threads() -> int:
+    # outside of a budget, e.g. in benchmarks, like an idle server
+    budget = _budget.get()
+    return budget if budget is not None else min(OCR_MAX_THREADS, CPUS)
+
+
+def info() -> Dict:
+    try:
+        with _registry() as entries:
+            allocations = dict(entries)
+    except OSError:
+        allocations = {}
+    return {
+        'cpus': round(cpu_quota(), 2),
+        'max_threads': OCR_MAX_THREADS,
+        'process_threads': int(os.environ.get('OMP_THREAD_LIMIT', process_threads())),
+        'running': len(allocations),
+        'allocated': sum(allocations.values()),
+    }
@@ -0,0 +1,101 @@
+import gzip
+import json
+import os
+from typing import Dict, List, Optional
+
+from flask import Response
+
+from helpers.usages import Stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LAYOUT_ROWS = 'rows'
+LAYOUT_COLUMNS = 'columns'
+LAYOUTS = (LAYOUT_ROWS, LAYOUT_COLUMNS)
+COLUMNS_MIMETYPE = 'application/vnd.abc-soup.columns+json'
+# the fields of `ExtractedBox`, in the columns layout `page_num` and `block_num` are left out as they equal `page` and `block`
+BOX_FIELDS = ('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height', 'conf')
+BOX_COLUMNS = ('level', 'par_num', 'line_num', 'word_num', 'left', 'top', 'width', 'height', 'conf')
+# smaller responses aren't worth compressing
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL_GZIP = int(os.environ.get('COMPRESS_LEVEL_GZIP', '5'))
+COMPRESS_LEVEL_ZSTD = int(os.environ.get('COMPRESS_LEVEL_ZSTD', '3'))
+
+
+def dumps(data) -> bytes:
+    if orjson:
+        # like `json`, which converts e.g. numbers to string keys
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def row_page(page: Dict) -> Dict:
+    """
+    Like dumping `OCROutcome`, without the schema: only its fields, boxes without their text.
+    """
+    data = {key: page[key] for key in ('page', 'file', 'content') if key in page}
+    if 'blocks' in page:
+        data['blocks'] = [{
+            'block': block['block'],
+            'text': block['text'],
+            'boxes': [{field: box[field] for field in BOX_FIELDS} for box in block['boxes']],
+        } for block in page['blocks']]
+    return data
+
+
+def column_page(page: Dict) -> Dict:
+    """
+    The boxes of each block as parallel arrays, `columns['left'][i]` is the left of the i-th box.
+    """
+    data = {key: page[key] for key in ('page', 'file', 'content') if key in page}
+    if 'blocks' in page:
+        data['blocks'] = [{
+            'block': block['block'],
+            'text': block['text'],
+            'columns': {field: [box[field] for box in block['boxes']] for field in BOX_COLUMNS},
+        } for block in page['blocks']]
+    return data
+
+
+def layout_pages(pages: List[Optional[Dict]], layout: str) -> List[Optional[Dict]]:
+    to_layout = column_page if layout == LAYOUT_COLUMNS else row_page
+    return [to_layout(page) if page else page for page in pages]
+
+
+def compress(body: bytes, accept_encoding) -> Optional[tuple]:
+    # the encoding the client prefers of the available ones, `None` if it accepts none or the body is small
+    if len(body) < COMPRESS_MIN_BYTES:
+        return None
+    available = ['zstd', 'gzip'] if zstandard else ['gzip']
+    encoding = accept_encoding.best_match(available) if accept_encoding else None
+    if encoding == 'zstd':
+        return encoding, zstandard.ZstdCompressor(level=COMPRESS_LEVEL_ZSTD).compress(body)
+    if encoding == 'gzip':
+        return encoding, gzip.compress(body, compresslevel=COMPRESS_LEVEL_GZIP, mtime=0)
+    return None
+
+
+def json_response(data, accept_encoding=None, content_type='application/json', status=200) -> Response:
+    """
+    Serializes the already shaped `data` without schema dumping, compressed if the client accepts it.
+    """
+    with Stage('serialize') as info:
+        body = dumps(data)
+        info['bytes'] = len(body)
+        compressed = compress(body, accept_encoding)
+        if compressed:
+            info['encoding'], body = compressed
+            info['compressed_bytes'] = len(body)
+    response = Response(body, status=status, content_type=content_type)
+    if compressed:
+        response.headers['Content-Encoding'] = compressed[0]
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,175 @@
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from helpers.ocr_engine import get_engine, TSV_HEADER
+from helpers.scheduler import share
+from helpers.tiling import run_bounded
+from helpers.usages import Stage
+
+# pages are only cropped when the text regions cover at most this part of the page, else the whole page is recognized
+REGIONS_MAX_COVERAGE = float(os.environ.get('REGIONS_MAX_COVERAGE', '0.6'))
+# more regions are recognized as one crop around all of them, as every crop costs a call of the engine
+REGIONS_MAX_COUNT = int(os.environ.get('REGIONS_MAX_COUNT', '8'))
+# pixels around the text of a region, tesseract recognizes text touching the edge badly
+REGIONS_PADDING = int(os.environ.get('REGIONS_PADDING', '24'))
+# long edge of the copy the regions are detected in
+REGIONS_DETECT_SIZE = 1200
+# edges weaker than this are paper texture or compression noise
+REGIONS_MIN_GRADIENT = 32
+# lines further apart than this part of the detected page are separate regions, words of a line three times as far
+REGIONS_GAP = 0.02
+# components higher than this part of the detected page are photos or frames, not lines of text
+REGIONS_MAX_LINE_HEIGHT = 0.08
+
+
+class Region(NamedTuple):
+    left: int
+    top: int
+    right: int
+    bottom: int
+
+
+def use_regions(options: Dict) -> bool:
+    return bool(options.get('regions'))
+
+
+def _merge_overlapping(boxes: List[List[int]]) -> List[List[int]]:
+    # until no boxes overlap anymore, as a merged box may now overlap another one
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def find_text_regions(image: np.ndarray, padding: int = REGIONS_PADDING) -> List[Region]:
+    """
+    The parts of the grayscale page which contain text, in reading order, `[]` when none were found.
+
+    Detected in a downscaled copy: the morphological gradient finds the edges of letters, closing them horizontally joins
+    letters to lines, connected components which are too large for a line are left out, nearby lines are joined to regions.
+    """
+    height, width = image.shape[:2]
+    factor = min(1.0, REGIONS_DETECT_SIZE / max(height, width))
+    small = cv2.resize(image, (max(1, round(width * factor)), max(1, round(height * factor))), interpolation=cv2.INTER_AREA) if factor < 1 else image
+    small_height, small_width = small.shape[:2]
+
+    gradient = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    otsu, _ = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    edges = cv2.threshold(gradient, max(otsu, REGIONS_MIN_GRADIENT), 255, cv2.THRESH_BINARY)[1]
+    lines = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1)))
+
+    count, _, stats, _ = cv2.connectedComponentsWithStats(lines, connectivity=8)
+    max_line_height = max(4, round(small_height * REGIONS_MAX_LINE_HEIGHT))
+    text = np.zeros_like(lines)
+    for left, top, w, h, area in stats[1:count]:
+        # specks, and lines higher than text lines or barely filled like the outline of a frame
+        if area < 6 or h > max_line_height or area < w * h * 0.15:
+            continue
+        text[top:top + h, left:left + w] = 255
+    if not text.any():
+        return []
+
+    gap = max(3, round(max(small_height, small_width) * REGIONS_GAP)) | 1
+    joined = cv2.dilate(text, cv2.getStructuringElement(cv2.MORPH_RECT, (gap * 3, gap)))
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(joined, connectivity=8)
+    boxes = []
+    for i, (left, top, w, h, _) in enumerate(stats[1:count], 1):
+        # the lines inside, without the dilation
+        x, y, w, h = cv2.boundingRect(np.where(labels[top:top + h, left:left + w] == i, text[top:top + h, left:left + w], 0))
+        left, top = left + x, top + y
+        boxes.append([
+            max(0, int(left / factor) - padding),
+            max(0, int(top / factor) - padding),
+            min(width, int(np.ceil((left + w) / factor)) + padding),
+            min(height, int(np.ceil((top + h) / factor)) + padding),
+        ])
+    boxes = _merge_overlapping(boxes)
+    return [Region(*box) for box in sorted(boxes, key=lambda box: (box[1], box[0]))]
+
+
+def text_regions(image: Image.Image, options: Dict) -> Optional[List[Region]]:
+    """
+    The regions to recognize instead of the whole page, `None` when the page isn't cropped.
+    """
+    if not use_regions(options):
+        return None
+    with Stage('regions') as info:
+        array = np.asarray(image if image.mode == 'L' else image.convert('L'))
+        regions = find_text_regions(array)
+        if len(regions) > REGIONS_MAX_COUNT:
+            regions = [Region(
+                min(region.left for region in regions), min(region.top for region in regions),
+                max(region.right for region in regions), max(region.bottom for region in regions),
+            )]
+        coverage = sum((region.right - region.left) * (region.bottom - region.top) for region in regions) / (image.width * image.height)
+        info.update(regions=len(regions), coverage=round(coverage, 3))
+        # without any, the detection may have missed faint text; the whole page is recognized then
+        if not regions or coverage > REGIONS_MAX_COVERAGE:
+            info['cropped'] = False
+            return None
+        info['cropped'] = True
+        return regions
+
+
+def merge_regions(regions: List[Region], tsvs: List[str], width: int, height: int, page_num: int = 1) -> str:
+    """
+    Moves the rows of each region TSV into page coordinates and numbers the blocks of all regions one after another.
+    """
+    rows = [TSV_HEADER, f'1\t{page_num}\t0\t0\t0\t0\t0\t0\t{width}\t{height}\t-1\t']
+    block_offset = 0
+    for region, tsv in zip(regions, tsvs):
+        max_block = 0
+        for line in tsv.split('\n')[1:]:
+            cells = line.split('\t')
+            # the page row of the crop is replaced by the one of the page
+            if len(cells) != 12 or cells[0] == '1':
+                continue
+            block_num = int(cells[2])
+            max_block = max(max_block, block_num)
+            cells[1] = str(page_num)
+            cells[2] = str(block_num + block_offset)
+            cells[6] = str(int(cells[6]) + region.left)
+            cells[7] = str(int(cells[7]) + region.top)
+            rows.append('\t'.join(cells))
+        block_offset += max_block
+    return '\n'.join(rows) + '\n'
+
+
+def image_to_data_regions(image: Image.Image, regions: List[Region], lang: str, config: List[str], page_num: int = 1) -> str:
+    """
+    OCR of only the text regions of a page, in parallel like tiles, returns the TSV in the coordinates of the page.
+    """
+    logging.debug(f'ocr of {len(regions)} regions for {image.width}x{image.height}')
+    engine = get_engine()
+
+    def crop_of(region: Region) -> Image.Image:
+        crop = image.crop(region)
+        crop.format = image.format
+        return crop
+
+    def recognize(region: Region) -> str:
+        # single threaded, the budget of the page is used by running regions in parallel
+        with share(1):
+            return engine.image_to_data([crop_of(region)], lang, config)
+
+    if len(regions) == 1:
+        return merge_regions(regions, [engine.image_to_data([crop_of(regions[0])], lang, config)], image.width, image.height, page_num)
+
+    # the regions don't overlap, so they are distinct
+    tsvs = {region: future.result() for region, future in run_bounded(recognize, regions)}
+    return merge_regions(regions, [tsvs[region] for region in regions], image.width, image.height, page_num)
@@ -0,0 +1,247 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
+
+import numpy as np
+from PIL import Image
+
+from helpers.ocr_engine import get_engine, TSV_HEADER
+from helpers.scheduler import CPUS, share, thread_budget
+
+# pages with at least this many pixels are split into tiles, unless option `tiles` is set
+TILE_MIN_PIXELS = int(os.environ.get('TILE_MIN_PIXELS', '25000000'))
+# target edge length of a tile, the actual cuts are moved into nearby whitespace
+TILE_SIZE = int(os.environ.get('TILE_SIZE', '3000'))
+# pixels each tile extends into its neighbours, should be larger than the widest word
+TILE_OVERLAP = int(os.environ.get('TILE_OVERLAP', '200'))
+# threads per gunicorn worker recognizing tiles in parallel
+TILE_WORKERS = int(os.environ.get('TILE_WORKERS', CPUS))
+
+_pool: Optional[ThreadPoolExecutor] = None
+
+Item = TypeVar('Item')
+
+
+def get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        # threads are enough, both engines release the GIL while recognizing
+        _pool = ThreadPoolExecutor(max_workers=max(1, TILE_WORKERS), thread_name_prefix='ocr-tile')
+    return _pool
+
+
+def run_bounded(fn: Callable[[Item], object], items: Iterable[Item], until: Optional[float] = None) -> Iterator[Tuple[Item, Future]]:
+    """
+    Runs `fn` for the items in the tile pool, at most as many at once as the thread budget and the engine handles allow,
+    and yields each item with its done future in the order they finish.
+
+    After `until` of `time.monotonic()` no more items are started and it stops waiting, as it does when the caller stops
+    iterating; items which haven't started then are cancelled.
+    """
+    with thread_budget() as threads:
+        parallel = max(1, min(threads, TILE_WORKERS, get_engine().max_parallel or TILE_WORKERS))
+        waiting = iter(items)
+        running: Dict[Future, Item] = {}
+
+        def submit_next():
+            if until is not None and time.monotonic() >= until:
+                return
+            for item in waiting:
+                # each in a copy of the context, so the stages are added to the request
+                running[get_pool().submit(contextvars.copy_context().run, fn, item)] = item
+                return
+
+        try:
+            for _ in range(parallel):
+                submit_next()
+            while running:
+                timeout = None if until is None else max(0.0, until - time.monotonic())
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    yield running.pop(future), future
+                    submit_next()
+        finally:
+            for future in running:
+                future.cancel()
+
+
+class Tile(NamedTuple):
+    # the crop, including the overlap into neighbouring tiles
+    left: int
+    top: int
+    right: int
+    bottom: int
+    # the part of the page this tile is responsible for, words are kept when their center is inside
+    core: tuple
+
+
+def use_tiles(image: Image.Image, options: Dict) -> bool:
+    tiles = options.get('tiles')
+    if tiles is None:
+        return image.width * image.height >= TILE_MIN_PIXELS
+    return bool(tiles)
+
+
+def find_cuts(ink: np.ndarray, tile_size: int) -> List[int]:
+    """
+    Positions for cutting a page axis with the `ink` profile into parts of about `tile_size`, each at the emptiest line near the target.
+    """
+    length = len(ink)
+    count = max(1, round(length / tile_size))
+    cuts = [0]
+    search = tile_size // 4
+    for i in range(1, count):
+        target = i * length // count
+        start = max(cuts[-1] + 1, target - search)
+        window = ink[start:min(length - 1, target + search)]
+        if not len(window):
+            continue
+        # prefers the cut closest to the target, when multiple lines are equally empty
+        candidates = np.flatnonzero(window == window.min()) + start
+        cuts.append(int(candidates[np.abs(candidates - target).argmin()]))
+    cuts.append(length)
+    return cuts
+
+
+def split_tiles(image: np.ndarray, tile_size: int = TILE_SIZE, overlap: int = TILE_OVERLAP) -> List[Tile]:
+    """
+    Splits the grayscale page along whitespace gutters, tiles are ordered row by row.
+    """
+    height, width = image.shape[:2]
+    ink = image < 128
+    xs = find_cuts(ink.sum(axis=0), tile_size)
+    ys = find_cuts(ink.sum(axis=1), tile_size)
+    tiles = []
+    for y0, y1 in zip(ys, ys[1:]):
+        for x0, x1 in zip(xs, xs[1:]):
+            tiles.append(Tile(
+                left=max(0, x0 - overlap),
+                top=max(0, y0 - overlap),
+                right=min(width, x1 + overlap),
+                bottom=min(height, y1 + overlap),
+                core=(x0, y0, x1, y1),
+            ))
+    return tiles
+
+
+def _iou(a, b) -> float:
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    if x1 <= x0 or y1 <= y0:
+        return 0.0
+    inter = (x1 - x0) * (y1 - y0)
+    return inter / (a[2] * a[3] + b[2] * b[3] - inter)
+
+
+def merge_tiles(tiles: List[Tile], tsvs: List[str], width: int, height: int, page_num: int = 1) -> str:
+    """
+    Moves the words of each tile TSV into page coordinates, drops the duplicates of the overlaps and renumbers the blocks per tile.
+
+    Only the page and word rows are kept, as `process_data` only uses the words; a single tile is the page, its TSV is kept as is.
+    """
+    if len(tiles) == 1:
+        return TSV_HEADER + '\n' + page_rows(tsvs[0], page_num)
+    rows = [TSV_HEADER, f'1\t{page_num}\t0\t0\t0\t0\t0\t0\t{width}\t{height}\t-1\t']
+    # words near any cut, only those can be duplicates
+    overlap_words = []
+    # words wider than the overlap are cut by both tiles, `(row, tile, box)` of each piece
+    cut_words = []
+    block_offset = 0
+    for tile_index, (tile, tsv) in enumerate(zip(tiles, tsvs)):
+        max_block = 0
+        for line in tsv.split('\n')[1:]:
+            cells = line.split('\t')
+            if len(cells) != 12 or cells[0] != '5':
+                continue
+            left, top, w, h = int(cells[6]), int(cells[7]), int(cells[8]), int(cells[9])
+            block_num = int(cells[2])
+            max_block = max(max_block, block_num)
+            # words touching an inner edge of the crop are cut, the neighbouring tile contains them completely,
+            # unless they also reach beyond the crop of the neighbour
+            cut = (left <= 1 and tile.left > 0, top <= 1 and tile.top > 0,
+                   left + w >= tile.right - tile.left - 1 and tile.right < width,
+                   top + h >= tile.bottom - tile.top - 1 and tile.bottom < height)
+            left += tile.left
+            top += tile.top
+            x0, y0, x1, y1 = tile.core
+            if any(cut):
+                cut_by_neighbour = (cut[0] and left + w > x0 + TILE_OVERLAP) or (cut[1] and top + h > y0 + TILE_OVERLAP) \
+                    or (cut[2] and left < x1 - TILE_OVERLAP) or (cut[3] and top < y1 - TILE_OVERLAP)
+                if not cut_by_neighbour:
+                    continue
+            cells[1] = str(page_num)
+            cells[2] = str(block_num + block_offset)
+            cells[6] = str(left)
+            cells[7] = str(top)
+            if any(cut):
+                # decided when the pieces of all tiles are known
+                cut_words.append((len(rows), tile_index, (left, top, w, h)))
+                rows.append('\t'.join(cells))
+                continue
+            center_x = left + w / 2
+            center_y = top + h / 2
+            if not (x0 <= center_x < x1 and y0 <= center_y < y1):
+                continue
+            box = (left, top, w, h)
+            if left < x0 + TILE_OVERLAP or top < y0 + TILE_OVERLAP or left + w > x1 - TILE_OVERLAP or top + h > y1 - TILE_OVERLAP:
+                if any(_iou(box, other) > 0.5 for other in overlap_words):
+                    continue
+                overlap_words.append(box)
+            rows.append('\t'.join(cells))
+        block_offset += max_block
+
+    # a cut word is kept from the tile whose core contains the center of all its pieces
+    dropped = set()
+    for row, tile_index, box in cut_words:
+        x0, y0, x1, y1 = box[0], box[1], box[0] + box[2], box[1] + box[3]
+        for _, other_index, other in cut_words:
+            if other_index != tile_index and _iou(box, other) > 0:
+                x0, y0 = min(x0, other[0]), min(y0, other[1])
+                x1, y1 = max(x1, other[0] + other[2]), max(y1, other[1] + other[3])
+        core = tiles[tile_index].core
+        if not (core[0] <= (x0 + x1) / 2 < core[2] and core[1] <= (y0 + y1) / 2 < core[3]):
+            dropped.add(row)
+    return '\n'.join(row for i, row in enumerate(rows) if i not in dropped) + '\n'
+
+
+def page_rows(tsv: str, page_num: int) -> str:
+    """
+    The rows of a single page TSV without header, moved to `page_num` for joining multiple pages.
+    """
+    rows = []
+    for line in tsv.split('\n')[1:]:
+        cells = line.split('\t')
+        if len(cells) == 12:
+            cells[1] = str(page_num)
+            rows.append('\t'.join(cells) + '\n')
+    return ''.join(rows)
+
+
+def image_to_data_tiled(image: Image.Image, lang: str, config: List[str], page_num: int = 1) -> str:
+    """
+    OCR of a large page by recognizing its tiles in parallel, returns the merged TSV like the engine does for a single page.
+    """
+    array = np.asarray(image)
+    if array.ndim == 3:
+        array = np.asarray(image.convert('L'))
+    tiles = split_tiles(array)
+    logging.debug(f'ocr with {len(tiles)} tiles for {image.width}x{image.height}')
+    engine = get_engine()
+
+    def recognize(tile: Tile) -> str:
+        crop = image.crop((tile.left, tile.top, tile.right, tile.bottom))
+        crop.format = image.format
+        # single threaded, the budget of the page is used by running tiles in parallel
+        with share(1):
+            return engine.image_to_data([crop], lang, config)
+
+    # the tiles are distinct, each at its own position
+    tsvs = {tile: future.result() for tile, future in run_bounded(recognize, tiles)}
+    return merge_tiles(tiles, [tsvs[tile] for tile in tiles], image.width, image.height, page_num)
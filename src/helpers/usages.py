@@ -0,0 +1,104 @@
+import os
+import resource
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+
+# the stages of the current request, returned as `_usages`
+_usages: ContextVar[Optional[List[Dict]]] = ContextVar('usages', default=None)
+
+STAGE_SECONDS = Histogram(
+    'ocr_stage_seconds', 'Wall time per processing stage', ['stage'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+STAGE_CPU_SECONDS = Counter('ocr_stage_cpu_seconds', 'CPU time of the process per processing stage, including its threads and ended tesseract processes', ['stage'])
+REQUEST_SECONDS = Histogram(
+    'ocr_request_seconds', 'Wall time per request', ['endpoint', 'status'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+BINARIZATION = Counter('ocr_binarization', 'Preprocessed pages per binarization branch', ['branch'])
+ADMISSION_REJECTED = Counter('ocr_admission_rejected', 'Requests rejected by the upload, pixel and memory limits', ['reason'])
+DEADLINE_EXCEEDED = Counter('ocr_deadline_exceeded', 'Requests and jobs which ran out of time, by the stage running then', ['stage'])
+
+
+def start() -> List[Dict]:
+    """
+    Starts collecting the stages in the current context, returns the list they are added to.
+    """
+    usages = []
+    _usages.set(usages)
+    return usages
+
+
+def stop():
+    _usages.set(None)
+
+
+def current() -> List[Dict]:
+    usages = _usages.get()
+    return usages if usages is not None else []
+
+
+def extend(entries: List[Dict]):
+    # for stages which ran in other processes, their metrics are already recorded there
+    usages = _usages.get()
+    if usages is not None:
+        usages.extend(entries)
+
+
+def _cpu_time() -> float:
+    # of all threads of the process, thus including the OpenMP threads of `tesserocr` and the tile threads, and of ended
+    # child processes like `tesseract`; other work running at the same time in the process, e.g. job threads, is included
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+class Stage:
+    """
+    Measures wall and CPU time of a processing stage, added to `_usages` of the current request and to the metrics.
+
+    Further details can be added to `info` while the stage runs, use as context manager or call `end`.
+    """
+
+    def __init__(self, name: str, **info):
+        self.name = name
+        self.info = info
+        self._start = time.perf_counter()
+        self._cpu_start = _cpu_time()
+
+    def end(self):
+        wall = time.perf_counter() - self._start
+        cpu = _cpu_time() - self._cpu_start
+        STAGE_SECONDS.labels(self.name).observe(wall)
+        STAGE_CPU_SECONDS.labels(self.name).inc(cpu)
+        usages = _usages.get()
+        if usages is not None:
+            usages.append({'stage': self.name, 'wall_ms': round(wall * 1000, 2), 'cpu_ms': round(cpu * 1000, 2), **self.info})
+
+    def __enter__(self):
+        return self.info
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end()
+
+
+def server_timing(usages: List[Dict]) -> str:
+    # summed per stage, for the `Server-Timing` header
+    durations: Dict[str, float] = {}
+    for usage in usages:
+        durations[usage['stage']] = durations.get(usage['stage'], 0) + usage['wall_ms']
+    return ', '.join(f'{name};dur={duration:.2f}' for name, duration in durations.items())
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """
+    The metrics in the Prometheus text format, of all processes when `PROMETHEUS_MULTIPROC_DIR` is set.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
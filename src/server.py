@@ -1,34 +1,55 @@
+import io
 import json
 import logging
+import math
 import os
-import random
+import shutil
 import signal
-import string
 import sys
+import tempfile
+import time
 from pathlib import Path
-from typing import Dict, List
 
 from apiflask import APIFlask, Schema, FileSchema
 import apiflask.fields as fields
 import apiflask.validators as validators
-from flask import render_template, url_for, request, Response
+from flask import g, render_template, url_for, request, Request, Response, stream_with_context
 from flask_cors import CORS
-from pytesseract import pytesseract
-from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 
-from helpers.prepare_files import prepare_files, optimize_image
-from helpers.process_data import process_data
+from helpers import deadline, jobs, limits, scheduler, usages
+from helpers.input_pages import INPUT_EXTENSIONS, is_document, MAX_PDF_DPI
+from helpers.ocr import default_options, default_options_pdf, OptionError, parse_options, process_first_page, process_request, iter_process_request, ocr_to_pdf, ocr_files_to_pdf
+from helpers.ocr_cache import get_cache
+from helpers.ocr_engine import get_engine_info
+from helpers.serialize import COLUMNS_MIMETYPE, LAYOUT_COLUMNS, LAYOUTS, LAYOUT_ROWS, column_page, dumps, json_response, layout_pages, row_page
+import helpers.ocr_jobs  # noqa: F401, registers the job handlers
 
 # todo: https://stackoverflow.com/a/16993115/2073149
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logging.getLogger('PIL').setLevel(logging.INFO)
 
+
+class SpoolingRequest(Request):
+    """
+    Receives larger uploads into named temporary files, which the preprocessing reads by path instead of copying them.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= limits.UPLOAD_SPOOL_KB * 1024:
+            return io.BytesIO()
+        return tempfile.NamedTemporaryFile('wb+')
+
+
 app = APIFlask(
     __name__,
     title='ABC-Soup',
     version='0.0.5',
 )
 CORS(app)
+# larger uploads are received to disk, requests over the limit are rejected while receiving them
+app.request_class = SpoolingRequest
+app.config['MAX_CONTENT_LENGTH'] = limits.MAX_UPLOAD_MB * 1024 * 1024 or None
 
 original_sigint_handler = signal.getsignal(signal.SIGINT)
 
@@ -46,6 +67,84 @@ signal.signal(signal.SIGTERM, on_signal)
 signal.signal(signal.SIGINT, on_signal)
 
 
+@app.before_request
+def before_request():
+    # started lazily, as gunicorn forks the workers after importing
+    jobs.start_workers()
+    g.request_start = time.perf_counter()
+    usages.start()
+
+
+@app.after_request
+def after_request(response):
+    # for streamed responses only until the first byte, their stages are in the trailer
+    endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+    usages.REQUEST_SECONDS.labels(endpoint, response.status_code).observe(time.perf_counter() - g.request_start)
+    timing = usages.server_timing(usages.current())
+    if timing and not response.is_streamed:
+        response.headers['Server-Timing'] = timing
+    return response
+
+
+@app.teardown_request
+def teardown_request(error):
+    usages.stop()
+
+
+def api_error(error: str, status_code: int, headers=None, **details):
+    response = app.json.response({'_usages': usages.current(), 'error': error, **details})
+    response.status_code = status_code
+    response.headers.extend(headers or {})
+    return response
+
+
+def output_layout(options=None) -> str:
+    # by option, else by the `Accept` header
+    if options and options.get('layout'):
+        return options['layout']
+    if request.accept_mimetypes.best_match(['application/json', COLUMNS_MIMETYPE]) == COLUMNS_MIMETYPE:
+        return LAYOUT_COLUMNS
+    return LAYOUT_ROWS
+
+
+def ocr_response(outcome, layout: str, stage_usages=None):
+    # shaped like `OCROutput`/`OCROutputBatch` but without dumping each box through the schema
+    outcome = layout_pages(outcome, layout) if isinstance(outcome, list) else layout_pages([outcome], layout)[0]
+    return json_response(
+        {'_usages': usages.current() if stage_usages is None else stage_usages, 'outcome': outcome},
+        request.accept_encodings,
+        COLUMNS_MIMETYPE if layout == LAYOUT_COLUMNS else 'application/json',
+    )
+
+
+@app.errorhandler(OptionError)
+def option_error(error: OptionError):
+    return api_error(str(error), 400)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(error: RequestEntityTooLarge):
+    usages.ADMISSION_REJECTED.labels('upload').inc()
+    return api_error(f'Request larger than {limits.MAX_UPLOAD_MB} MB', 413)
+
+
+@app.errorhandler(limits.TooLarge)
+def too_large(error: limits.TooLarge):
+    return api_error(str(error), 413)
+
+
+@app.errorhandler(limits.Busy)
+def busy(error: limits.Busy):
+    # about when the memory of the running requests is released, a request waits as long before it is rejected
+    return api_error(str(error), 503, {'Retry-After': str(max(1, math.ceil(limits.MEMORY_WAIT_SECONDS)))})
+
+
+@app.errorhandler(deadline.DeadlineExceeded)
+def deadline_exceeded(error: deadline.DeadlineExceeded):
+    usages.DEADLINE_EXCEEDED.labels(error.stage).inc()
+    return api_error(str(error), 504, stage=error.stage, deadline_seconds=error.seconds)
+
+
 @app.route('/')
 def route_home():
     links = []
@@ -63,88 +162,52 @@ def route_home():
 
 
 class ServerInfo(Schema):
+    engine = fields.String(example='tesserocr')
     languages = fields.List(
         fields.String(),
         example=['eng']
     )
-    tesseract_version = fields.String(example=str(pytesseract.get_tesseract_version()))
+    tesseract_version = fields.String(example='5.3.0')
+    probed_at = fields.Float(metadata={'description': 'Unix time the engine was asked for `languages` and `tesseract_version`, cached per worker until `refresh`.'})
+    cache = fields.Dict(metadata={'description': 'Hits and misses of the OCR result cache of the answering worker, `null` if disabled.'})
+    threads = fields.Dict(metadata={'description': 'CPUs of the container, max. and in-process tesseract threads per call, running calls of all workers and their allocated threads.'})
+    memory = fields.Dict(metadata={'description': 'Memory budget of the answering worker, reserved by running requests, and the upload and pixel limits.'})
+
+
+class ServerInfoQuery(Schema):
+    refresh = fields.Boolean(load_default=False, metadata={'description': 'Probes the engine again, e.g. after installing languages. Only of the answering worker.'})
 
 
 @app.route('/info')
+@app.input(ServerInfoQuery, location='query')
 @app.output(ServerInfo)
 @app.doc(operation_id='info', summary='Get OCR-Engine Info')
-def route_info():
-    return {
-        "languages": pytesseract.get_languages(),
-        "tesseract_version": str(pytesseract.get_tesseract_version()),
-    }
-
-
-def build_config(options: Dict):
-    psm = options.get('psm', None)  # https://tesseract-ocr.github.io/tessdoc/ImproveQuality.html#page-segmentation-method
-    preserve_interword_spaces = options.get('preserve_interword_spaces', None)  # preserve_interword_spaces=1
-
-    config = []
-    if psm is not None:
-        config.append(fr'--psm {psm}')
-    if preserve_interword_spaces is not None:
-        config.append(fr'-c preserve_interword_spaces={preserve_interword_spaces}')
-
-    return config
-
-
-def parse_options(form_options):
-    options = json.loads(form_options) if form_options else default_options
-    if 'lang' in options and isinstance(options['lang'], list):
-        options['lang'] = '+'.join(options['lang'])
-
+def route_info(query_data):
     return {
-        **default_options,
-        **options,
+        **get_engine_info(refresh=query_data['refresh']),
+        "cache": get_cache().info() if get_cache() else None,
+        "threads": scheduler.info(),
+        "memory": limits.info(),
     }
 
 
-default_options_pdf = {
-    'lang': os.environ.get('DEFAULT_LANG', 'eng+deu'),
-    'optimize_images': True,
-    'save_intermediate': False,
-}
-
-default_options = {
-    **default_options_pdf,
-    'optimize_images': False,
-    'intra_block_breaks': True,
-    'keep_details': False,
-}
-
-
-def process_request(files: List[FileStorage], options: Dict):
-    lang = options['lang']
-    optimize_images = options['optimize_images']
-    save_intermediate = options['save_intermediate']
-    intra_block_breaks = options['intra_block_breaks']
-    keep_details = options['keep_details']
-    config = build_config(options)
-
-    image_paths, infer_file, infer_id = prepare_files(files, optimize=optimize_images, save_intermediate=save_intermediate)
-
-    text: str = pytesseract.image_to_data(
-        infer_file, lang=lang,
-        config=' '.join(config),
-    )
-
-    for image_path in image_paths:
-        os.unlink(image_path)
-    if infer_file not in image_paths:
-        os.unlink(infer_file)
-
-    return process_data(files, text, intra_block_breaks, keep_details)
+@app.get('/metrics')
+@app.doc(operation_id='metrics', summary='Get metrics in the Prometheus text format', description="""Stage durations, requests and binarization branches; of all workers when `PROMETHEUS_MULTIPROC_DIR` is set.""", responses={
+    200: {
+        'description': 'The metrics',
+        'content': {'text/plain': {'schema': {'type': 'string'}}},
+    },
+})
+def route_metrics():
+    metrics, content_type = usages.render_metrics()
+    return Response(metrics, content_type=content_type)
 
 
 class OCROptions(Schema):
     # todo: lang can be string or array, doesn't matter as long as the validation for `options` isn't activated in APIFlask
     lang = fields.String(required=True)
     optimize_images = fields.Boolean()
+    preprocess = fields.String(metadata={'description': 'Preprocessing profile like `auto`, `threshold` or `none`, or comma separated steps; replaces `optimize_images`.'})
     save_intermediate = fields.Boolean()
     intra_block_breaks = fields.Boolean()
     keep_details = fields.Boolean()
@@ -152,10 +215,17 @@ class OCROptions(Schema):
         externalDocs='https://tesseract-ocr.github.io/tessdoc/ImproveQuality.html#page-segmentation-method'
     )
     preserve_interword_spaces = fields.Integer()
+    tiles = fields.Boolean(allow_none=True, metadata={'description': 'Splits pages into tiles which are recognized in parallel, by default only for pages with at least `TILE_MIN_PIXELS`.'})
+    regions = fields.Boolean(metadata={'description': 'Recognizes only the regions of a page with text when they cover at most `REGIONS_MAX_COVERAGE` of it; rejected by the PDF endpoints, which recognize whole pages.'})
+    dpi = fields.Integer(validate=validators.Range(1, MAX_PDF_DPI), metadata={'description': f'Resolution for rasterizing PDF pages, defaults to `PDF_DPI`, at most {MAX_PDF_DPI}.'})
+    stream = fields.Boolean(metadata={'description': 'Only for the *batch* endpoint; Responds with NDJSON, one page per line.'})
+    refine = fields.Boolean(metadata={'description': 'Recognizes blocks with low confidence again with other preprocessing and page segmentation, keeping the better words; not for the PDF endpoints.'})
+    deadline = fields.Float(metadata={'description': 'Seconds the request may take, at most `OCR_DEADLINE_SECONDS`; when passed, the running stage is cancelled and it fails with a 504.'})
+    layout = fields.String(validate=validators.OneOf(LAYOUTS), metadata={'description': 'With `columns` the boxes of each block are returned as parallel arrays in `columns`, same as with the header `Accept: application/vnd.abc-soup.columns+json`.'})
 
 
 class OCRInput(Schema):
-    file = fields.File(required=True, validate=[validators.FileType(['.png', '.jpg', '.jpeg'])])
+    file = fields.File(required=True, validate=[validators.FileType(INPUT_EXTENSIONS)], metadata={'description': 'For PDF/TIFF only the first page with text is returned, use the *batch* endpoint for all pages.'})
     # todo: refactor to other field based strings for API-interface and internally mapping to clean flags
     options = fields.String(example=json.dumps(default_options))
     # options = OCROptions()
@@ -176,7 +246,7 @@ class OCRInputBatch(Schema):
     #       as long as it can't validate dynamic length files, it can't be used for batch-input
     # files = fields.Dict(
     #     fields.String(),
-    #     fields.File(required=True, validate=[validators.FileType(['.png', '.jpg', '.jpeg'])]),
+    #     fields.File(required=True, validate=[validators.FileType(INPUT_EXTENSIONS)]),
     #     minProperties=1,
     #
     # todo: refactor to other field based strings for API-interface and internally mapping to clean flags
@@ -185,7 +255,7 @@ class OCRInputBatch(Schema):
 
 
 class OCRInputForPDF(Schema):
-    file = fields.File(required=True, validate=[validators.FileType(['.png', '.jpg', '.jpeg'])])
+    file = fields.File(required=True, validate=[validators.FileType(INPUT_EXTENSIONS)])
     # todo: refactor to other field based strings for API-interface and internally mapping to clean flags
     options = fields.String(example=json.dumps(default_options_pdf))
     # options = OCROptions()
@@ -205,9 +275,25 @@ class ExtractedBox(Schema):
     conf = fields.Float()
 
 
+class ExtractedColumns(Schema):
+    """
+    The boxes of a block as parallel arrays, the i-th entries of all arrays are one box
+    """
+    level = fields.List(fields.Integer())
+    par_num = fields.List(fields.Integer())
+    line_num = fields.List(fields.Integer())
+    word_num = fields.List(fields.Integer())
+    left = fields.List(fields.Integer())
+    top = fields.List(fields.Integer())
+    width = fields.List(fields.Integer())
+    height = fields.List(fields.Integer())
+    conf = fields.List(fields.Float())
+
+
 class ExtractedBlock(Schema):
     block = fields.Integer(metadata={'description': 'The ID of the first box in this block'})
     boxes = fields.List(fields.Nested(ExtractedBox()), metadata={'description': 'All boxes with their respective position and text'})
+    columns = fields.Nested(ExtractedColumns(), metadata={'description': 'Only with the `columns` layout, instead of `boxes`.'})
     # text = fields.String(metadata={'description': """The text of all boxes in this block, using the positions to concatenate the texts of a box with the next one depending if below or right to the previous box, either with whitespaces or newlines.
     text = fields.String(metadata={'description': """The text of all boxes in this block, depending on the boxes positions either concatenated with whitespaces or newlines.
 
@@ -218,7 +304,7 @@ class OCROutcome(Schema):
     """
     Result of OCR inference
     """
-    page = fields.Integer(metadata={'description': 'Number of the page, only the *batch* endpoint returns multiple, each page is one input file.'})
+    page = fields.Integer(metadata={'description': 'Number of the page, the *batch* endpoint returns multiple, each image is one page; for PDF/TIFF files it is the page number inside of the `file`.'})
     file = fields.String(metadata={'description': 'Name of the input file.'})
     content = fields.String(metadata={'description': 'Only if `keep_details` is `false`; The full content of the pages blocks as a combined string.'})
     blocks = fields.List(
@@ -228,20 +314,56 @@ class OCROutcome(Schema):
 
 
 class OCROutput(Schema):
-    _usages = fields.List(fields.Dict())
+    _usages = fields.List(fields.Dict(), metadata={'description': 'Processing stages with `stage`, `wall_ms`, `cpu_ms` and details.'})
     outcome = fields.Nested(OCROutcome())
 
 
 class OCROutputBatch(Schema):
-    _usages = fields.List(fields.Dict())
+    _usages = fields.List(fields.Dict(), metadata={'description': 'Processing stages with `stage`, `wall_ms`, `cpu_ms` and details.'})
     outcome = fields.List(fields.Nested(OCROutcome()))
 
 
+class PageError(Schema):
+    page = fields.Integer(allow_none=True, metadata={'description': '`null` if the whole document could not be read or the deadline passed.'})
+    file = fields.String(allow_none=True)
+    error = fields.String()
+    stage = fields.String(metadata={'description': 'Only when the deadline passed; The stage which ran out of time, the remaining pages are missing.'})
+
+
+class OCRStreamTrailer(Schema):
+    """
+    Last line of a streamed batch response
+    """
+    _usages = fields.List(fields.Dict(), metadata={'description': 'Processing stages with `stage`, `wall_ms`, `cpu_ms` and details.'})
+    errors = fields.List(fields.Nested(PageError()), metadata={'description': 'Pages which failed, these are missing in the stream.'})
+
+
 class ApiError(Schema):
-    _usages = fields.List(fields.Dict())
+    _usages = fields.List(fields.Dict(), metadata={'description': 'Processing stages with `stage`, `wall_ms`, `cpu_ms` and details.'})
     error = fields.String()
 
 
+class DeadlineError(ApiError):
+    stage = fields.String(metadata={'description': 'The stage which ran out of time, one of `admit`, `decode`, `preprocess` or `ocr`.'})
+    deadline_seconds = fields.Float()
+
+
+limit_error_responses = {
+    413: {
+        'description': 'Upload, pixels of a page or the estimated memory exceed the limits',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+    503: {
+        'description': 'Not enough memory available in time, retry later',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+    504: {
+        'description': 'The deadline passed, the running stage was cancelled',
+        'content': {'application/json': {'schema': DeadlineError}},
+    },
+}
+
+
 @app.post('/ocr')
 @app.input(OCRInput, location='form_and_files')
 @app.output(OCROutput)
@@ -254,7 +376,8 @@ class ApiError(Schema):
                 'schema': ApiError
             }
         }
-    }
+    },
+    **limit_error_responses,
 })
 def route_ocr(form_and_files_data):
     file = form_and_files_data['file']
@@ -262,20 +385,20 @@ def route_ocr(form_and_files_data):
         return {'error': 'Missing "file"'}, 400
 
     options = parse_options(form_and_files_data['options'] if 'options' in form_and_files_data else None)
-    pages = process_request([file], options)
+    with deadline.within(deadline.request_seconds(options)), limits.admit([file], options):
+        page = process_first_page(file, options)
 
-    return {
-        '_usages': [],
-        # 'outcome': None if not pages else pages[0]['blocks'] if options['keep_details'] else pages[0]['content'],
-        'outcome': None if not pages else pages[0],
-    }
+    # 'outcome': None if not pages else pages[0]['blocks'] if options['keep_details'] else pages[0]['content'],
+    return ocr_response(page, output_layout(options))
 
 
 @app.post('/ocr-batch')
 # @app.input(OCRInputBatch, location='form_and_files')
 @app.output(OCROutputBatch)
 # todo: get this working with multiple `.output` instead of the full response doc https://github.com/apiflask/apiflask/issues/327
-@app.doc(operation_id='ocr_batch', summary='Run OCR on multiple files', responses={
+@app.doc(operation_id='ocr_batch', summary='Run OCR on multiple files', description="""With the header `Accept: application/x-ndjson` or option `stream: true` responds with one `OCROutcome` per line as soon as each page is ready, the last line is the `OCRStreamTrailer`.
+
+With the header `Accept: application/vnd.abc-soup.columns+json` or option `layout: columns` the boxes of each block are returned as parallel arrays, responses are compressed for `Accept-Encoding: gzip` or `zstd`.""", responses={
     400: {
         'description': 'API Error',
         'content': {
@@ -283,23 +406,49 @@ def route_ocr(form_and_files_data):
                 'schema': ApiError
             }
         }
-    }
+    },
+    **limit_error_responses,
 })
 def route_ocr_batch():
     # files = form_and_files_data['files']
-    # todo: support order-in-form and PDF
-    files = list(request.files.values())
+    # in form order, also with multiple files in the same field
+    files = [file for _, file in request.files.items(multi=True)]
     if not files:
         return {'error': 'Missing files'}, 400
 
     options = parse_options(request.form['options'] if 'options' in request.form else None)
     # options = parse_options(form_and_files_data['options'] if 'options' in form_and_files_data else None)
-    pages = process_request(files, options)
-
-    return {
-        '_usages': [],
-        'outcome': pages,
-    }
+    if options.get('stream') or request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+        with deadline.within(deadline.request_seconds(options)) as request_deadline:
+            reservation = limits.admit(files, options)
+        response = Response(stream_with_context(stream_ocr_batch(files, options, output_layout(options), reservation, request_deadline)), content_type='application/x-ndjson')
+        # also when the client disconnects before the stream ended
+        response.call_on_close(reservation.release)
+        return response
+
+    # without documents all preprocessed images are kept until recognized together
+    with deadline.within(deadline.request_seconds(options)), limits.admit(files, options, all_pages_held=not any(is_document(file) for file in files)):
+        pages = process_request(files, options)
+
+    return ocr_response(pages, output_layout(options))
+
+
+def stream_ocr_batch(files, options, layout, reservation, request_deadline):
+    # one `OCROutcome` per line, as soon as the page is ready; the last line is the `OCRStreamTrailer`
+    to_layout = column_page if layout == LAYOUT_COLUMNS else row_page
+    errors = []
+    # the deadline started with the request, not with the stream
+    with deadline.restore(request_deadline), reservation:
+        try:
+            for page_num, file, page, error in iter_process_request(files, options):
+                if error:
+                    errors.append({'page': page_num, 'file': file.filename, 'error': str(error) or type(error).__name__})
+                elif page:
+                    yield dumps(to_layout(page)) + b'\n'
+        except deadline.DeadlineExceeded as e:
+            usages.DEADLINE_EXCEEDED.labels(e.stage).inc()
+            errors.append({'page': None, 'file': None, 'error': str(e), 'stage': e.stage})
+    yield dumps(OCRStreamTrailer().dump({'_usages': usages.current(), 'errors': errors})) + b'\n'
 
 
 @app.post('/ocr-to-pdf')
@@ -318,7 +467,8 @@ def route_ocr_batch():
                 'schema': ApiError
             }
         }
-    }
+    },
+    **limit_error_responses,
 })
 def route_ocr_to_pdf(form_and_files_data):
     file = form_and_files_data['file']
@@ -330,22 +480,206 @@ def route_ocr_to_pdf(form_and_files_data):
     if 'keep_details' in request.form:
         return {'error': 'Option `keep_details` not supported'}, 400
 
-    options = parse_options(form_and_files_data['options'] if 'options' in form_and_files_data else None)
-    lang = options['lang']
-    optimize_images = options['optimize_images']
-    save_intermediate = options['save_intermediate']
-    config = build_config(options)
-
-    infer_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-    pil_image = optimize_image(file, optimize_images, f'/app/shared-assets/pdf_{infer_id}_' if save_intermediate else None)
-
-    binary_pdf = pytesseract.image_to_pdf_or_hocr(
-        pil_image, lang=lang,
-        config=' '.join(config),
-        extension='pdf',
-    )
+    options = parse_options(form_and_files_data['options'] if 'options' in form_and_files_data else None, pdf=True)
+    with deadline.within(deadline.request_seconds(options)), limits.admit([file], options):
+        binary_pdf = ocr_to_pdf(file, options)
 
     filename = Path(file.filename).stem
     response = Response(binary_pdf, content_type='application/pdf')
     response.headers['Content-Disposition'] = f'inline; filename="{filename}.pdf"'
     return response
+
+
+@app.post('/ocr-batch-to-pdf')
+@app.output(
+    FileSchema(type='string', format='binary'),
+    content_type='application/pdf',
+    description='One PDF with all pages, the header `X-Page-Memory-Peak` contains the bytes of the largest preprocessed page, which is the only one in memory'
+)
+@app.doc(operation_id='ocr_batch_pdf', summary='Generate one PDF from multiple files', description="""Pages are in form order, each page of a PDF/TIFF is added as a separate page.""", responses={
+    400: {
+        'description': 'API Error',
+        'content': {
+            'application/json': {
+                'schema': ApiError
+            }
+        }
+    },
+    **limit_error_responses,
+})
+def route_ocr_batch_to_pdf():
+    files = [file for _, file in request.files.items(multi=True)]
+    if not files:
+        return api_error('Missing files', 400)
+    unsupported = [file.filename for file in files if Path(file.filename or '').suffix.lower() not in INPUT_EXTENSIONS]
+    if unsupported:
+        return api_error(f'Unsupported file types {unsupported}', 400)
+
+    options = parse_options(request.form['options'] if 'options' in request.form else None, pdf=True)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with deadline.within(deadline.request_seconds(options)), limits.admit(files, options):
+            pdf_path, page_memory_peak = ocr_files_to_pdf(files, options, tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    # streamed from disk, the directory is removed after sending
+    response = Response(stream_file(pdf_path, tmp_dir), content_type='application/pdf')
+    response.headers['Content-Length'] = str(os.path.getsize(pdf_path))
+    response.headers['Content-Disposition'] = f'inline; filename="{Path(files[0].filename).stem}.pdf"'
+    response.headers['X-Page-Memory-Peak'] = str(page_memory_peak)
+    return response
+
+
+def stream_file(path, remove_dir, chunk_size=64 * 1024):
+    try:
+        with open(path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+    finally:
+        shutil.rmtree(remove_dir, ignore_errors=True)
+
+
+class JobInput(Schema):
+    file = fields.File(required=True, validate=[validators.FileType(INPUT_EXTENSIONS)])
+    options = fields.String(example=json.dumps(default_options))
+    priority = fields.Integer(load_default=0, metadata={'description': 'Jobs with a higher priority are processed first.'})
+
+
+class JobInputBatch(Schema):
+    options = fields.String(example=json.dumps(default_options))
+    priority = fields.Integer(load_default=0, metadata={'description': 'Jobs with a higher priority are processed first.'})
+
+
+class JobInputForPDF(Schema):
+    file = fields.File(required=True, validate=[validators.FileType(INPUT_EXTENSIONS)])
+    options = fields.String(example=json.dumps(default_options_pdf))
+    priority = fields.Integer(load_default=0, metadata={'description': 'Jobs with a higher priority are processed first.'})
+
+
+class JobStatus(Schema):
+    job_id = fields.String()
+    kind = fields.String()
+    priority = fields.Integer()
+    status = fields.String(metadata={'description': 'One of `queued`, `running`, `done` or `failed`.'})
+    error = fields.String(allow_none=True)
+    queue_position = fields.Integer(metadata={'description': 'Only if `queued`; Number of jobs processed before this one.'})
+    files = fields.List(fields.String())
+    created = fields.Float()
+    started = fields.Float(allow_none=True)
+    finished = fields.Float(allow_none=True)
+
+
+job_error_responses = {
+    413: limit_error_responses[413],
+    429: {
+        'description': 'Queue is full, retry later',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+    503: {
+        'description': 'No job workers available',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+}
+
+
+def enqueue_job(kind, files, options, priority):
+    # rejected right away, instead of failing when the job runs
+    limits.check(files, options, all_pages_held=True)
+    try:
+        job_id = jobs.enqueue(kind, files, options, priority)
+    except jobs.QueueFull:
+        return api_error('Too many queued jobs', 429, {'Retry-After': '10'})
+    except jobs.NoWorkers:
+        return api_error('No job workers available', 503, {'Retry-After': '30'})
+    return jobs.get_job(job_id), 202, {'Location': url_for('route_job', job_id=job_id)}
+
+
+@app.post('/jobs/ocr')
+@app.input(JobInput, location='form_and_files')
+@app.output(JobStatus, status_code=202)
+@app.doc(operation_id='job_ocr', summary='Queue OCR on a single file', responses=job_error_responses)
+def route_job_ocr(form_and_files_data):
+    options = parse_options(form_and_files_data['options'] if 'options' in form_and_files_data else None)
+    return enqueue_job('ocr', [form_and_files_data['file']], options, form_and_files_data['priority'])
+
+
+@app.post('/jobs/ocr-batch')
+# only the form fields, the files are read from the request as their count varies
+@app.input(JobInputBatch, location='form')
+@app.output(JobStatus, status_code=202)
+@app.doc(operation_id='job_ocr_batch', summary='Queue OCR on multiple files', responses={
+    400: {
+        'description': 'API Error',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+    **job_error_responses,
+})
+def route_job_ocr_batch(form_data):
+    files = [file for _, file in request.files.items(multi=True)]
+    if not files:
+        return api_error('Missing files', 400)
+
+    options = parse_options(form_data['options'] if 'options' in form_data else None)
+    return enqueue_job('ocr-batch', files, options, form_data['priority'])
+
+
+@app.post('/jobs/ocr-to-pdf')
+@app.input(JobInputForPDF, location='form_and_files')
+@app.output(JobStatus, status_code=202)
+@app.doc(operation_id='job_ocr_pdf', summary='Queue PDF generation from single file', responses=job_error_responses)
+def route_job_ocr_to_pdf(form_and_files_data):
+    options = parse_options(form_and_files_data['options'] if 'options' in form_and_files_data else None, pdf=True)
+    return enqueue_job('ocr-to-pdf', [form_and_files_data['file']], options, form_and_files_data['priority'])
+
+
+@app.get('/jobs/<job_id>')
+@app.output(JobStatus)
+@app.doc(operation_id='job', summary='Get the status of a job', responses={
+    404: {
+        'description': 'Unknown or expired job',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+})
+def route_job(job_id):
+    job = jobs.get_job(job_id)
+    if not job:
+        return api_error('Unknown job', 404)
+    return job
+
+
+@app.get('/jobs/<job_id>/result')
+@app.doc(operation_id='job_result', summary='Get the result of a finished job', responses={
+    200: {
+        'description': 'The result like returned by the respective endpoint',
+        'content': {
+            'application/json': {'schema': OCROutputBatch},
+            'application/pdf': {'schema': {'type': 'string', 'format': 'binary'}},
+        },
+    },
+    404: {
+        'description': 'Unknown or expired job',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+    409: {
+        'description': 'Job not finished or failed',
+        'content': {'application/json': {'schema': ApiError}},
+    },
+})
+def route_job_result(job_id):
+    job = jobs.get_job(job_id)
+    if not job:
+        return api_error('Unknown job', 404)
+    if job['status'] != 'done':
+        return api_error(job['error'] if job['status'] == 'failed' else f'Job is {job["status"]}', 409)
+
+    with open(jobs.result_path(job_id), 'rb') as file:
+        result = file.read()
+    if job['kind'] == 'ocr-to-pdf':
+        response = Response(result, content_type='application/pdf')
+        response.headers['Content-Disposition'] = f'inline; filename="{Path(job["files"][0]).stem}.pdf"'
+        return response
+
+    result = json.loads(result)
+    return ocr_response(result['outcome'], output_layout(), result['_usages'])
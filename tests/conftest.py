@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app runs from `src`, its packages are imported like there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,48 @@
+import pickle
+import time
+
+import pytest
+
+from helpers import deadline
+
+
+def test_without_deadline():
+    assert deadline.current() is None and deadline.remaining() is None
+    deadline.check('stage')
+
+
+def test_within():
+    with deadline.within(10) as outer:
+        assert outer.seconds == 10 and 9 < deadline.remaining() <= 10
+        # a nested deadline can only shorten it
+        with deadline.within(60) as inner:
+            assert inner == outer
+        with deadline.within(1) as inner:
+            assert inner.seconds == 1 and deadline.remaining() <= 1
+        with deadline.within(None):
+            assert deadline.current() == outer
+        assert deadline.current() == outer
+    assert deadline.current() is None
+
+
+def test_check():
+    with deadline.within(0.01):
+        time.sleep(0.02)
+        with pytest.raises(deadline.DeadlineExceeded) as error:
+            deadline.check('ocr')
+    assert error.value.stage == 'ocr' and 'ocr' in str(error.value)
+
+
+def test_exceeded_pickles():
+    error = pickle.loads(pickle.dumps(deadline.DeadlineExceeded('preprocess', 2.5)))
+    assert (error.stage, error.seconds, str(error)) == ('preprocess', 2.5, 'Deadline of 2.5s exceeded in stage `preprocess`')
+
+
+def test_request_seconds(monkeypatch):
+    monkeypatch.setattr(deadline, 'OCR_DEADLINE_SECONDS', 25.0)
+    assert deadline.request_seconds({}) == 25
+    assert deadline.request_seconds({'deadline': 5}) == 5
+    # only shortens the deadline of the server
+    assert deadline.request_seconds({'deadline': 60}) == 25
+    monkeypatch.setattr(deadline, 'OCR_DEADLINE_SECONDS', 0.0)
+    assert deadline.request_seconds({}) is None
@@ -0,0 +1,38 @@
+import cv2
+import numpy as np
+from PIL import Image
+
+from helpers.detect_lang import classify, CROP_MIN_HEIGHT, CROP_WIDTH, text_crop
+
+
+def page(font_scale: float, width: int, height: int) -> Image.Image:
+    image = np.full((height, width), 255, np.uint8)
+    line_height = int(40 * font_scale)
+    for y in range(line_height * 2, height - line_height, line_height):
+        cv2.putText(image, 'the quick brown fox jumps over the lazy dog ' * 4, (20, y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 0, max(1, int(font_scale * 2)))
+    return Image.fromarray(image)
+
+
+def test_text_crop_large_letters_scaled_down():
+    image = page(4.0, 6000, 8000)
+    crop = text_crop(image)
+    assert crop.info['scale'] < 1
+    # the crop covers the same text as a crop of a page with letters of the target height
+    assert crop.width <= CROP_WIDTH + 1
+    assert crop.height >= CROP_MIN_HEIGHT - 1
+    assert crop.width * crop.height < 6000 * 8000 * crop.info['scale'] ** 2
+
+
+def test_text_crop_small_letters_unscaled():
+    image = page(0.7, 3000, 4000)
+    crop = text_crop(image)
+    assert crop.info['scale'] == 1.0
+    assert crop.size == (CROP_WIDTH, max(CROP_MIN_HEIGHT, 4000 // 8))
+
+
+def test_classify():
+    words = 'der Hund und die Katze sind in dem Haus mit der Maus für uns'.split()
+    langs, scores = classify(words, ['eng', 'deu'])
+    assert langs == ['deu']
+    assert scores['deu'] > scores['eng']
+    assert classify(words[:3], ['eng', 'deu'])[0] is None
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from benchmarks.find_darkest_areas import find_darkest_areas_loop, make_images
+from helpers.optimize_image import find_darkest_areas
+
+
+@pytest.mark.parametrize('rect', [1, 3, 5])
+@pytest.mark.parametrize('height, width', [(12, 12), (7, 9), (64, 48), (31, 150)])
+def test_equal_to_loop(height, width, rect):
+    # gray, single channel and RGB pages, with and without an area dark enough to end the search early
+    for name, image in make_images(np.random.default_rng(height * width + rect), height, width).items():
+        assert find_darkest_areas(image, rect=rect) == find_darkest_areas_loop(image, rect=rect), name
+
+
+@pytest.mark.parametrize('shape', [(20, 20), (20, 20, 1), (20, 20, 3)])
+def test_first_very_dark_area_wins(shape):
+    image = np.full(shape, 255, dtype=np.uint8)
+    # the darker area comes later in row-major order, the search ends at the first one at most 0.01
+    image[4:7, 10:13] = 2
+    image[12:15, 2:5] = 0
+    assert find_darkest_areas(image, rect=3) == find_darkest_areas_loop(image, rect=3) == pytest.approx(2 / 255)
+
+
+@pytest.mark.parametrize('channels', [None, 1, 3])
+@pytest.mark.parametrize('height, width, rect', [
+    # no area offsets left, as the last two rows or columns aren't searched
+    (6, 20, 5), (20, 6, 5), (6, 6, 5), (5, 20, 5), (1, 1, 1), (2, 2, 1), (4, 10, 3), (10, 4, 3),
+    # a single row or column of offsets
+    (7, 20, 5), (20, 7, 5), (3, 3, 1),
+])
+def test_edge_sizes(height, width, rect, channels):
+    shape = (height, width) if channels is None else (height, width, channels)
+    image = np.random.default_rng(height * width).integers(0, 256, size=shape, dtype=np.uint8)
+    expected = find_darkest_areas_loop(image, rect=rect)
+    assert find_darkest_areas(image, rect=rect) == expected
+    if height - rect - 1 <= 0 or width - rect - 1 <= 0:
+        assert expected == float('inf')
+
+
+@pytest.mark.parametrize('shape', [(10, 10, 2), (10, 10, 4), (10,)])
+def test_unsupported_shape(shape):
+    image = np.zeros(shape, dtype=np.uint8)
+    with pytest.raises(ValueError):
+        find_darkest_areas(image)
+    with pytest.raises(ValueError):
+        find_darkest_areas_loop(image)
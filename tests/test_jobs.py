@@ -0,0 +1,195 @@
+import io
+import json
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from helpers import jobs
+
+
+def png(width=40, height=30) -> bytes:
+    data = io.BytesIO()
+    Image.fromarray(np.full((height, width), 255, dtype=np.uint8)).save(data, 'PNG')
+    return data.getvalue()
+
+
+def upload(name='page.png') -> FileStorage:
+    return FileStorage(io.BytesIO(png()), filename=name)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # a queue of its own with a single registered worker, no threads run the jobs
+    monkeypatch.setattr(jobs, 'JOBS_DIR', str(tmp_path))
+    monkeypatch.setattr(jobs, 'start_workers', lambda count=0: None)
+    jobs.init_store()
+    jobs.heartbeat('test-worker')
+    return tmp_path
+
+
+def test_enqueue_stores_the_files(store):
+    job_id = jobs.enqueue('ocr', [upload('a.png'), upload('b.png')], {'lang': 'eng'})
+    job = jobs.get_job(job_id)
+    assert (job['kind'], job['status'], job['files'], job['queue_position']) == ('ocr', 'queued', ['a.png', 'b.png'], 0)
+    assert sorted(path.name for path in (store / job_id).iterdir()) == ['0_a.png', '1_b.png']
+
+
+def test_enqueue_without_workers(store):
+    with jobs.connect() as db:
+        db.execute('DELETE FROM workers')
+    with pytest.raises(jobs.NoWorkers):
+        jobs.enqueue('ocr', [upload()], {})
+
+
+def test_claim_by_priority(store):
+    low = jobs.enqueue('ocr', [upload()], {}, priority=0)
+    high = jobs.enqueue('ocr', [upload()], {}, priority=5)
+    later_low = jobs.enqueue('ocr', [upload()], {}, priority=0)
+    assert jobs.get_job(later_low)['queue_position'] == 2
+    # the highest priority first, then in the order they were queued
+    assert [jobs.claim_job()['id'] for _ in range(3)] == [high, low, later_low]
+    assert jobs.claim_job() is None
+    assert jobs.get_job(high)['status'] == 'running'
+
+
+def test_queue_full(store, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_MAX_QUEUED', 2)
+    jobs.enqueue('ocr', [upload()], {})
+    jobs.enqueue('ocr', [upload()], {})
+    with pytest.raises(jobs.QueueFull):
+        jobs.enqueue('ocr', [upload()], {})
+    # the files of the rejected job aren't kept
+    assert len([path for path in store.iterdir() if path.is_dir()]) == 2
+
+
+def test_queue_full_is_429(store, monkeypatch):
+    import server
+
+    monkeypatch.setattr(jobs, 'JOBS_MAX_QUEUED', 1)
+    client = server.app.test_client()
+    response = client.post('/jobs/ocr', data={'file': (io.BytesIO(png()), 'page.png')})
+    assert response.status_code == 202
+    response = client.post('/jobs/ocr', data={'file': (io.BytesIO(png()), 'page.png')})
+    assert response.status_code == 429
+    assert response.headers['Retry-After']
+
+
+def test_run_job(store):
+    jobs.register_handler('test', lambda files, options: ('text/plain', b''.join(file.read()[:4] for file in files) + options['suffix'].encode()))
+    job_id = jobs.enqueue('test', [upload()], {'suffix': '!'})
+    jobs.run_job(jobs.claim_job())
+    job = jobs.get_job(job_id)
+    assert (job['status'], job['content_type'], job['error']) == ('done', 'text/plain', None)
+    with open(jobs.result_path(job_id), 'rb') as file:
+        assert file.read() == png()[:4] + b'!'
+    # the uploads are removed, the result is kept
+    assert [path.name for path in (store / job_id).iterdir()] == ['result']
+
+
+def test_failing_job(store):
+    def fail(files, options):
+        raise RuntimeError('broken')
+
+    jobs.register_handler('fail', fail)
+    job_id = jobs.enqueue('fail', [upload()], {})
+    jobs.run_job(jobs.claim_job())
+    assert (jobs.get_job(job_id)['status'], jobs.get_job(job_id)['error']) == ('failed', 'broken')
+
+
+def test_result_ttl_cleanup(store, monkeypatch):
+    jobs.register_handler('test', lambda files, options: ('text/plain', b'ok'))
+    job_id = jobs.enqueue('test', [upload()], {})
+    jobs.run_job(jobs.claim_job())
+    jobs.cleanup()
+    assert jobs.get_job(job_id)['status'] == 'done'
+
+    with jobs.connect() as db:
+        db.execute('UPDATE jobs SET finished = ? WHERE id = ?', (time.time() - jobs.JOBS_RESULT_TTL - 1, job_id))
+    jobs.cleanup()
+    assert jobs.get_job(job_id) is None
+    assert not (store / job_id).exists()
+
+
+def test_lost_job_recovery(store):
+    job_id = jobs.enqueue('ocr', [upload()], {})
+    jobs.claim_job()
+    jobs.cleanup()
+    assert jobs.get_job(job_id)['status'] == 'running'
+
+    # e.g. its worker was killed while running it
+    with jobs.connect() as db:
+        db.execute('UPDATE jobs SET started = ? WHERE id = ?', (time.time() - jobs.JOBS_RUNNING_TIMEOUT - 1, job_id))
+    jobs.cleanup()
+    assert (jobs.get_job(job_id)['status'], jobs.get_job(job_id)['error']) == ('failed', 'job lost')
+
+
+def test_job_of_stopped_worker_recovery(store):
+    job_id = jobs.enqueue('ocr', [upload()], {})
+    jobs.claim_job('test-worker')
+    jobs.cleanup()
+    assert jobs.get_job(job_id)['status'] == 'running'
+
+    # e.g. killed with its container, the heartbeats stop
+    with jobs.connect() as db:
+        db.execute('UPDATE workers SET seen = ?', (time.time() - jobs.WORKER_HEARTBEAT_TIMEOUT - 1,))
+    jobs.cleanup()
+    assert (jobs.get_job(job_id)['status'], jobs.get_job(job_id)['error']) == ('failed', 'job lost, its worker stopped')
+
+
+def test_store_of_earlier_version(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_DIR', str(tmp_path))
+    with jobs.connect() as db:
+        db.execute('CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT, priority INTEGER, status TEXT, options TEXT, files TEXT, '
+                   'content_type TEXT, error TEXT, created REAL, started REAL, finished REAL)')
+    jobs.init_store()
+    jobs.heartbeat('test-worker')
+    job_id = jobs.enqueue('ocr', [upload()], {})
+    jobs.claim_job('test-worker')
+    with jobs.connect() as db:
+        assert db.execute('SELECT worker FROM jobs WHERE id = ?', (job_id,)).fetchone()[0] == 'test-worker'
+
+
+def test_worker_survives_broken_job(store, monkeypatch):
+    import threading
+
+    job_id = jobs.enqueue('ocr', [upload()], {})
+    # its files are gone, opening them fails before the handler runs
+    for path in json.loads(jobs.claim_job()['files']):
+        (store / job_id / path[1].rsplit('/', 1)[-1]).unlink()
+    with jobs.connect() as db:
+        db.execute("UPDATE jobs SET status = 'queued' WHERE id = ?", (job_id,))
+
+    stop = threading.Event()
+    worker = threading.Thread(target=jobs.work, args=(stop, 'test-worker', 0.01))
+    worker.start()
+    try:
+        for _ in range(200):
+            if jobs.get_job(job_id)['status'] == 'failed':
+                break
+            time.sleep(0.01)
+        assert jobs.get_job(job_id)['status'] == 'failed'
+        assert worker.is_alive()
+    finally:
+        stop.set()
+        worker.join()
+
+
+@pytest.mark.parametrize('route, files', [('/jobs/ocr', {'file': 'page.png'}), ('/jobs/ocr-batch', {'a': 'a.png', 'b': 'b.png'})])
+def test_priority_of_routes(store, route, files):
+    import server
+
+    client = server.app.test_client()
+
+    def post(**form):
+        return client.post(route, data={**{field: (io.BytesIO(png()), name) for field, name in files.items()}, **form})
+
+    response = post(priority='high')
+    assert response.status_code == server.app.config['VALIDATION_ERROR_STATUS_CODE']
+    response = post(priority='3', options=json.dumps({'lang': 'eng'}))
+    assert response.status_code == 202
+    job = jobs.get_job(response.json['job_id'])
+    assert (job['priority'], job['files']) == (3, list(files.values()))
+    assert jobs.get_job(post().json['job_id'])['priority'] == 0
@@ -0,0 +1,80 @@
+import io
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from helpers import deadline, limits
+from helpers.limits import Busy, MemoryBudget, TooLarge
+
+
+def image_file(width, height, name='page.png') -> FileStorage:
+    data = io.BytesIO()
+    Image.fromarray(np.full((height, width), 255, dtype=np.uint8)).save(data, 'PNG')
+    data.seek(0)
+    return FileStorage(data, filename=name)
+
+
+def test_check():
+    budget = MemoryBudget(1000)
+    budget.check(1000)
+    with pytest.raises(TooLarge):
+        budget.check(1001)
+    # unlimited
+    MemoryBudget(None).check(10 ** 12)
+
+
+def test_acquire_and_release():
+    budget = MemoryBudget(1000)
+    first = budget.acquire(600)
+    assert budget.reserved == 600
+    with pytest.raises(Busy):
+        budget.acquire(600, wait=0.05)
+    first.release()
+    # safe to release twice
+    first.release()
+    assert budget.reserved == 0
+    with budget.acquire(1000):
+        assert budget.info()['reserved_mb'] == 0 and budget.reserved == 1000
+    assert budget.reserved == 0
+
+
+def test_acquire_waits_for_release():
+    budget = MemoryBudget(1000)
+    first = budget.acquire(800)
+    threading.Timer(0.05, first.release).start()
+    with budget.acquire(800, wait=5):
+        assert budget.reserved == 800
+
+
+def test_acquire_ends_with_deadline():
+    budget = MemoryBudget(1000)
+    with budget.acquire(1000), deadline.within(0.05):
+        with pytest.raises(deadline.DeadlineExceeded):
+            budget.acquire(1, wait=5)
+
+
+def test_admit(monkeypatch):
+    files = [image_file(100, 100), image_file(200, 100)]
+    needed = limits.estimate_memory(files, {})
+    assert needed > 0
+    # the files are rewound after reading their sizes
+    assert files[0].stream.tell() == 0
+    assert limits.estimate_memory(files, {}, all_pages_held=True) > needed
+
+    monkeypatch.setattr(limits, '_budget', MemoryBudget(needed))
+    with limits.admit(files, {}) as reservation:
+        assert reservation.reserved == needed
+        with pytest.raises(Busy):
+            limits.admit(files, {}, wait=0.01)
+    limits.check(files, {})
+    with pytest.raises(TooLarge):
+        limits.check(files, {}, all_pages_held=True)
+
+
+def test_too_many_pixels(monkeypatch):
+    monkeypatch.setattr(limits, 'MAX_IMAGE_PIXELS', 100 * 100 - 1)
+    with pytest.raises(TooLarge):
+        limits.estimate_memory([image_file(100, 100)], {})
@@ -0,0 +1,62 @@
+import io
+
+import pytest
+
+from helpers import ocr_cache
+from helpers.ocr_cache import OCRCache
+
+OPTIONS = {'lang': 'eng', 'psm': None, 'optimize_images': False, 'intra_block_breaks': True, 'keep_details': False}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return OCRCache(memory_bytes=1024 * 1024, disk_path=str(tmp_path / 'cache.sqlite'), disk_entries=10, version='1')
+
+
+def test_key_is_stable(cache):
+    file = io.BytesIO(b'image bytes')
+    key = cache.make_key(file, OPTIONS)
+    # the file is rewound, the same content and options give the same key, also in another process
+    assert file.tell() == 0
+    assert cache.make_key(file, OPTIONS) == key
+    assert OCRCache(memory_bytes=1024).make_key(io.BytesIO(b'image bytes'), dict(reversed(list(OPTIONS.items())))) == key
+
+
+def test_key_changes_with_content_and_options(cache):
+    key = cache.make_key(io.BytesIO(b'image bytes'), OPTIONS)
+    assert cache.make_key(io.BytesIO(b'other bytes'), OPTIONS) != key
+    assert cache.make_key(io.BytesIO(b'image bytes'), {**OPTIONS, 'lang': 'deu'}) != key
+    assert cache.make_key(io.BytesIO(b'image bytes'), {**OPTIONS, 'keep_details': True}) != key
+    # options which don't change the result
+    assert cache.make_key(io.BytesIO(b'image bytes'), {**OPTIONS, 'save_intermediate': True, 'layout': 'columns'}) == key
+
+
+def test_version_change_invalidates(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cache.sqlite')
+    OCRCache(memory_bytes=1024, disk_path=path, version='1').set('key', {'content': 'old'})
+    assert OCRCache(memory_bytes=1024, disk_path=path, version='1').get('key') == {'content': 'old'}
+    assert OCRCache(memory_bytes=1024, disk_path=path, version='2').get('key', None) is None
+
+    monkeypatch.setattr(ocr_cache, 'PREPROCESS_VERSION', 'changed')
+    assert OCRCache(memory_bytes=1024, disk_path=path, version='1').get('key', None) is None
+
+
+def test_memory_and_disk_tiers(cache, tmp_path):
+    cache.set('key', {'content': 'text'})
+    assert cache.get('key') == {'content': 'text'}
+    # another worker sharing the file
+    other = OCRCache(memory_bytes=1024, disk_path=str(tmp_path / 'cache.sqlite'), version='1')
+    assert other.get('key') == {'content': 'text'}
+    assert other.get('missing', None) is None
+    assert (cache.info()['hits_memory'], other.info()['hits_disk'], other.info()['misses']) == (1, 1, 1)
+
+
+def test_memory_lru_eviction():
+    cache = OCRCache(memory_bytes=60)
+    cache.set('a', 'x' * 20)
+    cache.set('b', 'x' * 20)
+    cache.get('a')
+    cache.set('c', 'x' * 20)
+    # `b` was used least recently
+    assert cache.get('b', None) is None
+    assert cache.get('a') and cache.get('c')
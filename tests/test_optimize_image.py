@@ -0,0 +1,57 @@
+import pytest
+
+from benchmarks.documents import DOCUMENTS
+from helpers import optimize_image, usages
+
+
+def binarize_info(image, preprocess):
+    stages = usages.start()
+    try:
+        optimize_image.optimize_image_array(image, 'page.png', preprocess)
+    finally:
+        usages.stop()
+    return next(stage for stage in stages if stage['stage'] == 'binarize')
+
+
+@pytest.fixture(scope='module')
+def pages():
+    return {name: DOCUMENTS[name]() for name in ('text', 'binary_scan')}
+
+
+def test_binary_page_skips_all_steps(pages):
+    info = binarize_info(pages['binary_scan'], True)
+    assert info['branch'] == 'skip:binary'
+    assert info['skipped'] == ['contrast', 'auto']
+
+
+def test_auto_fast_path_labels_branch(pages):
+    # the contrast step is applied, `auto` skips its dark and default steps
+    info = binarize_info(pages['text'], True)
+    assert info['branch'] == 'skip:bimodal'
+    assert info['skipped'] == ['clahe_dark']
+
+
+def test_nested_skipped_steps_not_counted_for_profile(pages, monkeypatch):
+    # two skipped steps of `auto` besides an applied step of the profile
+    monkeypatch.setitem(optimize_image.DARK_STEPS, optimize_image.BINARY_DARK, ['clahe_dark', 'bilateral_dark'])
+    info = binarize_info(pages['text'], 'auto,otsu')
+    assert info['skipped'] == ['clahe_dark', 'bilateral_dark']
+    assert info['branch'] == 'skip:bimodal'
+    info = binarize_info(pages['text'], 'clahe,otsu')
+    assert info['skipped'] == ['clahe']
+    assert info['branch'] == 'steps'
+    assert binarize_info(pages['text'], 'bilateral,clahe')['branch'] == 'skip:bimodal'
+
+
+def test_return_normalized(pages):
+    image = pages['text']
+    before = image.copy()
+    optimized, scale, normalized = optimize_image.optimize_image_array(image, 'page.png', True, return_normalized=True)
+    unprocessed, unprocessed_scale = optimize_image.optimize_image_array(image, 'page.png', False)
+    assert (normalized == unprocessed).all()
+    assert normalized.shape == optimized.shape
+    assert scale == unprocessed_scale
+    assert (image == before).all()
+    # without steps the page is its own normalized page
+    page, _, normalized = optimize_image.optimize_image_array(image, 'page.png', False, return_normalized=True)
+    assert normalized is page
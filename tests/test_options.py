@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from helpers.ocr import OptionError, parse_options
+
+
+def parse(**options):
+    return parse_options(json.dumps(options))
+
+
+def test_defaults():
+    assert parse_options(None)['lang']
+    assert parse(lang=['eng', 'deu'])['lang'] == 'eng+deu'
+
+
+@pytest.mark.parametrize('dpi', [1, 72, 300, 1200, None])
+def test_dpi(dpi):
+    assert parse(dpi=dpi)['dpi'] == dpi
+
+
+@pytest.mark.parametrize('dpi', ['abc', '300', 0, -100, 1201, 150.5, True, [300]])
+def test_invalid_dpi(dpi):
+    with pytest.raises(OptionError):
+        parse(dpi=dpi)
+
+
+@pytest.mark.parametrize('seconds', [0, -1, 'soon', True])
+def test_invalid_deadline(seconds):
+    with pytest.raises(OptionError):
+        parse(deadline=seconds)
+
+
+@pytest.mark.parametrize('preprocess', [5, ['clahe'], {'steps': 'otsu'}, 'unknown', 'otsu,unknown'])
+def test_invalid_preprocess(preprocess):
+    with pytest.raises(OptionError):
+        parse(preprocess=preprocess)
+
+
+@pytest.mark.parametrize('preprocess', ['auto', 'clahe', 'clahe,otsu', True, False, None])
+def test_preprocess(preprocess):
+    assert parse(preprocess=preprocess)['preprocess'] == preprocess
+
+
+def test_invalid_layout():
+    with pytest.raises(OptionError):
+        parse(layout='table')
+
+
+def test_regions_not_for_pdf():
+    assert parse_options(json.dumps({'regions': True}))['regions'] is True
+    assert parse_options(json.dumps({'regions': False}), pdf=True)['regions'] is False
+    with pytest.raises(OptionError):
+        parse_options(json.dumps({'regions': True}), pdf=True)
+
+
+@pytest.mark.parametrize('route', ['/ocr-to-pdf', '/ocr-batch-to-pdf'])
+def test_pdf_endpoints_reject_regions(route):
+    import io
+
+    import server
+
+    response = server.app.test_client().post(route, data={'file': (io.BytesIO(b'not read'), 'page.png'), 'options': json.dumps({'regions': True})})
+    assert response.status_code == 400
+    assert 'regions' in response.json['error']
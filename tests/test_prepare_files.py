@@ -0,0 +1,57 @@
+import glob
+import os
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+from PIL import Image
+
+from helpers import prepare_files
+
+
+def pages(count: int, fail_at: int):
+    def optimize_files(files, optimize, output_bases, keep_normalized=False):
+        for i in range(count):
+            if i == fail_at:
+                raise ValueError('broken file')
+            image = Image.new('L', (20, 10), 255)
+            image.format = 'PNG'
+            if keep_normalized:
+                image.info['normalized'] = np.full((10, 20), i, np.uint8)
+            yield image
+    return optimize_files
+
+
+@pytest.fixture
+def infer_id(monkeypatch):
+    monkeypatch.setattr(prepare_files.random, 'choices', lambda chars, k: list('testprepare0'))
+    yield 'testprepare0'
+    for path in glob.glob('/tmp/testprepare0*'):
+        os.unlink(path)
+
+
+def test_written_files_removed_when_later_file_fails(infer_id, monkeypatch):
+    monkeypatch.setattr(prepare_files, 'optimize_files', pages(3, fail_at=2))
+    files = [SimpleNamespace(filename=f'{i}.png') for i in range(3)]
+    with pytest.raises(ValueError):
+        prepare_files.prepare_files(files)
+    assert glob.glob(f'/tmp/{infer_id}*') == []
+
+
+def test_batch_list(infer_id, monkeypatch):
+    monkeypatch.setattr(prepare_files, 'optimize_files', pages(2, fail_at=-1))
+    files = [SimpleNamespace(filename=f'{i}.png') for i in range(2)]
+    paths, list_path, _, scales, normalized = prepare_files.prepare_files(files)
+    assert paths == [f'/tmp/{infer_id}_0.png', f'/tmp/{infer_id}_1.png']
+    assert list_path == f'/tmp/{infer_id}.txt'
+    with open(list_path) as file:
+        assert file.read().splitlines() == paths
+    assert scales == [1.0, 1.0]
+    assert normalized == [None, None]
+
+
+def test_normalized_pages_kept(infer_id, monkeypatch):
+    monkeypatch.setattr(prepare_files, 'optimize_files', pages(2, fail_at=-1))
+    files = [SimpleNamespace(filename=f'{i}.png') for i in range(2)]
+    _, _, _, _, normalized = prepare_files.prepare_files(files, keep_normalized=True)
+    assert [page[0, 0] for page in normalized] == [0, 1]
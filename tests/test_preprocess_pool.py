@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+from benchmarks.documents import DOCUMENTS
+from helpers import usages
+from helpers.optimize_image import optimize_image_bytes
+from helpers.preprocess_pool import _from_shared_memory, _optimize_to_shared_memory
+
+
+def test_shared_memory_round_trip():
+    data = cv2.imencode('.png', DOCUMENTS['text']())[1].tobytes()
+    expected, expected_scale, normalized = optimize_image_bytes(data, 'page.png', True, return_normalized=True)
+
+    usages.start()
+    try:
+        arrays, scale = _from_shared_memory(*_optimize_to_shared_memory(data, 'page.png', True, None))
+        assert arrays.shape == (1, *expected.shape)
+        assert np.array_equal(arrays[0], expected)
+        assert scale == expected_scale
+
+        arrays, scale = _from_shared_memory(*_optimize_to_shared_memory(data, 'page.png', True, None, keep_normalized=True))
+        assert arrays.shape == (2, *expected.shape)
+        assert np.array_equal(arrays[0], expected)
+        assert np.array_equal(arrays[1], normalized)
+    finally:
+        usages.stop()
@@ -0,0 +1,84 @@
+import pytest
+
+from benchmarks.process_data import File, make_tsv, process_data_two_pass
+from helpers.ocr_engine import TSV_HEADER
+from helpers.process_data import process_data
+
+FILES = [File(f'page_{i}.png') for i in range(3)]
+
+
+def word(page_num, block_num, line_num, word_num, left, top, conf, text, height=24):
+    return f'5\t{page_num}\t{block_num}\t1\t{line_num}\t{word_num}\t{left}\t{top}\t{len(text) * 14}\t{height}\t{conf}\t{text}'
+
+
+@pytest.mark.parametrize('keep_details', [False, True])
+@pytest.mark.parametrize('intra_block_breaks', [True, False])
+@pytest.mark.parametrize('words, pages', [(1, 1), (130, 1), (3000, 3)])
+def test_equal_to_two_pass(words, pages, intra_block_breaks, keep_details):
+    # several blocks per page, with rows of a confidence below 1 which are left out
+    tsv = make_tsv(words, pages=pages)
+    expected = process_data_two_pass(FILES, tsv, intra_block_breaks, keep_details)
+    assert process_data(FILES, tsv, intra_block_breaks, keep_details) == expected
+    assert process_data(FILES, iter(tsv.splitlines(keepends=True)), intra_block_breaks, keep_details) == expected
+
+
+def test_low_confidence_and_empty_blocks():
+    tsv = '\n'.join([
+        TSV_HEADER,
+        '1\t1\t0\t0\t0\t0\t0\t0\t100\t100\t-1\t',
+        word(1, 1, 1, 1, 10, 10, 0.5, 'noise'),
+        word(1, 1, 1, 2, 60, 10, 95, 'kept'),
+        # only whitespace, the block is left out but not the boxes of other blocks
+        word(1, 2, 1, 1, 10, 50, 90, ' '),
+        word(1, 3, 1, 1, 10, 80, 1, 'low'),
+        word(1, 3, 2, 1, 10, 120, 0, 'dropped'),
+        '',
+    ])
+    for keep_details in (False, True):
+        assert process_data(FILES, tsv, keep_details=keep_details) == process_data_two_pass(FILES, tsv, keep_details=keep_details)
+    assert process_data(FILES, tsv) == [{'page': 1, 'file': 'page_0.png', 'content': 'kept\n\nlow'}]
+
+
+def test_intra_block_breaks():
+    tsv = '\n'.join([TSV_HEADER, word(1, 1, 1, 1, 10, 10, 90, 'above'), word(1, 1, 2, 1, 10, 40, 90, 'below'), word(1, 1, 2, 2, 90, 40, 90, 'right')])
+    assert process_data(FILES, tsv)[0]['content'] == 'above\nbelow right'
+    assert process_data(FILES, tsv, intra_block_breaks=False)[0]['content'] == 'above below right'
+
+
+@pytest.mark.parametrize('tsv', ['', TSV_HEADER, TSV_HEADER + '\n', TSV_HEADER + '\n1\t1\t0\t0\t0\t0\t0\t0\t100\t100\t-1\t\n'])
+def test_empty_pages(tsv):
+    assert process_data(FILES, tsv) == process_data_two_pass(FILES, tsv) == []
+    assert process_data(FILES, iter(tsv.splitlines(keepends=True))) == []
+
+
+def test_file_of_page_after_page_without_text():
+    # page 2 has no words, the baseline named page 3 after the second file, it is named after the third now
+    tsv = '\n'.join([TSV_HEADER, word(1, 1, 1, 1, 10, 10, 90, 'one'), word(2, 1, 1, 1, 10, 10, 0, 'noise'), word(3, 1, 1, 1, 10, 10, 90, 'three')])
+    assert [(page['page'], page['file']) for page in process_data(FILES, tsv)] == [(1, 'page_0.png'), (3, 'page_2.png')]
+    assert [(page['page'], page['file']) for page in process_data_two_pass(FILES, tsv)] == [(1, 'page_0.png'), (3, 'page_1.png')]
+
+
+def test_scales():
+    tsv = '\n'.join([TSV_HEADER, word(1, 1, 1, 1, 100, 40, 90, 'ab', height=30), word(2, 1, 1, 1, 100, 40, 90, 'cd', height=30)])
+    expected = process_data_two_pass(FILES, tsv, keep_details=True)
+    assert process_data(FILES, tsv, keep_details=True, scales=[1.0, 1.0]) == expected
+    pages = process_data(FILES, tsv, keep_details=True, scales=[1.0, 2.0])
+    assert pages[0] == expected[0]
+    box = pages[1]['blocks'][0]['boxes'][0]
+    # back to the coordinates of the input, the text isn't changed
+    assert (box['left'], box['top'], box['width'], box['height']) == (50, 20, 14, 15)
+    assert pages[1]['blocks'][0]['text'] == 'cd'
+
+
+def test_other_column_order():
+    tsv = make_tsv(300, pages=2)
+    lines = [line.split('\t') for line in tsv.split('\n')]
+    order = list(reversed(range(12)))
+    reordered = '\n'.join('\t'.join(cells[i] for i in order) if len(cells) == 12 else '\t'.join(cells) for cells in lines)
+    for keep_details in (False, True):
+        assert process_data(FILES, reordered, keep_details=keep_details) == process_data(FILES, tsv, keep_details=keep_details)
+
+
+def test_missing_columns():
+    with pytest.raises(ValueError):
+        process_data(FILES, 'level\tpage_num\ttext\n5\t1\tword\n')
@@ -0,0 +1,37 @@
+import numpy as np
+from PIL import Image
+
+from helpers import refine
+from helpers.ocr_engine import TSV_HEADER
+from helpers.optimize_image import to_pil_image
+
+WEAK_TSV = TSV_HEADER + '\n' + ''.join('\t'.join(map(str, cells)) + '\n' for cells in [
+    (1, 1, 0, 0, 0, 0, 0, 0, 200, 100, -1, ''),
+    (2, 1, 1, 0, 0, 0, 40, 30, 60, 20, -1, ''),
+    (5, 1, 1, 1, 1, 1, 40, 30, 60, 20, 20, 'wcak'),
+])
+
+
+def crops_of(image: Image.Image, monkeypatch):
+    crops = []
+
+    def recognize(crop, name, preprocess, psm, lang, config, until):
+        crops.append(crop)
+        return [], 1.0
+    monkeypatch.setattr(refine, 'recognize', recognize)
+    assert refine.refine_page(image, WEAK_TSV, 'eng', []) == WEAK_TSV
+    return crops
+
+
+def test_crops_from_normalized_page(monkeypatch):
+    binarized = np.full((100, 200), 255, np.uint8)
+    normalized = np.full((100, 200), 180, np.uint8)
+    crops = crops_of(to_pil_image(binarized, 'page.png', normalized=normalized), monkeypatch)
+    assert len(crops) == len(refine.REFINE_ALTERNATIVES)
+    padding = refine.REFINE_PADDING
+    assert all(crop.shape == (20 + 2 * padding, 60 + 2 * padding) and (crop == 180).all() for crop in crops)
+
+
+def test_crops_from_page_without_normalized(monkeypatch):
+    crops = crops_of(to_pil_image(np.full((100, 200), 255, np.uint8), 'page.png'), monkeypatch)
+    assert crops and all((crop == 255).all() for crop in crops)
@@ -0,0 +1,68 @@
+import gzip
+import json
+
+from werkzeug.http import parse_accept_header
+
+from helpers.serialize import BOX_COLUMNS, BOX_FIELDS, LAYOUT_COLUMNS, LAYOUT_ROWS, column_page, compress, dumps, layout_pages, row_page
+
+
+def box(block_num, word_num, text):
+    return {
+        'level': 5, 'page_num': 2, 'block_num': block_num, 'par_num': 1, 'line_num': 1, 'word_num': word_num,
+        'left': 10 * word_num, 'top': 20 * block_num, 'width': 8, 'height': 12, 'conf': 91.5, 'text': text,
+    }
+
+
+PAGE = {
+    'page': 2,
+    'file': 'scan.pdf',
+    'blocks': [
+        {'block': 1, 'text': 'a b', 'boxes': [box(1, 1, 'a'), box(1, 2, 'b')]},
+        {'block': 3, 'text': 'c', 'boxes': [box(3, 1, 'c')]},
+    ],
+}
+
+
+def rows_of(page):
+    # the rows back from the parallel arrays, page and block numbers are those of the page and block
+    return {
+        **{key: page[key] for key in ('page', 'file')},
+        'blocks': [{
+            'block': block['block'],
+            'text': block['text'],
+            'boxes': [
+                {'page_num': page['page'], 'block_num': block['block'], **{field: block['columns'][field][i] for field in BOX_COLUMNS}}
+                for i in range(len(block['columns']['left']))
+            ],
+        } for block in page['blocks']],
+    }
+
+
+def test_row_page():
+    page = row_page(PAGE)
+    # boxes without their text, which is in the text of the block
+    assert page['blocks'][0]['boxes'][0] == {field: box(1, 1, 'a')[field] for field in BOX_FIELDS}
+    assert row_page({'page': 1, 'file': 'a.png', 'content': 'text'}) == {'page': 1, 'file': 'a.png', 'content': 'text'}
+
+
+def test_columns_round_trip():
+    columns = column_page(PAGE)
+    assert columns['blocks'][0]['columns']['left'] == [10, 20]
+    assert rows_of(columns) == row_page(PAGE)
+    # also through JSON, as the client receives it
+    assert rows_of(json.loads(dumps(columns))) == row_page(PAGE)
+
+
+def test_layout_pages_keeps_missing_pages():
+    assert layout_pages([PAGE, None], LAYOUT_COLUMNS) == [column_page(PAGE), None]
+    assert layout_pages([PAGE, None], LAYOUT_ROWS) == [row_page(PAGE), None]
+
+
+def test_compress():
+    body = dumps([PAGE] * 50)
+    gzip_only = parse_accept_header('gzip, deflate')
+    assert compress(body[:10], gzip_only) is None
+    assert compress(body, None) is None
+    assert compress(body, parse_accept_header('br')) is None
+    encoding, compressed = compress(body, gzip_only)
+    assert encoding == 'gzip' and gzip.decompress(compressed) == body
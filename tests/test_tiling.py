@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from helpers.ocr_engine import TSV_HEADER
+from helpers.tiling import TILE_OVERLAP, Tile, find_cuts, merge_tiles, split_tiles
+
+WIDTH = 2000
+HEIGHT = 600
+CUT = 1000
+# two tiles side by side, cut at `CUT`, each reaching `TILE_OVERLAP` into the other
+LEFT = Tile(0, 0, CUT + TILE_OVERLAP, HEIGHT, (0, 0, CUT, HEIGHT))
+RIGHT = Tile(CUT - TILE_OVERLAP, 0, WIDTH, HEIGHT, (CUT, 0, WIDTH, HEIGHT))
+
+
+def word(tile, left, top, width, text, block_num=1, line_num=1, word_num=1, height=30):
+    # `left` and `top` in page coordinates, written in the coordinates of the crop like the engine does
+    return f'5\t1\t{block_num}\t1\t{line_num}\t{word_num}\t{left - tile.left}\t{top - tile.top}\t{width}\t{height}\t95\t{text}'
+
+
+def tile_tsv(tile, *words):
+    return '\n'.join([
+        TSV_HEADER,
+        f'1\t1\t0\t0\t0\t0\t0\t0\t{tile.right - tile.left}\t{tile.bottom - tile.top}\t-1\t',
+        f'2\t1\t1\t0\t0\t0\t0\t0\t10\t10\t-1\t',
+        *words,
+    ]) + '\n'
+
+
+def merged_words(tsv):
+    rows = [line.split('\t') for line in tsv.split('\n')[1:] if line]
+    return {cells[11]: cells for cells in rows if cells[0] == '5'}, [cells[11] for cells in rows if cells[0] == '5']
+
+
+def merge(left_words, right_words):
+    return merge_tiles([LEFT, RIGHT], [tile_tsv(LEFT, *left_words), tile_tsv(RIGHT, *right_words)], WIDTH, HEIGHT)
+
+
+def test_words_outside_the_overlap():
+    words, texts = merged_words(merge([word(LEFT, 100, 100, 80, 'left')], [word(RIGHT, 1500, 100, 80, 'right')]))
+    assert texts == ['left', 'right']
+    # in page coordinates
+    assert (words['right'][6], words['right'][7]) == ('1500', '100')
+
+
+@pytest.mark.parametrize('left', [880, 930, 960, 1010])
+def test_word_in_the_overlap_kept_once(left):
+    # both tiles recognize the word completely, the tile whose core contains its center keeps it
+    words, texts = merged_words(merge([word(LEFT, left, 100, 60, 'both')], [word(RIGHT, left, 100, 60, 'both')]))
+    assert texts == ['both']
+    assert words['both'][6] == str(left)
+
+
+def test_slightly_different_boxes_in_the_overlap_kept_once():
+    # the centers are on different sides of the cut, the boxes overlap mostly
+    _, texts = merged_words(merge([word(LEFT, 961, 100, 76, 'same')], [word(RIGHT, 963, 100, 76, 'same')]))
+    assert texts == ['same']
+
+
+def test_word_cut_by_the_edge_of_a_crop():
+    # the left tile only sees a part of the word, the right tile the whole word
+    crop_right = LEFT.right
+    words, texts = merged_words(merge(
+        [word(LEFT, 1150, 100, crop_right - 1150, 'edge')],
+        [word(RIGHT, 1150, 100, 60, 'edge')],
+    ))
+    assert texts == ['edge']
+    assert words['edge'][8] == '60'
+
+
+def test_word_straddling_the_cut_wider_than_the_overlap():
+    # neither tile contains the word completely, the pieces are joined to decide which tile keeps it
+    left, right = CUT - TILE_OVERLAP - 100, CUT + TILE_OVERLAP + 200
+    _, texts = merged_words(merge(
+        [word(LEFT, left, 100, LEFT.right - left, 'wide')],
+        [word(RIGHT, RIGHT.left, 100, right - RIGHT.left, 'wide')],
+    ))
+    assert texts == ['wide']
+
+
+def test_blocks_renumbered_per_tile():
+    words, texts = merged_words(merge(
+        [word(LEFT, 100, 100, 60, 'a', block_num=1), word(LEFT, 100, 300, 60, 'b', block_num=2, line_num=2)],
+        [word(RIGHT, 1500, 100, 60, 'c', block_num=1), word(RIGHT, 1500, 300, 60, 'd', block_num=2, line_num=3)],
+    ))
+    assert texts == ['a', 'b', 'c', 'd']
+    assert [words[text][2] for text in texts] == ['1', '2', '3', '4']
+    # lines stay numbered within their block
+    assert [words[text][4] for text in texts] == ['1', '2', '1', '3']
+
+
+def test_single_tile_is_passed_through():
+    tile = Tile(0, 0, WIDTH, HEIGHT, (0, 0, WIDTH, HEIGHT))
+    tsv = tile_tsv(tile, word(tile, 0, 0, 60, 'corner'), word(tile, WIDTH - 60, HEIGHT - 30, 60, 'end', block_num=2))
+    assert merge_tiles([tile], [tsv], WIDTH, HEIGHT) == tsv
+    # only moved to the page
+    rows = [line.split('\t') for line in merge_tiles([tile], [tsv], WIDTH, HEIGHT, page_num=3).split('\n')[1:] if line]
+    assert [cells[1] for cells in rows] == ['3'] * 4
+    assert [cells[:1] + cells[2:] for cells in rows] == [line.split('\t')[:1] + line.split('\t')[2:] for line in tsv.split('\n')[1:] if line]
+
+
+def test_find_cuts_in_gutters():
+    ink = np.ones(3000, dtype=int)
+    # whitespace near the targets at 1000 and 2000
+    ink[1090] = 0
+    ink[1920] = 0
+    assert find_cuts(ink, 1000) == [0, 1090, 1920, 3000]
+    # without whitespace, at the target
+    assert find_cuts(np.ones(3000, dtype=int), 1000) == [0, 1000, 2000, 3000]
+    assert find_cuts(np.ones(1200, dtype=int), 3000) == [0, 1200]
+
+
+def test_split_tiles_cover_the_page():
+    image = np.full((2000, 4000), 255, dtype=np.uint8)
+    tiles = split_tiles(image, tile_size=1000, overlap=100)
+    assert len(tiles) == 4 * 2
+    covered = np.zeros(image.shape, dtype=int)
+    for tile in tiles:
+        x0, y0, x1, y1 = tile.core
+        covered[y0:y1, x0:x1] += 1
+        assert (tile.left, tile.top, tile.right, tile.bottom) == (max(0, x0 - 100), max(0, y0 - 100), min(4000, x1 + 100), min(2000, y1 + 100))
+    # each pixel in the core of exactly one tile
+    assert (covered == 1).all()